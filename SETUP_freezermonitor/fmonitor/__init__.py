@@ -0,0 +1,40 @@
+########################################################################
+#	     This script was written by E. Bentz: ejb345@cornell.edu       #
+########################################################################
+# Freezermonitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any
+# later version.
+
+# Project: Freezermonitor
+# License: GNU General Public License v3.0
+
+# The freezermonitor package holds the monitoring software run by freezermonitor.py.
+# Importing it has no side effects: hardware, network clients and files are only opened
+# when a Monitor is created, so every part can be imported and exercised off a Raspberry Pi.
+#
+#   settings       - reads and validates config.ini
+#   sensors        - sensor interface with MAX31865, simulated and replay backends
+#   acquisition    - sensor reading thread, fault checks and the ring buffer of readings
+#   state          - latest readings and device status used to build emails
+#   messages       - email content
+#   notifications  - background email delivery
+#   filters        - streaming filters for raw readings and the trend estimate
+#   sampling       - adaptive sampling rate
+#   alarms         - per probe alarm states, kept across restarts
+#   storage        - local store of every reading
+#   archive        - compressed archive of old readings
+#   rollups        - 1 minute, 1 hour and 1 day summaries of readings
+#   reports        - weekly report built from the rollups
+#   upload         - on-disk upload queue and the Initial State client
+#   fleet          - client for sending readings and emails through a fleet collector
+#   scheduler      - monotonic job scheduler
+#   eventlog       - central JSON-lines log
+#   metrics        - timings and counters, served in the OpenMetrics format
+#   network        - ip address lookup
+#   monitor        - ties everything together
+#   __main__       - command line entry point (python3 -m fmonitor)
+#   benchmark      - end-to-end benchmarks (python3 -m fmonitor.benchmark)
+#   backtest       - replays recorded readings through the alarms with many settings (python3 -m fmonitor.backtest)
+#   collector      - fleet collector server (python3 -m fmonitor.collector)
+#   query          - looks up, exports and serves the recorded readings (fmquery.py, python3 -m fmonitor.query)
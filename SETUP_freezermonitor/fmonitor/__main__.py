@@ -0,0 +1,34 @@
+# Command line entry point: python3 -m fmonitor (freezermonitor.py does the same)
+
+import argparse
+import asyncio
+import signal
+import sys
+
+from .eventlog import get_logger
+from .monitor import Monitor
+from .sensors import PROFILES, create_sensor, simulated_sensor
+from .settings import load_settings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='freezermonitor', description="Monitor freezer temperatures, upload them to Initial State and email when they get too warm.")
+    parser.add_argument('--config', default='config.ini', help="settings file (default: config.ini in the current directory)")
+    parser.add_argument('--simulate', choices=sorted(PROFILES), metavar='PROFILE',
+                        help=f"read every probe from a simulated temperature profile instead of its sensor ({', '.join(sorted(PROFILES))})")
+    args = parser.parse_args(argv)
+
+    settings = load_settings(args.config)
+    sensor_factory = create_sensor
+    if args.simulate:
+        sensor_factory = lambda probe: simulated_sensor(probe.options, args.simulate)
+    monitor = Monitor(settings, sensor_factory=sensor_factory, config_path=args.config)
+
+    # Log startup
+    get_logger('startup').info("freezermonitor service started")
+
+    # Exit normally when systemd stops the service, so that buffered log records are written out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    asyncio.run(monitor.run())
+
+if __name__ == '__main__':
+    main()
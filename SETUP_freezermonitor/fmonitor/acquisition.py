@@ -0,0 +1,189 @@
+# Reading the probes on a thread of their own
+#
+# The probes are read by a dedicated acquisition thread that keeps its own time on the monotonic clock,
+# like the scheduler, so readings are taken on time even while the event loop is busy, e.g. building an
+# email or writing a large upload batch. Each pass over the probes is checked for faults and stored, with
+# the time it was taken, in a SampleRing that the monitor reads from the event loop.
+#
+# A pass can only take as long as the slowest sensor driver call, which cannot be interrupted from Python.
+# A pass that took longer than SENSOR_TIMEOUT seconds is stored as a timeout fault rather than as
+# readings, and if the thread stops storing passes altogether the monitor records timeout faults for
+# every probe until it starts again (see Monitor.consume_samples).
+#
+# Besides faults reported by the sensor itself (see sensors.SensorFault) and failed reads, a reading is
+# a fault if it is outside SENSOR_MIN_TEMP to SENSOR_MAX_TEMP, which a working probe cannot read, or if it
+# has not changed at all for STUCK_TIME seconds. A real probe always shows a little noise, so a reading
+# that never changes comes from a converter or driver that has stopped updating.
+
+import math
+import threading
+import time
+from array import array
+
+from .eventlog import get_logger
+from .metrics import Histogram, Timer
+from .scheduler import ScheduledJob, lateness_seconds
+from .sensors import FAULTS, SensorFault, read_sensors
+
+error_log = get_logger('unexpected')
+
+sensor_read_seconds = Histogram('fmonitor_sensor_read_seconds', "Time to read every probe once")
+
+# Fault codes stored in the ring. 0 is a good reading
+FAULT_CODES = (None,) + tuple(FAULTS)
+FAULT_CODE = {kind: code for code, kind in enumerate(FAULT_CODES) if kind is not None}
+
+# Passes kept in the ring. The monitor handles every pass as soon as it is woken, so this only needs to
+# cover the event loop being held up, and at 16 bytes per pass plus 17 per probe it costs little
+RING_PASSES = 1024
+
+# Fixed-size ring of passes over the probes. Everything is allocated up front in flat arrays, so storing
+# a good pass only writes numbers into them and creates no objects; only a fault adds its description.
+# There is a single writer, the acquisition thread, which fills in a slot and only then moves written on.
+# A reader keeps its own position, copies the slots up to written and afterwards checks with overwritten()
+# that the writer has not come round to them again in the meantime, so readers never take a lock
+class SampleRing:
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        # Monotonic and wall clock time of each pass
+        self.times = array('d', bytes(8 * capacity))
+        self.timestamps = array('d', bytes(8 * capacity))
+        # Reading and fault code of each probe, width entries per pass. Faulty readings are NaN
+        self.values = array('d', bytes(8 * capacity * width))
+        self.faults = array('B', bytes(capacity * width))
+        # Description of each fault, kept with its pass so a backlog of passes keeps every fault's own detail
+        self.details = [''] * (capacity * width)
+        # Number of passes ever stored
+        self.written = 0
+
+    # True if pass number position may have been replaced by a newer one
+    def overwritten(self, position):
+        return self.written - position >= self.capacity
+
+class Acquisition:
+    def __init__(self, probes, settings, interval, capacity=RING_PASSES):
+        self.probes = probes
+        self.sensors = [probe.sensor for probe in probes]
+        self.settings = settings
+        self.ring = SampleRing(capacity, len(probes))
+        # Latest reading of each probe and when it last changed, for spotting stuck readings
+        self.last_values = array('d', [math.nan] * len(probes))
+        self.unchanged_since = array('d', [0.0] * len(probes))
+        # Timing and lateness, kept and reported the same way as for the scheduler's jobs
+        self.job = ScheduledJob('sample', self.read_pass, interval, time.monotonic())
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.notify = None
+        self.thread = None
+
+    @property
+    def interval(self):
+        return self.job.interval
+
+    def stats(self):
+        return self.job.stats()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Start reading on a new thread. notify is called from the thread after every pass. The ring has a
+    # single writer, so a thread that is still running (e.g. stuck in a read after stop() gave up on it)
+    # must finish before another is started
+    def start(self, notify):
+        if self.running():
+            raise RuntimeError("The sensor thread is still running")
+        self.notify = notify
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='sensor', daemon=True)
+        self.thread.start()
+
+    # Stop the thread, waiting up to timeout seconds for a read in progress to finish. Returns False if
+    # it is still running, in which case it stops on its own once the read returns
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                error_log.error(f"The sensor thread did not stop within {timeout} seconds", extra={'event': 'acquisition_stop_timeout'})
+                return False
+        return True
+
+    # Change the time between passes, counting from when the next pass is due
+    def set_interval(self, interval):
+        with self.lock:
+            if interval != self.job.interval:
+                self.job.due += interval - self.job.interval
+                self.job.interval = interval
+        self.wakeup.set()
+
+    def run(self):
+        job = self.job
+        while not self.stopping.is_set():
+            delay = job.due - time.monotonic()
+            if delay > 0:
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+                continue
+            lateness = -delay
+            job.runs += 1
+            job.last_lateness = lateness
+            job.max_lateness = max(job.max_lateness, lateness)
+            job.total_lateness += lateness
+            lateness_seconds.observe(lateness, job=job.name)
+            try:
+                self.read_pass()
+                self.notify()
+            except Exception as e:
+                error_log.error(f"Unexpected error in 'sample': {str(e)}", extra={'event': 'job_failed', 'fields': {'job': job.name}})
+            # Missed passes are skipped rather than taken back to back, as in the scheduler
+            with self.lock:
+                job.due += job.interval
+                behind = time.monotonic() - job.due
+                if behind >= 0:
+                    missed = int(behind // job.interval) + 1
+                    job.skipped += missed
+                    job.due += missed * job.interval
+
+    # Read every probe once and store the pass in the ring
+    def read_pass(self):
+        now = time.monotonic()
+        timestamp = time.time()
+        with Timer(sensor_read_seconds):
+            results = read_sensors(self.sensors)
+        slow = time.monotonic() - now > self.settings.SENSOR_TIMEOUT
+        ring = self.ring
+        slot = ring.written % ring.capacity
+        base = slot * ring.width
+        for i, result in enumerate(results):
+            fault = self.check(base + i, i, result, now, slow)
+            ring.values[base + i] = math.nan if fault else result
+            ring.faults[base + i] = fault
+        ring.times[slot] = now
+        ring.timestamps[slot] = timestamp
+        ring.written += 1
+
+    # Fault code for the result of reading probe i, 0 for a good reading. A fault's description is stored
+    # at position in the ring
+    def check(self, position, i, result, now, slow):
+        settings = self.settings
+        if isinstance(result, SensorFault):
+            return self.fault(position, result.kind, str(result))
+        if isinstance(result, Exception):
+            return self.fault(position, 'read_error', str(result))
+        if slow:
+            return self.fault(position, 'timeout', f"reading the probes took longer than {settings.SENSOR_TIMEOUT} seconds")
+        if not settings.SENSOR_MIN_TEMP <= result <= settings.SENSOR_MAX_TEMP:
+            return self.fault(position, 'implausible', f"read {result:.2f}°C")
+        if result != self.last_values[i]:
+            self.last_values[i] = result
+            self.unchanged_since[i] = now
+        elif settings.STUCK_TIME > 0 and now - self.unchanged_since[i] >= settings.STUCK_TIME:
+            return self.fault(position, 'stuck', f"read {result:.2f}°C for {now - self.unchanged_since[i]:.0f} seconds")
+        return 0
+
+    def fault(self, position, kind, detail):
+        self.ring.details[position] = detail
+        return FAULT_CODE[kind]
@@ -0,0 +1,210 @@
+# Alarm state of each probe
+#
+# Every probe's alarm is in one of five states:
+#
+#   NORMAL     no alarm
+#   WARNING    at or above WARNING_TEMP for ALARM_HOLD_TIME seconds
+#   ALERT      the same, and at or above ALERT_TEMP
+#   PANIC      the same, and at or above PANIC_TEMP
+#   RECOVERED  back below RESET_TEMP after an alarm, until ALARM_CLEAR_TIME seconds have passed
+#
+# A probe moves straight to the highest threshold it has reached, with one notification. Moving up
+# notifies again. Moving down never notifies: a probe only drops to a lower level once it is ALARM_HYSTERESIS
+# degrees below the threshold of its current level, so a temperature hovering on a threshold does not send a
+# stream of emails, and it only leaves the alarm once it is below RESET_TEMP. While a probe stays in WARNING,
+# ALERT or PANIC the notification is repeated every ALARM_RENOTIFY_INTERVAL seconds, and when it recovers a
+# notification is sent if ALARM_RECOVERY_NOTIFICATION is set.
+#
+# Sensor faults are a separate alarm that sits beside these states and never changes them: a probe
+# whose sensor is broken has no temperature to check, so it is neither in an alarm nor recovered. The
+# fault alarm is raised once every reading of the probe has been faulty for SENSOR_FAULT_TIME seconds,
+# repeated every ALARM_RENOTIFY_INTERVAL seconds while it lasts, and cleared once the readings have been
+# good again for SENSOR_FAULT_TIME seconds, each with a notification.
+#
+# The states, along with when the boot message was last sent, are kept in data/alarms.json. The file is
+# replaced atomically whenever something changes (a new state or a notification, so rarely), and read
+# back on startup, so a monitor restarted in the middle of a warming carries on where it left off instead
+# of sending every notification again. All times in the file are seconds since the epoch.
+
+import json
+import os
+
+from .eventlog import get_logger
+from .sensors import FAULTS
+
+NORMAL = 'NORMAL'
+WARNING = 'WARNING'
+ALERT = 'ALERT'
+PANIC = 'PANIC'
+RECOVERED = 'RECOVERED'
+
+# Alarm states by the number of thresholds reached
+LEVELS = (NORMAL, WARNING, ALERT, PANIC)
+
+# Readings this high come from a broken or disconnected probe and never move an alarm
+MAX_TEMPERATURE = 100
+
+alarm_log = get_logger('alarms')
+
+# since is when the probe entered its state and notified when its last notification was sent. started and
+# peak are when the current or last alarm started and the highest temperature it reached. predicted is set
+# once a predicted breach has been sent. fault is the kind of sensor fault (see sensors.FAULTS) while the
+# sensor fault alarm is raised and None otherwise, with when it was raised and last notified
+class AlarmState:
+    def __init__(self, state=NORMAL, since=0.0, notified=0.0, started=0.0, peak=None, predicted=False, fault=None, fault_since=0.0,
+                 fault_notified=0.0):
+        self.state = state
+        self.since = since
+        self.notified = notified
+        self.started = started
+        self.peak = peak
+        self.predicted = predicted
+        self.fault = fault
+        self.fault_since = fault_since
+        self.fault_notified = fault_notified
+        self.changed = False
+
+    # Number of thresholds of the current state: 0 for NORMAL and RECOVERED, up to 3 for PANIC
+    def level(self):
+        return LEVELS.index(self.state) if self.state in LEVELS else 0
+
+    def enter(self, state, now):
+        self.state = state
+        self.since = now
+        self.changed = True
+
+    def set_predicted(self, predicted):
+        if predicted != self.predicted:
+            self.predicted = predicted
+            self.changed = True
+
+    # Move on for a new reading of the probe. above is True once readings have been at or above WARNING_TEMP
+    # for ALARM_HOLD_TIME seconds. Returns the state to notify about, or None
+    def update(self, probe, temperature, above, now, settings):
+        if temperature >= MAX_TEMPERATURE:
+            return None
+        level = self.level()
+        reached = probe.level(temperature) if above else 0
+        if level:
+            self.peak = temperature if self.peak is None else max(self.peak, temperature)
+        if reached > level:
+            if not level:
+                self.started = now
+                self.peak = temperature
+            self.enter(LEVELS[reached], now)
+            self.notified = now
+            return self.state
+
+        if level:
+            if temperature < probe.reset_temp:
+                self.enter(RECOVERED, now)
+                if settings.ALARM_RECOVERY_NOTIFICATION:
+                    self.notified = now
+                    return RECOVERED
+                return None
+            thresholds = (probe.warning_temp, probe.alert_temp, probe.panic_temp)
+            lower = level
+            while lower > 1 and temperature < thresholds[lower - 1] - settings.ALARM_HYSTERESIS:
+                lower -= 1
+            if lower < level:
+                self.enter(LEVELS[lower], now)
+            elif settings.ALARM_RENOTIFY_INTERVAL > 0 and now - self.notified >= settings.ALARM_RENOTIFY_INTERVAL:
+                self.notified = now
+                self.changed = True
+                return self.state
+            return None
+
+        if self.state == RECOVERED and now - self.since >= settings.ALARM_CLEAR_TIME:
+            self.enter(NORMAL, now)
+        return None
+
+    # Raise the sensor fault alarm, or keep it raised, for a probe that has had nothing but faulty readings
+    # for SENSOR_FAULT_TIME seconds. Returns True if the fault should be notified
+    def set_fault(self, kind, now, settings):
+        if self.fault is None:
+            self.fault = kind
+            self.fault_since = now
+            self.fault_notified = now
+            self.changed = True
+            return True
+        if kind != self.fault:
+            self.fault = kind
+            self.changed = True
+        if settings.ALARM_RENOTIFY_INTERVAL > 0 and now - self.fault_notified >= settings.ALARM_RENOTIFY_INTERVAL:
+            self.fault_notified = now
+            self.changed = True
+            return True
+        return False
+
+    def clear_fault(self):
+        self.fault = None
+        self.changed = True
+
+    def to_json(self):
+        return {'state': self.state, 'since': self.since, 'notified': self.notified, 'started': self.started, 'peak': self.peak,
+                'predicted': self.predicted, 'fault': self.fault, 'fault_since': self.fault_since, 'fault_notified': self.fault_notified}
+
+    @classmethod
+    def from_json(cls, entry):
+        state = entry.get('state', NORMAL)
+        if state not in LEVELS and state != RECOVERED:
+            state = NORMAL
+        fault = entry.get('fault')
+        if fault not in FAULTS:
+            fault = None
+        return cls(state, float(entry.get('since', 0.0)), float(entry.get('notified', 0.0)), float(entry.get('started', 0.0)),
+                   entry.get('peak'), bool(entry.get('predicted', False)), fault, float(entry.get('fault_since', 0.0)),
+                   float(entry.get('fault_notified', 0.0)))
+
+class AlarmStore:
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        # Time the boot message was last sent, None if never
+        self.boot_notified = None
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.boot_notified = data.get('boot_notified')
+            self.states = {int(sensor_id): AlarmState.from_json(entry) for sensor_id, entry in data.get('probes', {}).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            alarm_log.error(f"Could not read {self.path}, starting with every probe in NORMAL: {e}", extra={'event': 'alarms_unreadable'})
+            self.states = {}
+
+    # Alarm state of a probe, NORMAL for a probe that has none yet
+    def get(self, sensor_id):
+        state = self.states.get(sensor_id)
+        if state is None:
+            state = self.states[sensor_id] = AlarmState()
+        return state
+
+    # True if no boot message has been sent within the last min_interval seconds, e.g. because the
+    # service is being restarted over and over. Records the time if so
+    def boot_message_due(self, now, min_interval):
+        if self.boot_notified is not None and 0 <= now - self.boot_notified < min_interval:
+            return False
+        self.boot_notified = now
+        self.changed = True
+        return True
+
+    # Write the file if anything has changed since it was last written
+    def save(self):
+        if not self.changed and not any(state.changed for state in self.states.values()):
+            return
+        data = json.dumps({'boot_notified': self.boot_notified,
+                           'probes': {str(sensor_id): state.to_json() for sensor_id, state in sorted(self.states.items())}},
+                          indent=1).encode('utf-8')
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+        for state in self.states.values():
+            state.changed = False
@@ -0,0 +1,288 @@
+# Compressed archive of old readings
+#
+# Raw segments take 16 bytes per reading, about 50 MB per probe per year at one reading every 10 seconds.
+# When ARCHIVE_AFTER_DAYS is set, full segments older than that are sealed into the archive and deleted.
+# Each sealed segment becomes one file, arc-<segment number>.bin, holding a block of up to BLOCK_READINGS
+# readings per probe:
+#
+#   encoding    1 byte, FIXED_POINT or XOR
+#   count       varint
+#   timestamps  milliseconds since the epoch: the first as a varint, the first difference as a zigzag
+#               varint and then the change in the difference (delta-of-delta) as zigzag varints. Readings
+#               taken at a steady interval have a delta-of-delta of a few milliseconds, so most take a byte
+#   values      FIXED_POINT: the temperature in hundredths of a degree as the zigzag difference from the
+#               previous value plus one, with 0 for a failed reading (NaN). The monitor stores readings
+#               rounded to 0.01 degrees, so a block is only written this way if every value comes back
+#               exactly, and small changes take a byte each.
+#               XOR: the bits of each value as a 32-bit float XORed with the previous value's, as a varint.
+#               Similar values share their sign, exponent and leading mantissa bits, so the result is small
+#   flags       (run length, flags) varint pairs
+#
+# Each block is then compressed with zlib, which mostly squeezes out the runs of identical one-byte
+# deltas. A steady probe comes to under a byte per reading, so the archive is well over ten times
+# smaller than the raw segments. Timestamps are kept to the millisecond, values exactly.
+#
+# archive-index holds the segment, position, probe, count, time span and lowest and highest temperature
+# of every block. Queries only read and decode the blocks that overlap the time span and range of
+# temperatures asked for, and decoding is a sequential pass using C-level accumulate over whole blocks.
+# The index is only ever appended to, or replaced atomically, and a segment's raw file is only deleted
+# once its blocks are in the index, so a power cut never loses readings.
+
+import heapq
+import itertools
+import math
+import operator
+import os
+import struct
+import zlib
+from array import array
+
+INDEX_RECORD = struct.Struct('<IIIHIddff')
+BLOCK_READINGS = 8192
+
+FIXED_POINT = 1
+XOR = 2
+
+# Hundredths of a degree
+SCALE = 100
+
+## ----- Varints ----- ##
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_varints(out, values):
+    for value in values:
+        if value < 0x80:
+            out.append(value)
+        else:
+            write_varint(out, value)
+
+# count varints starting at pos. Returns the values and the position after them. Most values fit in a
+# single byte, so runs of those are copied in one go and only the rest are decoded byte by byte
+def read_varints(data, pos, count):
+    values = []
+    append = values.append
+    while count:
+        run = min(count, 64)
+        chunk = data[pos:pos + run]
+        if max(chunk) < 0x80:
+            values.extend(chunk)
+            pos += run
+            count -= run
+            continue
+        count -= run
+        for _ in range(run):
+            byte = data[pos]
+            pos += 1
+            if byte < 0x80:
+                append(byte)
+                continue
+            value = byte & 0x7f
+            shift = 7
+            while True:
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            append(value)
+    return values, pos
+
+def unzigzag(values):
+    return [(value >> 1) ^ -(value & 1) for value in values]
+
+## ----- Blocks ----- ##
+
+# Encode (timestamp, sensor_id, value, flags) records of one probe, in time order
+def encode_block(records):
+    count = len(records)
+    out = bytearray()
+    times = [round(record[0] * 1000) for record in records]
+    values = [record[2] for record in records]
+    encoding = XOR
+    if not any(math.isinf(value) for value in values):
+        valid = [0.0 if math.isnan(value) else value for value in values]
+        scaled = [round(value * SCALE) for value in valid]
+        if array('f', [value / SCALE for value in scaled]) == array('f', valid):
+            encoding = FIXED_POINT
+    out.append(encoding)
+    write_varint(out, count)
+
+    write_varint(out, times[0])
+    deltas = [b - a for a, b in zip(times, times[1:])]
+    write_varints(out, [zigzag(delta) for delta in deltas[:1]])
+    write_varints(out, [zigzag(b - a) for a, b in zip(deltas, deltas[1:])])
+
+    if encoding == FIXED_POINT:
+        previous = 0
+        encoded = []
+        for value, level in zip(values, scaled):
+            if value != value:
+                encoded.append(0)
+                continue
+            encoded.append(zigzag(level - previous) + 1)
+            previous = level
+        write_varints(out, encoded)
+    else:
+        bits = array('I')
+        bits.frombytes(array('f', values).tobytes())
+        write_varints(out, [b ^ a for a, b in zip(itertools.chain((0,), bits), bits)])
+
+    for flags, run in itertools.groupby(record[3] for record in records):
+        write_varint(out, sum(1 for _ in run))
+        write_varint(out, flags)
+    return zlib.compress(bytes(out))
+
+# Decode a block into lists of timestamps, values and flags
+def decode_block(block):
+    data = zlib.decompress(block)
+    encoding = data[0]
+    count, pos = read_varints(data, 1, 1)
+    count = count[0]
+
+    first, pos = read_varints(data, pos, 1)
+    changes, pos = read_varints(data, pos, count - 1)
+    deltas = itertools.accumulate(unzigzag(changes))
+    times = [ms / 1000 for ms in itertools.accumulate(itertools.chain(first, deltas))]
+
+    encoded, pos = read_varints(data, pos, count)
+    if encoding == FIXED_POINT:
+        levels = itertools.accumulate([(value - 1 >> 1) ^ -(value - 1 & 1) if value else 0 for value in encoded])
+        values = array('f', [level / SCALE for level in levels]).tolist()
+        for i, value in enumerate(encoded):
+            if not value:
+                values[i] = math.nan
+    else:
+        bits = array('I', itertools.accumulate(encoded, operator.xor))
+        floats = array('f')
+        floats.frombytes(bits.tobytes())
+        values = floats.tolist()
+
+    flags = []
+    while len(flags) < count:
+        (run, value), pos = read_varints(data, pos, 2)
+        flags.extend(itertools.repeat(value, run))
+    return times, values, flags
+
+## ----- Archive ----- ##
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'archive-index')
+        self.index = self.read_index()
+
+    def path(self, number):
+        return os.path.join(self.directory, f'arc-{number:06d}.bin')
+
+    def read_index(self):
+        index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            for offset in range(0, len(data) - len(data) % INDEX_RECORD.size, INDEX_RECORD.size):
+                index.append(INDEX_RECORD.unpack_from(data, offset))
+        return index
+
+    # Numbers of the segments that are in the archive
+    def segments(self):
+        return {entry[0] for entry in self.index}
+
+    # Bytes taken by the archived blocks
+    def size(self):
+        return sum(entry[2] for entry in self.index)
+
+    # Seal the records of segment number into the archive. The file is complete and on disk before its
+    # blocks are added to the index
+    def add(self, number, records):
+        by_sensor = {}
+        for record in records:
+            by_sensor.setdefault(record[1], []).append(record)
+        data = bytearray()
+        entries = []
+        for sensor_id, readings in sorted(by_sensor.items()):
+            readings.sort(key=operator.itemgetter(0))
+            for start in range(0, len(readings), BLOCK_READINGS):
+                chunk = readings[start:start + BLOCK_READINGS]
+                block = encode_block(chunk)
+                temperatures = [record[2] for record in chunk if not math.isnan(record[2])]
+                entries.append((number, len(data), len(block), sensor_id, len(chunk), chunk[0][0], chunk[-1][0],
+                                min(temperatures, default=math.nan), max(temperatures, default=math.nan)))
+                data += block
+        path = self.path(number)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        with open(self.index_path, 'ab') as f:
+            f.write(b''.join(INDEX_RECORD.pack(*entry) for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self.index = self.index + entries
+
+    # Yield (timestamp, sensor_id, value, flags) for readings with start <= timestamp < end, in time order.
+    # With low or high, only readings from low to high degrees are returned and blocks with none are skipped
+    def query(self, start, end, sensor_id=None, low=None, high=None):
+        for number, blocks in itertools.groupby(self.index, key=operator.itemgetter(0)):
+            blocks = [entry for entry in blocks if entry[6] >= start and entry[5] < end and (sensor_id is None or entry[3] == sensor_id)
+                      and (low is None or entry[8] >= low) and (high is None or entry[7] <= high)]
+            if not blocks:
+                continue
+            try:
+                f = open(self.path(number), 'rb')
+            except FileNotFoundError:
+                # removed by expire() since the index was read
+                continue
+            with f:
+                readings = []
+                for entry in blocks:
+                    f.seek(entry[1])
+                    readings.append(self.read_block(f.read(entry[2]), entry, start, end, low, high))
+            if len(readings) == 1:
+                yield from readings[0]
+            else:
+                # The blocks of each probe are in time order, which sorting merges in one pass
+                yield from sorted(itertools.chain.from_iterable(readings), key=operator.itemgetter(0))
+
+    # Readings of one block for a query. A block that lies wholly inside the query is passed on without
+    # looking at each reading
+    @staticmethod
+    def read_block(block, entry, start, end, low, high):
+        times, values, flags = decode_block(block)
+        sensor_id = entry[3]
+        readings = zip(times, itertools.repeat(sensor_id), values, flags)
+        if entry[5] >= start and entry[6] < end and low is None and high is None:
+            return readings
+        return [reading for reading in readings if start <= reading[0] < end and (low is None or reading[2] >= low)
+                and (high is None or reading[2] <= high)]
+
+    # Delete archived segments whose readings are all older than before. Returns the number deleted
+    def expire(self, before):
+        last = {}
+        for entry in self.index:
+            last[entry[0]] = max(last.get(entry[0], entry[6]), entry[6])
+        expired = {number for number, timestamp in last.items() if timestamp < before}
+        if not expired:
+            return 0
+        kept = [entry for entry in self.index if entry[0] not in expired]
+        with open(self.index_path + '.tmp', 'wb') as f:
+            f.write(b''.join(INDEX_RECORD.pack(*entry) for entry in kept))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.index = kept
+        for number in expired:
+            try:
+                os.remove(self.path(number))
+            except FileNotFoundError:
+                pass
+        return len(expired)
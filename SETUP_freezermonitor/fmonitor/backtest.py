@@ -0,0 +1,419 @@
+# Replaying recorded readings through the alarms with many settings at once
+#
+#   python3 -m fmonitor.backtest --days 365 --warning-temp=-70:-55:1 --hold-time 0,60,300,600 --median-samples 1,3,5
+#
+# Readings come from the local reading store (data/readings, archive included) or, with --csv, from a file
+# with the time in the first column (seconds since the epoch or ISO 8601) and the temperature in the last,
+# or in columns headed time and temperature. Every combination of the values given for the thresholds,
+# ALARM_HYSTERESIS, ALARM_HOLD_TIME, MEDIAN_SAMPLES and EMA_TIME_CONSTANT is replayed through the same
+# filters and alarm states as the monitor (filters.ReadingFilter, filters.Debounce and AlarmState.update);
+# anything not swept is taken from config.ini. A value can be given as a list (-60,-58), a range with a
+# step (-70:-55:1, both ends included) or both. Values starting with a minus sign are given after an =.
+#
+# For each combination the backtest counts the notifications that would have been sent and compares the
+# alarms with real excursions: runs of readings at or above --excursion-temp (the probe's ALERT_TEMP by
+# default) lasting at least --excursion-time seconds. An excursion is caught if an alarm was raised before it
+# ended. The lead time is from the alarm being raised to the start of the excursion, negative if the alarm
+# only came once the excursion had started. An alarm that overlaps no excursion is a false alarm.
+#
+# The store holds the readings as they were reported, one every SECONDS_BETWEEN_READINGS, after the
+# monitor's own filters. A MEDIAN_SAMPLES of 1 and EMA_TIME_CONSTANT of 0 replay them as they are.
+#
+# NumPy is needed (pip3 install numpy). Rather than stepping through the readings one at a time, each
+# combination is evaluated over whole arrays. Each level of an alarm behaves as a switch of its own: it is
+# turned on by a held reading at or above its threshold and off by a reading below RESET_TEMP or, above
+# WARNING, ALARM_HYSTERESIS below its threshold, so its state at every reading is that of the last reading
+# that turned it on or off, found with a running maximum. The alarm's level is the number of switches that
+# are on. Readings below every RESET_TEMP of the sweep turn everything off, so each run of them is cut down to
+# its first reading before sweeping. Of the rest, the switches can only change at a reading that crosses one of
+# the thresholds being swept, or where the hold time is first met, so only those readings are replayed for
+# each combination. A freezer that is cold most of the time leaves a few thousand readings out of a year's,
+# and thousands of combinations take seconds.
+
+import argparse
+import csv
+import itertools
+import math
+import os
+import sys
+import time
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .alarms import LEVELS, MAX_TEMPERATURE
+from .settings import load_settings
+from .storage import FLAG_READ_ERROR, ReadingStore
+
+# Settings that can be swept, with their attribute for a probe or in Settings
+THRESHOLDS = ('warning_temp', 'alert_temp', 'panic_temp', 'reset_temp')
+FILTERS = ('MEDIAN_SAMPLES', 'EMA_TIME_CONSTANT')
+ALARMS = ('ALARM_HOLD_TIME', 'ALARM_HYSTERESIS')
+
+# Longest stretch of the moving average worked out in one go, in time constants. 1 / decay over a stretch
+# must stay within floating point range
+STRETCH = 500
+
+## ----- Reading the readings ----- ##
+
+# Values for a swept setting: a comma-separated list of values and start:stop:step ranges
+def parse_values(text, kind=float):
+    values = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if ':' in part:
+            try:
+                start, stop, step = (float(value) for value in part.split(':'))
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"'{part}' is not a range start:stop:step")
+            if step <= 0:
+                raise argparse.ArgumentTypeError(f"the step of '{part}' must be above 0")
+            values.update(kind(round(start + i * step, 6)) for i in range(math.floor((stop - start) / step + 1e-9) + 1))
+        else:
+            try:
+                values.add(kind(part))
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"'{part}' is not a number")
+    if not values:
+        raise argparse.ArgumentTypeError("no values given")
+    return sorted(values)
+
+def parse_counts(text):
+    return parse_values(text, int)
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text.strip()).timestamp()
+
+# Good readings of one probe from the reading store, as arrays of times and temperatures in time order
+def load_store(directory, sensor_id, start, end):
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"No reading store in {directory}")
+    readings = [(record[0], record[2]) for record in ReadingStore(directory, writable=False).query(start, end, sensor_id)
+                if not record[3] & FLAG_READ_ERROR]
+    return as_arrays(readings)
+
+# Readings from a CSV file. Rows that do not parse, such as a header, are skipped. With a sensor_id
+# column, only the readings of sensor_id are used
+def load_csv(path, sensor_id):
+    readings = []
+    time_column, value_column, sensor_column = 0, -1, None
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            names = [name.strip().lower() for name in row]
+            if 'temperature' in names:
+                value_column = names.index('temperature')
+                time_column = names.index('timestamp') if 'timestamp' in names else names.index('time') if 'time' in names else 0
+                sensor_column = names.index('sensor_id') if 'sensor_id' in names else None
+                continue
+            try:
+                if sensor_column is not None and sensor_id is not None and int(row[sensor_column]) != sensor_id:
+                    continue
+                readings.append((parse_time(row[time_column]), float(row[value_column])))
+            except (ValueError, IndexError):
+                continue
+    return as_arrays(readings)
+
+def as_arrays(readings):
+    data = np.array(readings, dtype=float).reshape(-1, 2)
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    times, values = data[:, 0], data[:, 1]
+    # Failed readings and readings from a broken probe never reach the alarms
+    good = np.isfinite(values) & (values < MAX_TEMPERATURE)
+    return np.ascontiguousarray(times[good]), np.ascontiguousarray(values[good])
+
+## ----- Filters ----- ##
+
+# Readings after the monitor's filters, rounded to 0.01 degrees as the monitor does
+def filtered(times, values, median_samples, time_constant):
+    if median_samples > 1:
+        values = rolling_median(values, median_samples)
+    if time_constant > 0:
+        values = moving_average(times, values, time_constant)
+    result = np.round(values, 2)
+    # np.round and the monitor's formatting can differ when a reading is halfway between two hundredths,
+    # e.g. the median of an even number of readings, so those are formatted the same way
+    scaled = values * 100
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    result[ties] = [float('{0:0.2f}'.format(value)) for value in values[ties].tolist()]
+    return result
+
+# Median of each reading and the window - 1 before it, like filters.RollingMedian
+def rolling_median(values, window):
+    result = np.empty_like(values)
+    for i in range(min(window - 1, len(values))):
+        result[i] = np.median(values[:i + 1])
+    if len(values) >= window:
+        result[window - 1:] = np.median(np.lib.stride_tricks.sliding_window_view(values, window), axis=1)
+    return result
+
+# Exponential moving average with the time constant in seconds, like filters.ExponentialAverage. After
+# the first reading of a stretch, the average at reading i is d[i] * (y + sum of a[k] * x[k] / d[k] up to i),
+# with y the average at the first reading, d the decay since then and a the weight of each reading, so a
+# stretch is one cumulative sum
+def moving_average(times, values, time_constant):
+    result = np.empty_like(values)
+    if not len(values):
+        return result
+    weights = -np.expm1(-np.diff(times, prepend=times[0]) / time_constant)
+    edges = np.arange(times[0], times[-1], STRETCH * time_constant)
+    starts = np.unique(np.searchsorted(times, edges))
+    average = values[0]
+    for start, stop in zip(starts, itertools.chain(starts[1:], [len(values)])):
+        if start:
+            average += weights[start] * (values[start] - average)
+        result[start] = average
+        if stop - start > 1:
+            decay = np.exp(-(times[start + 1:stop] - times[start]) / time_constant)
+            result[start + 1:stop] = decay * (average + np.cumsum(weights[start + 1:stop] * values[start + 1:stop] / decay))
+            average = result[stop - 1]
+    return result
+
+# Cut each run of readings below floor down to its first reading
+def compress(times, values, floor):
+    cold = values < floor
+    keep = ~(cold & np.concatenate(([False], cold[:-1])))
+    return times[keep], values[keep]
+
+## ----- Alarms ----- ##
+
+# True where readings have been at or above threshold for hold seconds without a break, like filters.Debounce
+def held(times, values, threshold, hold):
+    above = values >= threshold
+    if hold <= 0:
+        return above
+    starts = above & ~np.concatenate(([False], above[:-1]))
+    since = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+    return above & (times - times[since] >= hold)
+
+# State at every reading of a switch turned on where on is True and off where off is True
+def latch(on, off):
+    last = np.maximum.accumulate(np.where(on | off, np.arange(len(on)), -1))
+    return (last >= 0) & on[last]
+
+# Alarm level (0 to 3, see alarms.LEVELS) at every reading, for readings above WARNING_TEMP long enough
+# to count (held) and the alarm thresholds
+def alarm_levels(values, above, alert_temp, panic_temp, reset_temp, hysteresis):
+    cleared = values < reset_temp
+    level = latch(above, cleared).astype(np.int8)
+    for threshold in (alert_temp, panic_temp):
+        level += latch(above & (values >= threshold), cleared | (values < threshold - hysteresis))
+    return level
+
+# Number of repeated notifications, like AlarmState.update: until an alarm is raised again or recovers, the
+# first reading at least interval seconds after the last notification repeats it, unless the alarm drops a
+# level at that reading. times are those of every reading and positions those of the readings replayed,
+# which include every change of level
+def renotifications(times, positions, level, previous, raised, recovered, interval):
+    raised_at = positions[raised]
+    ends = np.concatenate((raised_at, positions[recovered], [len(times)]))
+    ends.sort()
+    ends = ends[np.searchsorted(ends, raised_at, side='right')]
+    # Most alarms change before the first repeat is due, which is checked for all of them at once
+    position = np.searchsorted(times, times[raised_at] + interval)
+    dropped = positions[(level > 0) & (level < previous)]
+    count = 0
+    # The rest are followed one repeat at a time, all together
+    while True:
+        due = position < ends
+        if not due.any():
+            return count
+        position, ends = position[due], ends[due]
+        skipped = np.isin(position, dropped)
+        count += len(position) - int(np.count_nonzero(skipped))
+        position = np.where(skipped, position + 1, np.searchsorted(times, times[position] + interval))
+
+# Runs of readings at or above temperature that last at least duration seconds, as arrays of start and end times
+def excursions(times, values, temperature, duration):
+    hot = np.concatenate(([0], (values >= temperature).astype(np.int8), [0]))
+    edges = np.diff(hot)
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1) - 1
+    long = times[stops] - times[starts] >= duration
+    return times[starts[long]], times[stops[long]]
+
+# Positions of the readings at which any of the cuts is crossed or above changes. Every switch stays as it is
+# from one of these readings to the next, so only they need replaying
+def crossings(values, above, cuts):
+    code = np.searchsorted(cuts, values, side='right') * 2 + above
+    return np.flatnonzero(np.concatenate(([True], code[1:] != code[:-1])))
+
+# Replay one combination of alarm settings over the filtered readings at positions, with values and above
+# for those readings. Returns the notifications by kind and how the alarms line up with the excursions
+def replay(times, positions, values, above, alert_temp, panic_temp, reset_temp, hysteresis, settings, excursion_starts, excursion_ends):
+    level = alarm_levels(values, above, alert_temp, panic_temp, reset_temp, hysteresis)
+    previous = np.concatenate(([0], level[:-1]))
+    raised = np.flatnonzero(level > previous)
+    recovered = np.flatnonzero((previous > 0) & (level == 0))
+    counts = np.bincount(level[raised], minlength=4)
+    result = {LEVELS[i].lower(): int(counts[i]) for i in (1, 2, 3)}
+    result['renotified'] = 0
+    if settings.ALARM_RENOTIFY_INTERVAL > 0 and len(raised):
+        result['renotified'] = renotifications(times, positions, level, previous, raised, recovered, settings.ALARM_RENOTIFY_INTERVAL)
+    times = times[positions]
+    result['recovered'] = len(recovered) if settings.ALARM_RECOVERY_NOTIFICATION else 0
+    result['notifications'] = len(raised) + result['renotified'] + result['recovered']
+
+    # Each alarm runs from the reading that raised it from NORMAL to the reading that recovered it
+    alarm_starts = times[raised[previous[raised] == 0]]
+    alarm_ends = np.full(len(alarm_starts), math.inf)
+    alarm_ends[:len(recovered)] = times[recovered]
+    result['alarms'] = len(alarm_starts)
+
+    overlap = np.searchsorted(excursion_ends, alarm_starts)
+    hits = overlap < len(excursion_starts)
+    hits[hits] = excursion_starts[overlap[hits]] < alarm_ends[hits]
+    result['false_alarms'] = int(np.count_nonzero(~hits))
+
+    # The alarm in force when each excursion started, or else the first one raised during it
+    leads = np.full(len(excursion_starts), math.nan)
+    if len(alarm_starts):
+        before = np.searchsorted(alarm_starts, excursion_starts, side='right') - 1
+        covering = (before >= 0) & (alarm_ends[before] > excursion_starts)
+        after = np.minimum(before + 1, len(alarm_starts) - 1)
+        during = ~covering & (before + 1 < len(alarm_starts)) & (alarm_starts[after] <= excursion_ends)
+        leads[covering] = excursion_starts[covering] - alarm_starts[before[covering]]
+        leads[during] = excursion_starts[during] - alarm_starts[after[during]]
+    caught = leads[~np.isnan(leads)]
+    result['caught'] = len(caught)
+    result['missed'] = len(leads) - len(caught)
+    result['median_lead'] = float(np.median(caught)) if len(caught) else math.nan
+    result['min_lead'] = float(caught.min()) if len(caught) else math.nan
+    return result
+
+## ----- Sweeping ----- ##
+
+# Replay every combination of settings in grid (a dict of setting name to values) over one probe's readings.
+# Combinations whose thresholds are out of order are left out
+def sweep(times, values, grid, settings, excursion_starts, excursion_ends):
+    results = []
+    floor = min(grid['reset_temp'])
+    for median_samples, time_constant in itertools.product(grid['MEDIAN_SAMPLES'], grid['EMA_TIME_CONSTANT']):
+        sweep_times, sweep_values = compress(times, filtered(times, values, median_samples, time_constant), floor)
+        for warning_temp, hold in itertools.product(grid['warning_temp'], grid['ALARM_HOLD_TIME']):
+            combinations = [(alert_temp, panic_temp, reset_temp, hysteresis) for alert_temp, panic_temp, reset_temp, hysteresis
+                            in itertools.product(grid['alert_temp'], grid['panic_temp'], grid['reset_temp'], grid['ALARM_HYSTERESIS'])
+                            if reset_temp < warning_temp <= alert_temp <= panic_temp]
+            if not combinations:
+                continue
+            above = held(sweep_times, sweep_values, warning_temp, hold)
+            cuts = np.unique([cut for alert_temp, panic_temp, reset_temp, hysteresis in combinations
+                              for cut in (alert_temp, panic_temp, alert_temp - hysteresis, panic_temp - hysteresis, reset_temp)])
+            positions = crossings(sweep_values, above, cuts)
+            for alert_temp, panic_temp, reset_temp, hysteresis in combinations:
+                result = {'warning_temp': warning_temp, 'alert_temp': alert_temp, 'panic_temp': panic_temp, 'reset_temp': reset_temp,
+                          'ALARM_HYSTERESIS': hysteresis, 'ALARM_HOLD_TIME': hold, 'MEDIAN_SAMPLES': median_samples,
+                          'EMA_TIME_CONSTANT': time_constant}
+                result.update(replay(sweep_times, positions, sweep_values[positions], above[positions], alert_temp, panic_temp, reset_temp,
+                                     hysteresis, settings, excursion_starts, excursion_ends))
+                results.append(result)
+    return results
+
+# Best first: fewest missed excursions, then fewest false alarms, then fewest notifications, then longest lead
+def rank(result):
+    lead = result['median_lead']
+    return result['missed'], result['false_alarms'], result['notifications'], -lead if lead == lead else math.inf
+
+def minutes(seconds):
+    return f"{seconds / 60:.1f}" if seconds == seconds else '-'
+
+def print_results(results, top):
+    print(f"{'warning':>8} {'alert':>7} {'panic':>7} {'reset':>7} {'hyst':>5} {'hold':>6} {'median':>6} {'ema':>6}"
+          f" | {'notify':>6} {'alarms':>6} {'false':>5} {'caught':>6} {'missed':>6} {'lead min':>8} {'min lead':>8}")
+    for result in results[:top]:
+        print(f"{result['warning_temp']:8.2f} {result['alert_temp']:7.2f} {result['panic_temp']:7.2f} {result['reset_temp']:7.2f}"
+              f" {result['ALARM_HYSTERESIS']:5.2f} {result['ALARM_HOLD_TIME']:6.0f} {result['MEDIAN_SAMPLES']:6d} {result['EMA_TIME_CONSTANT']:6.0f}"
+              f" | {result['notifications']:6d} {result['alarms']:6d} {result['false_alarms']:5d} {result['caught']:6d} {result['missed']:6d}"
+              f" {minutes(result['median_lead']):>8} {minutes(result['min_lead']):>8}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m fmonitor.backtest',
+                                     description="Replay recorded readings through the alarms for every combination of the settings given and "
+                                                 "report the notifications each would have sent and how far ahead of real excursions.")
+    parser.add_argument('--config', default='config.ini', help="settings file, for the settings that are not swept (default: config.ini in the current directory)")
+    parser.add_argument('--data', default='data/readings', help="reading store to replay (default: data/readings)")
+    parser.add_argument('--csv', help="replay the readings in this CSV file instead of the reading store")
+    parser.add_argument('--days', type=float, default=365, help="days of readings to replay from the reading store (default 365)")
+    parser.add_argument('--sensor-id', type=int, help="probe to replay (default: every probe in the settings file, or the first with --csv)")
+    parser.add_argument('--warning-temp', type=parse_values, help="WARNING_TEMP values (default: the probe's)")
+    parser.add_argument('--alert-temp', type=parse_values, help="ALERT_TEMP values (default: the probe's)")
+    parser.add_argument('--panic-temp', type=parse_values, help="PANIC_TEMP values (default: the probe's)")
+    parser.add_argument('--reset-temp', type=parse_values, help="RESET_TEMP values (default: the probe's)")
+    parser.add_argument('--hysteresis', type=parse_values, help="ALARM_HYSTERESIS values")
+    parser.add_argument('--hold-time', type=parse_values, help="ALARM_HOLD_TIME values")
+    parser.add_argument('--median-samples', type=parse_counts, help="MEDIAN_SAMPLES values")
+    parser.add_argument('--ema-time-constant', type=parse_values, help="EMA_TIME_CONSTANT values")
+    parser.add_argument('--excursion-temp', type=float, help="temperature of a real excursion (default: the probe's ALERT_TEMP)")
+    parser.add_argument('--excursion-time', type=float, default=600, help="seconds a real excursion lasts at least (default 600)")
+    parser.add_argument('--top', type=int, default=20, help="combinations to print for each probe, best first (default 20)")
+    parser.add_argument('--output', help="also write every combination to this CSV file")
+    args = parser.parse_args(argv)
+
+    if np is None:
+        sys.exit("The backtest needs NumPy: pip3 install numpy")
+    settings = load_settings(args.config)
+    probes = [probe for probe in settings.probes if args.sensor_id is None or probe.sensor_id == args.sensor_id]
+    if not probes:
+        sys.exit(f"No probe with SENSOR_ID {args.sensor_id} in {args.config}")
+    if args.csv:
+        probes = probes[:1]
+
+    rows = []
+    for probe in probes:
+        started = time.perf_counter()
+        if args.csv:
+            times, values = load_csv(args.csv, args.sensor_id)
+        else:
+            end = time.time()
+            try:
+                times, values = load_store(args.data, probe.sensor_id, end - args.days * 86400, end)
+            except FileNotFoundError as e:
+                sys.exit(str(e))
+        if not len(times):
+            print(f"{probe.name}: no readings")
+            continue
+        loaded = time.perf_counter()
+
+        grid = {name: [getattr(probe, name)] for name in THRESHOLDS}
+        grid.update({name: [getattr(settings, name)] for name in FILTERS + ALARMS})
+        for name, values_given in (('warning_temp', args.warning_temp), ('alert_temp', args.alert_temp), ('panic_temp', args.panic_temp),
+                                   ('reset_temp', args.reset_temp), ('ALARM_HYSTERESIS', args.hysteresis), ('ALARM_HOLD_TIME', args.hold_time),
+                                   ('MEDIAN_SAMPLES', args.median_samples), ('EMA_TIME_CONSTANT', args.ema_time_constant)):
+            if values_given:
+                grid[name] = values_given
+
+        excursion_temp = probe.alert_temp if args.excursion_temp is None else args.excursion_temp
+        excursion_starts, excursion_ends = excursions(times, values, excursion_temp, args.excursion_time)
+        results = sorted(sweep(times, values, grid, settings, excursion_starts, excursion_ends), key=rank)
+        finished = time.perf_counter()
+
+        print(f"{probe.name}: {len(times)} readings from {datetime.fromtimestamp(times[0]):%Y-%m-%d %H:%M} to "
+              f"{datetime.fromtimestamp(times[-1]):%Y-%m-%d %H:%M} (loaded in {loaded - started:.1f} s), "
+              f"{len(excursion_starts)} excursions at or above {excursion_temp}°C for {args.excursion_time:.0f} seconds")
+        print(f"{len(results)} combinations replayed in {finished - loaded:.1f} s")
+        if results:
+            print_results(results, args.top)
+        else:
+            print("No combination has RESET_TEMP < WARNING_TEMP <= ALERT_TEMP <= PANIC_TEMP")
+        print()
+        rows.extend(dict(result, probe=probe.name) for result in results)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['probe'] + list(THRESHOLDS + ALARMS + FILTERS) +
+                                    ['notifications', 'warning', 'alert', 'panic', 'renotified', 'recovered', 'alarms', 'false_alarms',
+                                     'caught', 'missed', 'median_lead', 'min_lead'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,617 @@
+# End-to-end benchmarks for the monitoring pipeline
+#
+# Runs the monitor against a simulated sensor, a local SMTP server standing in for Gmail and a fake
+# Initial State API, all on this machine, and prints the results as JSON so they can be compared
+# between releases:
+#
+#   python3 -m fmonitor.benchmark --output results.json
+#
+#   alarm_latency      - seconds from the sensor reading that crosses WARNING_TEMP to the email
+#                        arriving at the mail server
+#   tick_cost          - CPU time and memory allocated per reading
+#   upload_throughput  - readings and batches per second sent to the Initial State API
+#   network_faults     - alarm latency and upload behaviour while the mail server and the API fail
+#                        some requests and answer slowly
+#   weekly_report      - seconds to build the weekly update email from a week of rollups
+#   cold_start         - seconds from launching the monitor to its first stored reading, first upload
+#                        and boot message, with UPLOAD_INTERVAL at its default of 60 seconds
+#   fleet              - readings per second stored by the fleet collector while several simulated
+#                        monitors, each in its own process, send to it at once
+#   archive            - size of the compressed archive against the raw readings, time to seal them
+#                        and readings per second decoded by full, one day and above-threshold queries
+#
+# Nothing is read from or written to the real config.ini, logs or data; each run works in a
+# temporary directory that is removed afterwards.
+
+import argparse
+import asyncio
+import configparser
+import email
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .collector import Collector
+from .eventlog import stop_logging
+from .monitor import Monitor
+from .sensors import Sensor, SimulatedSensor, steady_profile
+from .settings import CollectorSettings, Settings
+from .storage import FLAG_READ_ERROR, RECORD, ReadingStore
+
+WARNING_TEMP = -60.0
+RESET_TEMP = -70.0
+
+## ----- Stand-ins for the mail server and Initial State ----- ##
+
+# Fails a fraction of requests and delays every answer, to imitate a poor network
+class FaultInjector:
+    def __init__(self, fail_rate=0.0, delay=0.0, seed=None):
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def apply(self):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            return self.fail_rate > 0 and self.random.random() < self.fail_rate
+
+# A minimal SMTP server. Any login is accepted, and the time each message arrives is recorded along
+# with its subject and the temperature in its body
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost benchmark mail sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    lines.append(data[1:] if data.startswith(b'..') else data)
+                if self.server.faults.apply():
+                    self.server.rejected += 1
+                    self.reply('451 4.3.0 Temporary failure, try again later')
+                else:
+                    self.server.received.append((time.perf_counter(), email.message_from_bytes(b''.join(lines))))
+                    self.reply('250 OK queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, faults):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.faults = faults
+        self.received = []
+        self.rejected = 0
+
+    # Arrival time of each alarm email, by the temperature it reports
+    def alarm_arrivals(self):
+        arrivals = {}
+        for received_at, message in self.received:
+            for part in message.walk():
+                if part.get_content_type() != 'text/html':
+                    continue
+                body = part.get_payload(decode=True).decode(errors='replace')
+                for temperature in re.findall(r'<div style="margin-left: 30px;">\s*<p>(-?\d+\.\d\d)&deg;C<p>', body):
+                    arrivals.setdefault(temperature, received_at)
+        return arrivals
+
+class InitialStateHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.faults.apply():
+            self.server.rejected += 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path.endswith('/events'):
+            with self.server.lock:
+                self.server.batches += 1
+                self.server.events += len(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeInitialState(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, faults):
+        super().__init__(('127.0.0.1', 0), InitialStateHandler)
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.events = 0
+        self.rejected = 0
+
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/api'
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+## ----- Simulated freezer ----- ##
+
+# Alternates between RESET_TEMP - 5 and just above WARNING_TEMP every half period, so every period
+# sends one warning email. Each warm stretch reads a slightly different temperature, which is how
+# its email is found again at the mail server. The time of the first warm reading is recorded.
+class CrossingSensor(Sensor):
+    def __init__(self, period):
+        self.period = period
+        self.started = time.perf_counter()
+        self.crossings = {}
+
+    def read_temperature(self):
+        now = time.perf_counter()
+        phase = int((now - self.started) / (self.period / 2))
+        if phase % 2 == 0:
+            return RESET_TEMP - 5
+        temperature = WARNING_TEMP + 1 + (phase // 2 % 500) * 0.01
+        self.crossings.setdefault(f'{temperature:.2f}', now)
+        return temperature
+
+## ----- Running the monitor ----- ##
+
+def benchmark_config(smtp_port, api_url, interval, coalesce_window):
+    custom_text = {f'CUSTOM_{kind}_MESSAGE_LINE_{i}': '' for kind in ('BOOT', 'WEEKLY', 'WARNING', 'ALERT', 'PANIC') for i in (1, 2, 3)}
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'DeviceSettings': {'HOSTNAME': 'benchmark', 'DEVICE_LOCATION_NAME': 'Benchmark freezer', 'HEALTH_CHECK_INTERVAL': '3600'},
+        'NetworkSettings': {'WirelessInterface': 'wlan0', 'NETWORK_INFO_INTERVAL': '3600'},
+        'EmailSettings': {'admin_email_list': 'admin@localhost', 'email_list': 'lab@localhost', 'gmail_account': 'monitor@localhost',
+                          'gmail_password': 'benchmark', 'SMTP_SERVER': '127.0.0.1', 'SMTP_PORT': str(smtp_port), 'SMTP_SECURITY': 'none',
+                          'SMTP_TIMEOUT': '3'},
+        'EmailCustomText': custom_text,
+        'AlarmThresholds': {'WARNING_TEMP': str(WARNING_TEMP), 'ALERT_TEMP': '-40', 'PANIC_TEMP': '-20', 'RESET_TEMP': str(RESET_TEMP),
+                            'SECONDS_BETWEEN_READINGS': str(interval)},
+        'Notifications': {'NOTIFICATION_RETRY_DELAY': '1', 'NOTIFICATION_MAX_RETRY_DELAY': '4', 'NOTIFICATION_COALESCE_WINDOW': str(coalesce_window),
+                          'NOTIFICATION_TIMEOUT': '10'},
+        'RTDSetup': {'CSBoardLocation': 'D5', 'SensorWires': '4', 'BACKEND': 'simulated'},
+        'InitialState': {'SENSOR_LOCATION_NAME': 'Benchmark', 'BUCKET_NAME': 'Benchmark', 'BUCKET_KEY': 'benchmark', 'ACCESS_KEY': 'benchmark',
+                         'SHARE_LINK': '', 'API_URL': api_url, 'UPLOAD_INTERVAL': '1', 'UPLOAD_TIMEOUT': '5'},
+    })
+    return config
+
+def benchmark_settings(smtp_port, api_url, interval, coalesce_window):
+    return Settings(benchmark_config(smtp_port, api_url, interval, coalesce_window))
+
+def close_monitor(monitor):
+    monitor.acquisition.stop(monitor.settings.SENSOR_TIMEOUT)
+    monitor.upload_executor.shutdown(wait=False)
+    monitor.dispatcher.executor.shutdown(wait=False)
+    monitor.email.smtp.close()
+    stop_logging(monitor.log_handler)
+
+# Run the monitor until duration seconds have passed, then stop it
+async def run_for(monitor, duration):
+    task = asyncio.create_task(monitor.run())
+    await asyncio.sleep(duration)
+    task.cancel()
+    if monitor.dispatcher.task is not None:
+        monitor.dispatcher.task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': ordered[-1],
+    }
+
+## ----- Benchmarks ----- ##
+
+# Time from each threshold crossing to its email arriving at the mail server
+def alarm_latency(args, mail_faults, api_faults):
+    sink = start_server(SMTPSink(mail_faults))
+    api = start_server(FakeInitialState(api_faults))
+    try:
+        settings = benchmark_settings(sink.server_address[1], api.url(), args.interval, args.coalesce_window)
+        sensor = CrossingSensor(args.period)
+        monitor = Monitor(settings, [sensor])
+        asyncio.run(run_for(monitor, args.crossings * args.period + args.settle))
+        close_monitor(monitor)
+        arrivals = sink.alarm_arrivals()
+        latencies = [arrivals[key] - crossed for key, crossed in sensor.crossings.items() if key in arrivals]
+        sample = monitor.acquisition.stats()
+        return {
+            'crossings': len(sensor.crossings),
+            'delivered': len(latencies),
+            'latency_seconds': percentiles(latencies),
+            'notifications': monitor.dispatcher.stats(),
+            'emails_rejected': sink.rejected,
+            'sample_lateness_seconds': {'mean': sample['mean_lateness'], 'max': sample['max_lateness'], 'skipped': sample['skipped']},
+            'uploads': {'events': api.events, 'batches': api.batches, 'rejected': api.rejected,
+                        'backlog_bytes': monitor.upload_queue.backlog_bytes()},
+        }
+    finally:
+        sink.shutdown()
+        api.shutdown()
+
+# CPU time and allocations for one reading: read the sensor, store it, queue it for upload and check thresholds
+def tick_cost(args):
+    api = start_server(FakeInitialState(FaultInjector()))
+    try:
+        settings = benchmark_settings(1, api.url(), args.interval, args.coalesce_window)
+        monitor = Monitor(settings, [SimulatedSensor(steady_profile(RESET_TEMP - 5), noise=0.05, seed=1)])
+
+        # One pass of the acquisition thread, taken here instead, then checked as the event loop would
+        async def tick():
+            monitor.acquisition.read_pass()
+            monitor.process_samples()
+            await asyncio.sleep(0)
+
+        async def measure():
+            monitor.upload_readings = asyncio.Queue()
+            monitor.first_reading = asyncio.Event()
+            queueing = asyncio.create_task(monitor.queue_uploads())
+            for _ in range(min(args.ticks, 100)):
+                await tick()
+
+            cpu_started = time.process_time()
+            wall_started = time.perf_counter()
+            for _ in range(args.ticks):
+                await tick()
+            cpu = time.process_time() - cpu_started
+            wall = time.perf_counter() - wall_started
+
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            peaks = []
+            for _ in range(args.ticks):
+                current = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                await tick()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            # Let the uploader catch up so that readings waiting in the queue are not counted as retained
+            await asyncio.sleep(0.1)
+            differences = tracemalloc.take_snapshot().compare_to(before, 'filename')
+            tracemalloc.stop()
+            queueing.cancel()
+            return {
+                'ticks': args.ticks,
+                'cpu_seconds_per_tick': cpu / args.ticks,
+                'wall_seconds_per_tick': wall / args.ticks,
+                'peak_allocated_bytes_per_tick': sum(peaks) / len(peaks),
+                'retained_bytes_per_tick': sum(stat.size_diff for stat in differences) / args.ticks,
+                'retained_blocks_per_tick': sum(stat.count_diff for stat in differences) / args.ticks,
+            }
+
+        result = asyncio.run(measure())
+        close_monitor(monitor)
+        return result
+    finally:
+        api.shutdown()
+
+# Readings per second sent from the on-disk queue to the API
+def upload_throughput(args, api_faults):
+    api = start_server(FakeInitialState(api_faults))
+    try:
+        settings = benchmark_settings(1, api.url(), args.interval, args.coalesce_window)
+        monitor = Monitor(settings, [SimulatedSensor(steady_profile(RESET_TEMP - 5))])
+        now = time.time()
+        for start in range(0, args.upload_events, 10000):
+            monitor.upload_queue.extend(('Benchmark Temperature', -80.0, now + i) for i in range(start, min(start + 10000, args.upload_events)))
+        runs = 0
+        started = time.perf_counter()
+        while monitor.upload_queue.backlog_bytes() > 0 and runs < args.upload_events:
+            monitor.upload_batches()
+            runs += 1
+        elapsed = time.perf_counter() - started
+        close_monitor(monitor)
+        return {
+            'events': api.events,
+            'batches': api.batches,
+            'rejected': api.rejected,
+            'seconds': elapsed,
+            'events_per_second': api.events / elapsed if elapsed else None,
+            'batches_per_second': api.batches / elapsed if elapsed else None,
+            'batch_size': settings.UPLOAD_BATCH_SIZE,
+        }
+    finally:
+        api.shutdown()
+
+# Seconds to build the weekly update from a week of one-a-minute readings with a daily door opening
+def weekly_report(args):
+    settings = benchmark_settings(1, 'http://127.0.0.1:1/', 60, args.coalesce_window)
+    monitor = Monitor(settings, [SimulatedSensor(steady_profile(RESET_TEMP - 5))])
+    probe = monitor.probes[0]
+    rng = random.Random(args.seed)
+    end = time.time()
+    for minute in range(7 * 24 * 60):
+        temperature = RESET_TEMP - 5 + rng.gauss(0, 0.3)
+        if minute % 1440 < 20:
+            temperature += 20
+        monitor.rollups.add(end - (7 * 24 * 60 - minute) * 60, probe.sensor_id, temperature, probe.level(temperature))
+    monitor.rollups.flush()
+    times = []
+    for _ in range(args.reports):
+        started = time.perf_counter()
+        snapshot = monitor.state.snapshot()
+        subject, body = monitor.messages.build_weekly_update(snapshot, snapshot.upload_failures, snapshot.started)
+        times.append(time.perf_counter() - started)
+    close_monitor(monitor)
+    return {'reports': args.reports, 'body_bytes': len(body.encode()), 'render_seconds': percentiles(times)}
+
+# Environment for running the monitor as its own process with this copy of the package
+def package_environment():
+    package_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_directory, os.environ.get('PYTHONPATH')])))
+
+# Launch python3 -m fmonitor in a fresh directory args.cold_starts times, as after a power cut, and
+# time each startup stage from the moment the process was launched. The monitor's own account of
+# the same times, which leaves out the time to launch Python, is read back from its log
+def cold_start(args):
+    sink = start_server(SMTPSink(FaultInjector()))
+    api = start_server(FakeInitialState(FaultInjector()))
+    stages = {'first_reading': [], 'first_upload': []}
+    reported = {'first_reading': [], 'first_upload': []}
+    boot_messages = []
+    try:
+        for i in range(args.cold_starts):
+            config = benchmark_config(sink.server_address[1], api.url(), args.interval, args.coalesce_window)
+            config['InitialState']['UPLOAD_INTERVAL'] = '60'
+            directory = f'start-{i}'
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'config.ini'), 'w') as f:
+                config.write(f)
+            received = len(sink.received)
+            launched = time.time()
+            launched_perf = time.perf_counter()
+            process = subprocess.Popen([sys.executable, '-m', 'fmonitor', '--config', 'config.ini'], cwd=directory, env=package_environment(),
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            time.sleep(args.cold_start_duration)
+            process.terminate()
+            process.wait()
+            with open(os.path.join(directory, 'logs', 'events.jsonl')) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record.get('stage') in stages:
+                        stages[record['stage']].append(record['at'] - launched)
+                        reported[record['stage']].append(record['seconds_since_start'])
+            boot_messages.extend(received_at - launched_perf for received_at, _ in sink.received[received:])
+    finally:
+        sink.shutdown()
+        api.shutdown()
+    return {
+        'starts': args.cold_starts,
+        'first_reading_seconds': percentiles(stages['first_reading']),
+        'first_upload_seconds': percentiles(stages['first_upload']),
+        'boot_message_seconds': percentiles(boot_messages),
+        'reported_first_reading_seconds': percentiles(reported['first_reading']),
+        'reported_first_upload_seconds': percentiles(reported['first_upload']),
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Readings per second stored by the collector while args.nodes monitors send to it. Each monitor runs
+# as its own process in its own directory with a simulated probe, as it would on its own Pi
+def fleet(args):
+    sink = start_server(SMTPSink(FaultInjector()))
+    port = free_port()
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'Collector': {'LISTEN_ADDRESS': '127.0.0.1', 'LISTEN_PORT': str(port), 'COLLECTOR_TOKEN': 'benchmark', 'INGEST_FLUSH_INTERVAL': '0.2'},
+        'EmailSettings': {'gmail_account': 'collector@localhost', 'gmail_password': 'benchmark', 'SMTP_SERVER': '127.0.0.1',
+                          'SMTP_PORT': str(sink.server_address[1]), 'SMTP_SECURITY': 'none', 'RECIPIENTS': 'admin@localhost,lab@localhost'},
+        'Notifications': {'NOTIFICATION_COALESCE_WINDOW': str(args.coalesce_window)},
+    })
+    collector = Collector(CollectorSettings(config))
+
+    async def serve():
+        task = asyncio.create_task(collector.run())
+        await asyncio.sleep(args.fleet_duration + args.settle)
+        task.cancel()
+        collector.dispatcher.task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    serving = threading.Thread(target=asyncio.run, args=(serve(),))
+    serving.start()
+    nodes = []
+    try:
+        for i in range(args.nodes):
+            node_config = benchmark_config(1, 'http://127.0.0.1:1/', args.interval, args.coalesce_window)
+            node_config['Collector'] = {'COLLECTOR_URL': f'http://127.0.0.1:{port}', 'COLLECTOR_TOKEN': 'benchmark', 'NODE_NAME': f'node-{i}'}
+            directory = f'node-{i}'
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'config.ini'), 'w') as f:
+                node_config.write(f)
+            nodes.append(subprocess.Popen([sys.executable, '-m', 'fmonitor', '--config', 'config.ini'], cwd=directory, env=package_environment(),
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        time.sleep(args.fleet_duration)
+    finally:
+        for node in nodes:
+            node.terminate()
+        for node in nodes:
+            node.wait()
+        serving.join()
+        sink.shutdown()
+    stored = collector.database.nodes()
+    lags = [lag for lag, in collector.database.connection.execute('SELECT received - epoch FROM readings')]
+    ingest = collector.scheduler.stats()['ingest']
+    collector.database.close()
+    collector.database_executor.shutdown(wait=False)
+    collector.upload_executor.shutdown(wait=False)
+    collector.dispatcher.executor.shutdown(wait=False)
+    collector.email.smtp.close()
+    stop_logging(collector.log_handler)
+    total = sum(node['readings'] for node in stored)
+    return {
+        'nodes': args.nodes,
+        'nodes_heard_from': len(stored),
+        'readings_stored': total,
+        'readings_per_second': total / args.fleet_duration,
+        'readings_per_node': {'min': min((node['readings'] for node in stored), default=0),
+                              'max': max((node['readings'] for node in stored), default=0)},
+        'storage_lag_seconds': percentiles(lags),
+        'database_writes': ingest['runs'],
+        'notifications': collector.dispatcher.stats(),
+        'emails_received': len(sink.received),
+    }
+
+# Readings from two probes every 10 seconds, with the first one's door left open for five minutes every
+# 12 hours (above WARNING_TEMP) and the odd failed read, sealed into the archive and read back
+def archive(args):
+    rng = random.Random(args.seed)
+    store = ReadingStore('readings')
+    start = 1.7e9
+    timestamp = start
+    for i in range(args.archive_readings // 2):
+        timestamp += 10 + rng.gauss(0, 0.005)
+        for sensor_id, base in ((0, -80.0), (1, -20.0)):
+            if rng.random() < 0.001:
+                store.append(timestamp, sensor_id, math.nan, FLAG_READ_ERROR)
+                continue
+            door = 25.0 if sensor_id == 0 and i % 4320 < 30 else 0.0
+            store.append(timestamp, sensor_id, round(base + door + rng.gauss(0, 0.05), 2))
+    # Only segments in the index are sealed, so close the one being written as well, however few
+    # readings it holds
+    store.rotate()
+    sealed_records = sum(entry[3] for entry in store.index)
+    started = time.perf_counter()
+    segments = store.seal(math.inf)
+    seal_seconds = time.perf_counter() - started
+    archive_bytes = store.archive.size()
+
+    def timed(*query):
+        started = time.perf_counter()
+        count = sum(1 for _ in store.query(*query))
+        seconds = time.perf_counter() - started
+        return {'readings': count, 'seconds': seconds, 'readings_per_second': count / seconds if seconds else None}
+
+    return {
+        'readings': sealed_records,
+        'segments': segments,
+        'raw_bytes': sealed_records * RECORD.size,
+        'archive_bytes': archive_bytes,
+        'bytes_per_reading': archive_bytes / sealed_records if sealed_records else None,
+        'compression_ratio': sealed_records * RECORD.size / archive_bytes if archive_bytes else None,
+        'seal_seconds': seal_seconds,
+        'full_query': timed(0, math.inf),
+        'one_day_query': timed(start + 86400, start + 2 * 86400, 1),
+        'above_warning_query': timed(0, math.inf, 0, WARNING_TEMP),
+    }
+
+# Run one benchmark in a fresh temporary directory, as the monitor keeps its logs and data in the current one
+def in_temporary_directory(func, *args):
+    previous = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='fmonitor-benchmark-')
+    os.chdir(directory)
+    try:
+        return func(*args)
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m fmonitor.benchmark', description="Benchmark the monitoring pipeline against local stand-ins for the mail server and Initial State.")
+    parser.add_argument('--output', help="write the JSON results to this file instead of printing them")
+    parser.add_argument('--crossings', type=int, default=10, help="threshold crossings per alarm latency run (default 10)")
+    parser.add_argument('--period', type=float, default=2.0, help="seconds between threshold crossings (default 2)")
+    parser.add_argument('--settle', type=float, default=5.0, help="seconds to wait for the last emails after the crossings (default 5)")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between readings during the latency runs (default 0.05)")
+    parser.add_argument('--coalesce-window', type=float, default=0.5, help="NOTIFICATION_COALESCE_WINDOW for the runs (default 0.5)")
+    parser.add_argument('--ticks', type=int, default=2000, help="readings to time for the tick cost (default 2000)")
+    parser.add_argument('--upload-events', type=int, default=50000, help="readings to upload for the throughput test (default 50000)")
+    parser.add_argument('--fail-rate', type=float, default=0.3, help="fraction of requests failed during the network fault run (default 0.3)")
+    parser.add_argument('--network-delay', type=float, default=0.2, help="seconds added to every request during the network fault run (default 0.2)")
+    parser.add_argument('--reports', type=int, default=20, help="weekly reports to build for the report timing (default 20)")
+    parser.add_argument('--cold-starts', type=int, default=5, help="launches of the monitor to time in the cold start run (default 5)")
+    parser.add_argument('--cold-start-duration', type=float, default=5.0, help="seconds each launch runs for in the cold start run (default 5)")
+    parser.add_argument('--nodes', type=int, default=5, help="simulated monitors sending to the collector in the fleet run (default 5)")
+    parser.add_argument('--fleet-duration', type=float, default=10.0, help="seconds the simulated monitors run for in the fleet run (default 10)")
+    parser.add_argument('--archive-readings', type=int, default=500000, help="readings to seal into the archive in the archive run (default 500000)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the injected faults (default 1)")
+    args = parser.parse_args(argv)
+
+    results = {
+        'version': 1,
+        'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'system': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+    }
+    results['alarm_latency'] = in_temporary_directory(alarm_latency, args, FaultInjector(), FaultInjector())
+    results['tick_cost'] = in_temporary_directory(tick_cost, args)
+    results['upload_throughput'] = in_temporary_directory(upload_throughput, args, FaultInjector())
+    results['network_faults'] = in_temporary_directory(alarm_latency, args, FaultInjector(args.fail_rate, args.network_delay, args.seed),
+                                                       FaultInjector(args.fail_rate, args.network_delay, args.seed + 1))
+    results['network_faults']['upload_throughput'] = in_temporary_directory(
+        upload_throughput, args, FaultInjector(args.fail_rate, args.network_delay, args.seed + 2))
+    results['weekly_report'] = in_temporary_directory(weekly_report, args)
+    results['cold_start'] = in_temporary_directory(cold_start, args)
+    results['fleet'] = in_temporary_directory(fleet, args)
+    results['archive'] = in_temporary_directory(archive, args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+# Fleet collector
+#
+#   python3 -m fmonitor.collector [--config collector.ini]
+#
+# A small server that any number of monitors send their readings and notifications to (COLLECTOR_URL
+# in their config.ini, see fleet.py), so that only one machine needs the Initial State and mail
+# credentials, and the readings of every freezer can be looked up in one place:
+#
+#   POST /readings       {"node": ..., "events": [{"key": ..., "value": ..., "epoch": ...}, ...]}
+#   POST /notifications  {"node": ..., "recipients": [...], "subject": ..., "body": ...}, only to RECIPIENTS
+#   GET  /nodes          every node, when it was last heard from and how many readings it has sent
+#   GET  /readings       stored readings, oldest first (?node=&key=&start=&end=&limit=)
+#   GET  /metrics        timings and counters in the OpenMetrics format
+#
+# Readings from every request that arrives within INGEST_FLUSH_INTERVAL seconds are written to one
+# SQLite database in a single transaction, and a request is only answered once its readings are
+# committed, so a node never lets go of readings that are not stored yet. When more than
+# INGEST_QUEUE_EVENTS readings are waiting to be written, new readings are refused with 503 and a
+# Retry-After of RETRY_AFTER seconds, and the nodes keep them in their own upload queues until then.
+#
+# Stored readings are forwarded to Initial State through the collector's own on-disk upload queue,
+# with each stream key prefixed by the node name, when ACCESS_KEY is set. Notifications go out through
+# one SMTP session, and those for the same recipients arriving together from several nodes (e.g. after
+# a power cut) are combined into one email. Accepted notifications are only kept in memory.
+
+import argparse
+import asyncio
+import functools
+import hmac
+import itertools
+import json
+import math
+import os
+import signal
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from .eventlog import configure_logging, get_logger
+from .metrics import CONTENT_TYPE, Counter, GaugeFunction, Histogram, Timer, dependency_failures, render
+from .notifications import EmailSender, NotificationDispatcher
+from .scheduler import Scheduler
+from .settings import load_collector_settings
+from .upload import InitialStateUploader, UploadQueue
+
+collector_log = get_logger('collector')
+upload_log = get_logger('upload')
+
+ingested_readings = Counter('fmonitor_collector_readings', "Readings stored by the collector", ['node'])
+refused_requests = Counter('fmonitor_collector_refused_requests', "Requests the collector turned away", ['reason'])
+write_seconds = Histogram('fmonitor_collector_write_seconds', "Time to write one batch of readings to the database")
+
+# Seconds a connection may sit idle between requests
+REQUEST_TIMEOUT = 60
+
+# Notifications are ordered by urgency when combined, going by the start of their subject
+PRIORITIES = {'PANIC': 3, 'ALERT': 2, 'WARNING': 1, 'PREDICTED': 1, 'RECOVERED': 1}
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+## ----- Storage ----- ##
+
+class ReadingDatabase:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Only ever used from the collector's database thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS readings (node TEXT NOT NULL, key TEXT NOT NULL, epoch REAL NOT NULL, '
+                                    'value REAL NOT NULL, received REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS readings_by_node ON readings (node, key, epoch)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, address TEXT, first_seen REAL NOT NULL, '
+                                    'last_seen REAL NOT NULL, readings INTEGER NOT NULL)')
+
+    # Store the readings of several requests in one transaction. batches holds (node, address, rows)
+    # with rows of (key, value, epoch)
+    def insert(self, batches, received):
+        with self.connection:
+            self.connection.executemany('INSERT INTO readings VALUES (?, ?, ?, ?, ?)',
+                                        ((node, key, epoch, value, received) for node, address, rows in batches
+                                         for key, value, epoch in rows))
+            self.connection.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?) ON CONFLICT(node) DO UPDATE SET '
+                                        'address = excluded.address, last_seen = excluded.last_seen, readings = readings + excluded.readings',
+                                        ((node, address, received, received, len(rows)) for node, address, rows in batches))
+
+    def query(self, node=None, key=None, start=None, end=None, limit=10000):
+        clauses = []
+        params = []
+        for clause, value in (('node = ?', node), ('key = ?', key), ('epoch >= ?', start), ('epoch < ?', end)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ''
+        rows = self.connection.execute(f'SELECT node, key, epoch, value FROM readings {where}ORDER BY epoch LIMIT ?', params + [limit])
+        return [{'node': node, 'key': key, 'epoch': epoch, 'value': value} for node, key, epoch, value in rows]
+
+    def nodes(self):
+        rows = self.connection.execute('SELECT node, address, first_seen, last_seen, readings FROM nodes ORDER BY node')
+        return [{'node': node, 'address': address, 'first_seen': first_seen, 'last_seen': last_seen, 'readings': readings}
+                for node, address, first_seen, last_seen, readings in rows]
+
+    def close(self):
+        self.connection.close()
+
+## ----- HTTP ----- ##
+
+# Read one request. Returns (method, path, query, headers, body), or None once the client has closed
+# the connection
+async def read_request(reader, max_bytes):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "bad Content-Length")
+    if length > max_bytes:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"requests are limited to {max_bytes} bytes")
+    body = await reader.readexactly(length) if length else b''
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query), headers, body
+
+def write_response(writer, status, body, content_type='application/json', headers=None, keep_alive=True):
+    status = HTTPStatus(status)
+    lines = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type}', f'Content-Length: {len(body)}',
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+def parse_json(body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "the body is not valid JSON")
+
+def query_float(query, name):
+    if name not in query:
+        return None
+    try:
+        return float(query[name][0])
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a number")
+
+# Message builder for a notification that arrives already built
+def forwarded_message(snapshot, subject, body):
+    return subject, body
+
+## ----- Collector ----- ##
+
+class Collector:
+    def __init__(self, settings):
+        self.settings = settings
+        os.makedirs('logs', exist_ok=True)
+        os.makedirs('data', exist_ok=True)
+        self.log_handler = configure_logging(settings, 'logs/collector.jsonl')
+        self.database = ReadingDatabase(settings.DATABASE)
+        # The database is only touched from this thread, and the upload queue only from the upload thread
+        self.database_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+        self.upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload')
+
+        self.email = EmailSender(settings)
+        self.dispatcher = NotificationDispatcher(self.email.send, lambda: None, settings.NOTIFICATION_QUEUE_SIZE,
+                                                 settings.NOTIFICATION_MAX_ATTEMPTS, settings.NOTIFICATION_RETRY_DELAY,
+                                                 settings.NOTIFICATION_MAX_RETRY_DELAY, settings.NOTIFICATION_MAX_AGE,
+                                                 settings.NOTIFICATION_COALESCE_WINDOW, settings.NOTIFICATION_TIMEOUT)
+        self.notification_ids = itertools.count()
+
+        self.upload_queue = None
+        if settings.ACCESS_KEY:
+            self.upload_queue = UploadQueue('data/collector_upload_queue.jsonl')
+            self.uploader = InitialStateUploader(settings.API_URL, settings.BUCKET_NAME, settings.BUCKET_KEY, settings.ACCESS_KEY,
+                                                 settings.UPLOAD_TIMEOUT)
+        self.upload_failing = False
+
+        # Readings waiting for the next write, as (node, address, rows, future) with the future
+        # answered once they are committed
+        self.pending = []
+        self.pending_events = 0
+        self.scheduler = Scheduler()
+        GaugeFunction('fmonitor_collector_pending_readings', "Readings accepted but not yet written to the database", lambda: self.pending_events)
+        GaugeFunction('fmonitor_notification_queue_depth', "Notifications waiting to be sent", self.dispatcher.queue_depth)
+
+    ## ----- Readings ----- ##
+
+    # Wait until a node's readings are stored. Refused if too many readings are already waiting
+    async def ingest(self, node, address, rows):
+        if self.pending_events + len(rows) > self.settings.INGEST_QUEUE_EVENTS:
+            refused_requests.inc(reason='busy')
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "too many readings waiting to be stored",
+                            {'Retry-After': str(self.settings.RETRY_AFTER)})
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((node, address, rows, future))
+        self.pending_events += len(rows)
+        await future
+
+    # Write every waiting reading in one transaction, then answer the requests they came with
+    async def write_pending(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        loop = asyncio.get_running_loop()
+        count = sum(len(rows) for _, _, rows, _ in batch)
+        try:
+            with Timer(write_seconds):
+                await loop.run_in_executor(self.database_executor, self.database.insert,
+                                           [(node, address, rows) for node, address, rows, _ in batch], time.time())
+            if self.upload_queue is not None:
+                await loop.run_in_executor(self.upload_executor, self.upload_queue.extend,
+                                           [(f'{node}: {key}', value, epoch) for node, _, rows, _ in batch for key, value, epoch in rows])
+        except Exception as e:
+            collector_log.error(f"Could not store {count} readings: {e}", extra={'event': 'store_failed'})
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR, "the readings could not be stored"))
+            return
+        finally:
+            self.pending_events -= count
+        for node, _, rows, future in batch:
+            ingested_readings.inc(len(rows), node=node)
+            if not future.done():
+                future.set_result(None)
+
+    async def post_readings(self, body, address):
+        request = parse_json(body)
+        try:
+            node = str(request['node'])
+            rows = [(str(event['key']), float(event['value']), float(event['epoch'])) for event in request['events']]
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "expected a node and a list of events with a key, value and epoch")
+        rows = [row for row in rows if math.isfinite(row[1]) and math.isfinite(row[2])]
+        if rows:
+            await self.ingest(node, address, rows)
+        return HTTPStatus.OK, {'stored': len(rows)}
+
+    ## ----- Notifications ----- ##
+
+    async def post_notification(self, body):
+        request = parse_json(body)
+        try:
+            node = str(request['node'])
+            recipients = [str(recipient) for recipient in request['recipients']]
+            subject = str(request['subject'])
+            message = str(request['body'])
+        except (KeyError, TypeError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "expected a node, recipients, subject and body")
+        allowed = {address.lower() for address in self.settings.RECIPIENTS}
+        refused = [recipient for recipient in recipients if recipient.lower() not in allowed]
+        if refused:
+            refused_requests.inc(reason='recipient')
+            collector_log.warning(f"Refused a notification from {node} to {', '.join(refused)}, which are not in RECIPIENTS",
+                                  extra={'event': 'recipient_refused', 'fields': {'node': node}})
+            raise HTTPError(HTTPStatus.FORBIDDEN, f"not allowed to send to {', '.join(refused)}")
+        priority = PRIORITIES.get(subject.split(':', 1)[0].strip(), 0)
+        self.dispatcher.submit(functools.partial(forwarded_message, subject=subject, body=message), recipients,
+                               key=f'{node}:{next(self.notification_ids)}', priority=priority)
+        collector_log.info(f"Queued a notification from {node}: {subject}", extra={'event': 'notification_queued', 'fields': {'node': node}})
+        return HTTPStatus.ACCEPTED, {'queued': True}
+
+    ## ----- Forwarding to Initial State ----- ##
+
+    async def flush_uploads(self):
+        await asyncio.get_running_loop().run_in_executor(self.upload_executor, self.upload_batches)
+
+    # Send the readings of every node to Initial State, oldest first, combined into large batches
+    def upload_batches(self):
+        for _ in range(self.settings.UPLOAD_MAX_BATCHES):
+            events, end = self.upload_queue.read_batch(self.settings.UPLOAD_BATCH_SIZE)
+            if not events:
+                if end > self.upload_queue.offset:
+                    self.upload_queue.commit(end)
+                break
+            try:
+                self.uploader.send(events)
+            except Exception as e:
+                dependency_failures.inc(dependency='initialstate')
+                if not self.upload_failing:
+                    upload_log.error(f"Failed to forward readings to InitialState, they will be kept and sent later. Error: {e}", extra={'event': 'upload_failed'})
+                self.upload_failing = True
+                return
+            self.upload_queue.commit(end)
+        if self.upload_failing:
+            upload_log.warning(f"Forwarding readings to InitialState resumed, {self.upload_queue.backlog_bytes()} bytes still queued", extra={'event': 'upload_resumed'})
+            self.upload_failing = False
+
+    ## ----- Serving requests ----- ##
+
+    async def route(self, method, path, query, headers, body, address):
+        token = self.settings.COLLECTOR_TOKEN
+        if token and not hmac.compare_digest(headers.get('authorization', ''), f'Bearer {token}'):
+            refused_requests.inc(reason='unauthorized')
+            raise HTTPError(HTTPStatus.UNAUTHORIZED, "missing or wrong token")
+        routes = {
+            ('POST', '/readings'): lambda: self.post_readings(body, address),
+            ('POST', '/notifications'): lambda: self.post_notification(body),
+            ('GET', '/nodes'): lambda: self.get_from_database(self.database.nodes),
+            ('GET', '/readings'): lambda: self.get_from_database(self.database.query, query.get('node', [None])[0],
+                                                                 query.get('key', [None])[0], query_float(query, 'start'),
+                                                                 query_float(query, 'end'), int(query_float(query, 'limit') or 10000)),
+        }
+        if method == 'GET' and path == '/metrics':
+            return HTTPStatus.OK, render().encode('utf-8'), CONTENT_TYPE
+        if (method, path) not in routes:
+            if any(route_path == path for _, route_path in routes):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not supported for {path}")
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"nothing at {path}")
+        status, result = await routes[(method, path)]()
+        return status, json.dumps(result).encode('utf-8'), 'application/json'
+
+    async def get_from_database(self, func, *args):
+        return HTTPStatus.OK, await asyncio.get_running_loop().run_in_executor(self.database_executor, func, *args)
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        address = peer[0] if peer else None
+        try:
+            while True:
+                request = None
+                keep_alive = True
+                try:
+                    request = await asyncio.wait_for(read_request(reader, self.settings.MAX_REQUEST_BYTES), REQUEST_TIMEOUT)
+                    if request is None:
+                        break
+                    method, path, query, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, payload, content_type = await self.route(method, path, query, headers, body, address)
+                    write_response(writer, status, payload, content_type, keep_alive=keep_alive)
+                except HTTPError as e:
+                    # The rest of a request that could not be read is still waiting on the connection
+                    keep_alive = keep_alive and request is not None
+                    write_response(writer, e.status, json.dumps({'error': str(e)}).encode('utf-8'), headers=e.headers, keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            collector_log.error(f"Unexpected error while serving {address}: {e}", extra={'event': 'request_failed'})
+        finally:
+            writer.close()
+
+    async def maintain_log(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.log_handler.maintain)
+
+    async def run(self):
+        settings = self.settings
+        self.dispatcher.start()
+        server = await asyncio.start_server(self.handle_connection, settings.LISTEN_ADDRESS, settings.LISTEN_PORT)
+        collector_log.info(f"Listening on {settings.LISTEN_ADDRESS}:{settings.LISTEN_PORT}", extra={'event': 'listening'})
+        self.scheduler.add('ingest', self.write_pending, interval=settings.INGEST_FLUSH_INTERVAL)
+        if self.upload_queue is not None:
+            self.scheduler.add('upload', self.flush_uploads, interval=settings.UPLOAD_INTERVAL, delay=settings.UPLOAD_INTERVAL)
+        self.scheduler.add('log_flush', self.maintain_log, interval=settings.LOG_FLUSH_INTERVAL, delay=settings.LOG_FLUSH_INTERVAL)
+        async with server:
+            await self.scheduler.run()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m fmonitor.collector', description="Collect readings and notifications from many freezer monitors.")
+    parser.add_argument('--config', default='collector.ini', help="settings file (default: collector.ini in the current directory)")
+    args = parser.parse_args(argv)
+
+    collector = Collector(load_collector_settings(args.config))
+    get_logger('startup').info("collector started")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    asyncio.run(collector.run())
+
+if __name__ == '__main__':
+    main()
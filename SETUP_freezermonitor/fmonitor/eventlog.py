@@ -0,0 +1,220 @@
+# Central log
+#
+# Everything the monitor logs goes through the standard logging module, under the 'fmonitor' logger,
+# to a single JSON-lines file, logs/events.jsonl. Each line holds the time, level, category (sensor,
+# thresholds, email, upload, network, health, ...), message and any extra fields of one record, so
+# the log can be searched with grep or read with any JSON tool.
+#
+# Records are kept in memory and written out together every LOG_FLUSH_INTERVAL seconds, once
+# LOG_BUFFER_RECORDS are waiting, or straight away for warnings and errors. A message that repeats
+# more than LOG_RATE_LIMIT times within LOG_RATE_WINDOW seconds is only counted after that, and one
+# summary record with the count is written when the window ends, so a sensor that fails every reading
+# during a long outage costs a handful of lines and SD card writes instead of one per reading.
+#
+# The file is rotated once it reaches LOG_MAX_FILE_BYTES or is LOG_MAX_FILE_AGE_HOURS old. Rotated
+# files are compressed with gzip and only the newest LOG_BACKUP_COUNT are kept. Rotation and
+# compression only happen in maintain(), which the monitor runs on a worker thread.
+
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+
+LOGGER_NAME = 'fmonitor'
+
+# Logger for one category of records, e.g. get_logger('sensor')
+def get_logger(category):
+    return logging.getLogger(f'{LOGGER_NAME}.{category}')
+
+# Fields that tell the same event for different things apart, e.g. two probes failing at once
+SUBJECT_FIELDS = ('probe', 'job', 'node', 'notification', 'stage')
+
+# One JSON object per record. Extra fields are passed with extra={'fields': {...}}
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'category': record.name[len(LOGGER_NAME) + 1:] if record.name.startswith(LOGGER_NAME + '.') else record.name,
+        }
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry['event'] = event
+        entry['message'] = record.getMessage()
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+# Lets through at most limit records of the same category and event, about the same probe, job or
+# node, in each window of seconds. Records over the limit are counted, and a summary record is made for
+# them when the window ends
+class RateLimiter:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        # key -> [window start, records seen, last record]
+        self.windows = {}
+
+    # Records with the same key count as repeats of each other. Messages usually hold values that
+    # change from one record to the next, so they are only used for records without an event
+    @staticmethod
+    def key(record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            return (record.name, record.msg)
+        fields = getattr(record, 'fields', None) or {}
+        return (record.name, event) + tuple(fields.get(name) for name in SUBJECT_FIELDS)
+
+    def allow(self, record):
+        key = self.key(record)
+        entry = self.windows.get(key)
+        summary = None
+        if entry is not None and record.created - entry[0] >= self.window:
+            summary = self.summary(entry)
+            entry = None
+        if entry is None:
+            entry = self.windows[key] = [record.created, 0, record]
+        entry[1] += 1
+        entry[2] = record
+        return entry[1] <= self.limit, summary
+
+    # Summaries for every window that has ended, and forget those windows
+    def expire(self, now):
+        summaries = []
+        for key, entry in list(self.windows.items()):
+            if now - entry[0] >= self.window:
+                del self.windows[key]
+                summary = self.summary(entry)
+                if summary is not None:
+                    summaries.append(summary)
+        return summaries
+
+    def summary(self, entry):
+        started, seen, record = entry
+        suppressed = seen - self.limit
+        if suppressed <= 0:
+            return None
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f"{record.getMessage()} (repeated {suppressed} more times since {datetime.fromtimestamp(started).strftime('%H:%M:%S')})"
+        summary.args = None
+        summary.created = time.time()
+        summary.fields = dict(getattr(record, 'fields', None) or {}, repeated=suppressed)
+        return summary
+
+class BufferedJSONLinesHandler(logging.Handler):
+    def __init__(self, path, buffer_records=200, flush_level=logging.WARNING, max_bytes=1048576, max_age=86400,
+                 backup_count=30, rate_limit=5, rate_window=600):
+        super().__init__()
+        self.setFormatter(JSONLinesFormatter())
+        # The monitor works in the directory it was started from, which should not change where the log goes
+        self.path = os.path.abspath(path)
+        self.buffer_records = buffer_records
+        self.flush_level = flush_level
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.limiter = RateLimiter(rate_limit, rate_window) if rate_limit > 0 else None
+        self.buffer = []
+        self.started = self.file_started()
+
+    # Time of the first record in the current file, or None if there is no file yet
+    def file_started(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                first = f.readline()
+        except OSError:
+            return None
+        try:
+            return datetime.strptime(json.loads(first)['time'], '%Y-%m-%d %H:%M:%S').timestamp()
+        except (ValueError, KeyError, TypeError):
+            return os.path.getmtime(self.path)
+
+    def emit(self, record):
+        try:
+            if self.limiter is not None:
+                allowed, summary = self.limiter.allow(record)
+                if summary is not None:
+                    self.buffer.append(self.format(summary))
+                if not allowed:
+                    return
+            self.buffer.append(self.format(record))
+            if record.levelno >= self.flush_level or len(self.buffer) >= self.buffer_records:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    # Write out buffered records, including summaries of repeated messages whose window has ended
+    def flush(self):
+        self.acquire()
+        try:
+            if self.limiter is not None:
+                self.buffer.extend(self.format(summary) for summary in self.limiter.expire(time.time()))
+            if not self.buffer:
+                return
+            lines, self.buffer = self.buffer, []
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            if self.started is None:
+                self.started = time.time()
+        finally:
+            self.release()
+
+    # Flush, rotate the file if it is too big or too old, then compress rotated files and delete
+    # the oldest ones. Compressing can take a moment on a Pi Zero, so this is run on a worker thread
+    def maintain(self):
+        self.flush()
+        self.acquire()
+        try:
+            if self.started is not None and (os.path.getsize(self.path) >= self.max_bytes or time.time() - self.started >= self.max_age):
+                stem = os.path.splitext(self.path)[0]
+                os.replace(self.path, f"{stem}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl")
+                self.started = None
+        except FileNotFoundError:
+            self.started = None
+        finally:
+            self.release()
+        self.compress_rotated()
+
+    def rotated_files(self, extension):
+        stem = os.path.splitext(self.path)[0]
+        return sorted(glob.glob(f"{glob.escape(stem)}-*{extension}"))
+
+    def compress_rotated(self):
+        for path in self.rotated_files('.jsonl'):
+            with open(path, 'rb') as source, gzip.open(path + '.gz.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(path + '.gz.tmp', path + '.gz')
+            os.remove(path)
+        compressed = self.rotated_files('.jsonl.gz')
+        for path in compressed[:max(len(compressed) - self.backup_count, 0)]:
+            os.remove(path)
+
+    def close(self):
+        self.flush()
+        super().close()
+
+# Send every 'fmonitor' record to the central log described by the [Logging] settings, replacing any
+# handler set up before. Returns the handler so that the monitor can run its maintain() regularly
+def configure_logging(settings, path='logs/events.jsonl'):
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, BufferedJSONLinesHandler):
+            stop_logging(handler)
+    handler = BufferedJSONLinesHandler(path, settings.LOG_BUFFER_RECORDS, logging.WARNING, settings.LOG_MAX_FILE_BYTES,
+                                       settings.LOG_MAX_FILE_AGE_HOURS * 3600, settings.LOG_BACKUP_COUNT,
+                                       settings.LOG_RATE_LIMIT, settings.LOG_RATE_WINDOW)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return handler
+
+# Write out what is buffered and detach the handler
+def stop_logging(handler):
+    logging.getLogger(LOGGER_NAME).removeHandler(handler)
+    handler.close()
@@ -0,0 +1,197 @@
+# Streaming filters applied to raw sensor readings
+#
+# With oversampling the probes are read every SECONDS_BETWEEN_SAMPLES seconds, more often than readings
+# are reported. Each raw reading goes through a rolling median, which throws out single bad readings and
+# short spikes, and then an exponential moving average, which smooths out noise. Alarms are checked
+# against every filtered reading, and must hold for ALARM_HOLD_TIME seconds before a notification goes
+# out, so a door left open for a moment no longer sends a warning while a real warming still does.
+# Each filter keeps a fixed amount of state and does a small, bounded amount of work per reading.
+
+import heapq
+import math
+from collections import deque
+
+# Median of the last window readings, kept in two heaps: the lower half in a max-heap and the upper
+# half in a min-heap. Readings that drop out of the window are only removed from a heap once they reach
+# its top, so each reading costs O(log window). Should removed readings pile up below the tops, the
+# heaps are rebuilt from the window, which happens at most once every window readings
+class RollingMedian:
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.low = []
+        self.high = []
+        self.low_size = 0
+        self.high_size = 0
+        self.removed = {}
+
+    # Pop readings that have left the window from the top of a heap (sign is -1 for the max-heap)
+    def prune(self, heap, sign):
+        while heap and self.removed.get(sign * heap[0]):
+            self.removed[sign * heap[0]] -= 1
+            heapq.heappop(heap)
+
+    # Keep the lower half the same size as the upper half, or one larger
+    def balance(self):
+        if self.low_size > self.high_size + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.low_size -= 1
+            self.high_size += 1
+            self.prune(self.low, -1)
+        elif self.low_size < self.high_size:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.high_size -= 1
+            self.low_size += 1
+            self.prune(self.high, 1)
+
+    def add(self, value):
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+            self.low_size += 1
+        else:
+            heapq.heappush(self.high, value)
+            self.high_size += 1
+        self.values.append(value)
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            self.removed[old] = self.removed.get(old, 0) + 1
+            if old <= -self.low[0]:
+                self.low_size -= 1
+                self.prune(self.low, -1)
+            else:
+                self.high_size -= 1
+                self.prune(self.high, 1)
+        self.balance()
+        if len(self.low) + len(self.high) > 2 * self.window:
+            self.rebuild()
+        return self.median()
+
+    def rebuild(self):
+        ordered = sorted(self.values)
+        middle = (len(ordered) + 1) // 2
+        self.low = [-value for value in reversed(ordered[:middle])]
+        self.high = ordered[middle:]
+        self.low_size = len(self.low)
+        self.high_size = len(self.high)
+        self.removed = {}
+
+    def median(self):
+        if self.low_size > self.high_size:
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2
+
+# Exponential moving average with a time constant in seconds, so that it smooths the same amount
+# whatever the time between readings
+class ExponentialAverage:
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        self.value = None
+        self.last_update = None
+
+    def add(self, value, now):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += (1 - math.exp(-(now - self.last_update) / self.time_constant)) * (value - self.value)
+        self.last_update = now
+        return self.value
+
+# Rolling median followed by moving average. A median window of 1 or a time constant of 0 turns that
+# stage off, and with both off readings pass through unchanged
+class ReadingFilter:
+    def __init__(self, median_window, time_constant):
+        self.median = RollingMedian(median_window) if median_window > 1 else None
+        self.average = ExponentialAverage(time_constant) if time_constant > 0 else None
+
+    def add(self, value, now):
+        if self.median is not None:
+            value = self.median.add(value)
+        if self.average is not None:
+            value = self.average.add(value, now)
+        return value
+
+# Time debounce for alarms: a reading only counts as above a threshold once readings have been above
+# it for hold seconds without a break. Together with RESET_TEMP this gives hysteresis in both time and
+# temperature, so a reading hovering around a threshold does not send a stream of notifications
+class Debounce:
+    def __init__(self, hold):
+        self.hold = hold
+        self.above_since = None
+
+    def update(self, above, now):
+        if not above:
+            self.above_since = None
+            return False
+        if self.above_since is None:
+            self.above_since = now
+        return now - self.above_since >= self.hold
+
+# Least-squares slope of the readings over the last window seconds. Running sums are updated as
+# readings enter and leave the window, so each reading costs O(1). Every so often times are measured
+# again from the oldest reading in the window and the sums are recomputed, which costs O(1) per reading
+# on average and stops rounding errors from building up over months of running
+class TrendEstimator:
+    def __init__(self, window):
+        self.window = window
+        self.points = deque()
+        self.origin = None
+        self.updates = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = self.sum_yy = 0.0
+
+    def include(self, x, y, sign):
+        self.sum_x += sign * x
+        self.sum_y += sign * y
+        self.sum_xx += sign * x * x
+        self.sum_xy += sign * x * y
+        self.sum_yy += sign * y * y
+
+    def add(self, now, value):
+        if self.origin is None:
+            self.origin = now
+        x = now - self.origin
+        self.points.append((x, value))
+        self.include(x, value, 1)
+        while self.points[0][0] < x - self.window:
+            self.include(*self.points.popleft(), -1)
+        self.updates += 1
+        if self.updates > 2 * len(self.points) + 16:
+            self.recompute()
+
+    def recompute(self):
+        shift = self.points[0][0]
+        self.origin += shift
+        self.points = deque((x - shift, y) for x, y in self.points)
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = self.sum_yy = 0.0
+        for x, y in self.points:
+            self.include(x, y, 1)
+        self.updates = 0
+
+    # Seconds between the oldest and newest readings in the window
+    def span(self):
+        return self.points[-1][0] - self.points[0][0] if self.points else 0.0
+
+    # Degrees per second, or None with fewer than two readings
+    def slope(self):
+        n = len(self.points)
+        denominator = n * self.sum_xx - self.sum_x * self.sum_x
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+
+    # Value of the fitted line at the newest reading, which is less noisy than the reading itself
+    def fitted(self):
+        slope = self.slope()
+        if slope is None:
+            return self.points[-1][1] if self.points else None
+        n = len(self.points)
+        return (self.sum_y - slope * self.sum_x) / n + slope * self.points[-1][0]
+
+    # Standard deviation of the readings around the fitted line, i.e. how noisy they are whatever the
+    # trend, or None with fewer than three readings
+    def deviation(self):
+        slope = self.slope()
+        n = len(self.points)
+        if slope is None or n < 3:
+            return None
+        residual = self.sum_yy - self.sum_y * self.sum_y / n - slope * (self.sum_xy - self.sum_x * self.sum_y / n)
+        return math.sqrt(max(residual, 0.0) / (n - 2))
@@ -0,0 +1,61 @@
+# Sending readings and notifications through a fleet collector
+#
+# When COLLECTOR_URL is set in config.ini the monitor hands its readings and emails to a collector
+# (see collector.py) instead of talking to Initial State and the mail server itself. Readings still go
+# through the on-disk upload queue first, so they are kept on the device while the collector cannot be
+# reached and sent oldest first once it can. A collector that is too busy answers 503 with a
+# Retry-After time; until then no further requests are made and readings simply wait in the queue.
+# Notifications are retried by the monitor's own dispatcher until the collector has accepted them.
+
+import json
+import time
+
+# The collector asked to be left alone for a while, or could not take the request
+class CollectorBusy(Exception):
+    pass
+
+class CollectorClient:
+    # Used in log messages and as the dependency label of the failure metrics
+    name = 'the collector'
+    dependency = 'collector'
+
+    def __init__(self, url, token, node, timeout):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.node = node
+        self.timeout = timeout
+        self.retry_at = 0.0
+
+    def post(self, resource, data):
+        # Only imported once there is something to send, so it does not hold up the first reading
+        import urllib.error
+        import urllib.request
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        request = urllib.request.Request(self.url + resource, data=data, method='POST', headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code in (429, 503):
+                try:
+                    retry_after = float(e.headers.get('Retry-After', 30))
+                except ValueError:
+                    retry_after = 30.0
+                self.retry_at = time.monotonic() + retry_after
+                raise CollectorBusy(f"the collector is busy, retrying in {retry_after:.0f} seconds") from e
+            raise
+
+    # Send a batch of queued events, each already encoded as JSON by the upload queue. Nothing is sent
+    # while the collector has asked to wait
+    def send(self, events):
+        wait = self.retry_at - time.monotonic()
+        if wait > 0:
+            raise CollectorBusy(f"the collector asked to wait another {wait:.0f} seconds")
+        self.post('/readings', b'{"node": ' + json.dumps(self.node).encode() + b', "events": [' + b','.join(events) + b']}')
+
+    # Same arguments as EmailSender.send, so the notification dispatcher can use either. Notifications
+    # are sent even while readings are held back
+    def send_email(self, recipients, subject, body):
+        self.post('/notifications', json.dumps({'node': self.node, 'recipients': recipients, 'subject': subject, 'body': body}).encode())
@@ -0,0 +1,242 @@
+# Email content
+#
+# Messages are built only from the snapshot they are given and the settings, without blocking.
+# The weekly update also reads the hourly rollups, which takes a few milliseconds.
+# Each build_* method returns a (subject, html body) pair.
+
+from datetime import datetime
+
+from .reports import weekly_report_html
+from .sensors import FAULTS
+
+# A duration in seconds as hours and minutes, e.g. "2 h 05 min"
+def format_duration(seconds):
+    minutes = int(round(seconds / 60))
+    if minutes < 1:
+        return "less than a minute"
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60:02d} min"
+
+class Messages:
+    # rollups is only needed for the weekly update
+    def __init__(self, settings, probes, rollups=None):
+        self.settings = settings
+        self.probes = probes
+        self.rollups = rollups
+
+    # Name used for a probe in emails. With a single probe this is just the device location
+    def probe_label(self, probe):
+        if len(self.probes) == 1:
+            return self.settings.DEVICE_LOCATION_NAME
+        return f"{self.settings.DEVICE_LOCATION_NAME} ({probe.name})"
+
+    # Latest temperature of every probe with its recent range, one paragraph each
+    def temperatures_html(self, snapshot):
+        lines = []
+        for probe in self.probes:
+            reading = snapshot.readings.get(probe.sensor_id)
+            prefix = f"{probe.name}: " if len(self.probes) > 1 else ""
+            if reading is None:
+                lines.append(f"<p>{prefix}unavailable<p>")
+                continue
+            lines.append(f"<p>{prefix}{reading.temperature:.2f}&deg;C<p>")
+            lines.append(f"<p>(lowest {reading.minimum:.2f}&deg;C, highest {reading.maximum:.2f}&deg;C over the last {self.settings.RECENT_WINDOW // 60} minutes)<p>")
+            trend = self.trend_text(probe, reading)
+            if trend:
+                lines.append(f"<p>{trend}<p>")
+        return '\n            '.join(lines)
+
+    # How fast a probe's temperature is changing and, if it is rising, when it will reach ALERT_TEMP
+    def trend_text(self, probe, reading):
+        if reading is None or reading.trend is None:
+            return ""
+        text = f"Trend: {reading.trend * 3600:+.2f}&deg;C per hour"
+        if reading.eta is not None:
+            text += f", reaching the alert temperature ({probe.alert_temp}&deg;C) in about {format_duration(reading.eta)}"
+        return text
+
+    # Notification thresholds of every probe
+    def thresholds_html(self, include_reset):
+        lines = []
+        for probe in self.probes:
+            if len(self.probes) > 1:
+                lines.append(f"<p>{probe.name}:<p>")
+            lines.append(f"<p>Warning temp: {probe.warning_temp}&deg;C<p>")
+            lines.append(f"<p>Alert temp: {probe.alert_temp}&deg;C<p>")
+            lines.append(f"<p>Panic temp: {probe.panic_temp}&deg;C<p>")
+            if include_reset:
+                lines.append(f"<p>Reset temp: {probe.reset_temp}&deg;C<p>")
+        return '\n            '.join(lines)
+
+    def build_boot_message(self, snapshot):
+        settings = self.settings
+        custom_lines = settings.CUSTOM_BOOT_MESSAGE_LINES
+        subject = f"{settings.DEVICE_LOCATION_NAME} is online"
+        body = f"""
+        <p>{settings.DEVICE_LOCATION_NAME} was just powered on, and monitoring software is running</p>
+        <p>{custom_lines[0]}</p>
+        <p>{custom_lines[1]}</p>
+        <p>{custom_lines[2]}</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            {self.temperatures_html(snapshot)}
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p></p>
+        <p>...</p>
+        <p></p>
+        <p>Notification thresholds are set to:<p>
+        <div style="margin-left: 30px;">
+            {self.thresholds_html(include_reset=True)}
+        </div>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # upload_failures is the number of failed uploads since upload_failures_since, the previous weekly update
+    def build_weekly_update(self, snapshot, upload_failures, upload_failures_since):
+        settings = self.settings
+        custom_lines = settings.CUSTOM_WEEKLY_MESSAGE_LINES
+        subject = f"{settings.DEVICE_LOCATION_NAME} is running normally"
+        body = f"""
+        <p>This is your weekly update for {settings.DEVICE_LOCATION_NAME}. The device and software are running normally</p>
+        <p>{custom_lines[0]}</p>
+        <p>{custom_lines[1]}</p>
+        <p>{custom_lines[2]}</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            {self.temperatures_html(snapshot)}
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p>...</p>
+        <p>Over the last week:</p>
+        <div style="margin-left: 30px;">
+            {weekly_report_html(self.rollups, self.probes, self.probe_label, snapshot.taken_at, snapshot.started, upload_failures, upload_failures_since)}
+        </div>
+        <p>...</p>
+        <p>Notification thresholds are set to:<p>
+        <div style="margin-left: 40px;">
+            {self.thresholds_html(include_reset=False)}
+        </div>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # Warning, alert and panic emails share one layout. temperature is the reading that crossed the threshold
+    def build_threshold_message(self, snapshot, probe, temperature, level, threshold, emphasis, custom_lines):
+        settings = self.settings
+        label = self.probe_label(probe)
+        trend = self.trend_text(probe, snapshot.readings.get(probe.sensor_id))
+        trend_line = f"\n            <p>{trend}<p>" if trend else ""
+        subject = f"{level}: {label} temperature has exceeded {threshold}°C!"
+        body = f"""
+        <p>The temperature for {label} has exceeded {threshold}&deg;C{emphasis}</p>
+        <p>{custom_lines[0]}</p>
+        <p>{custom_lines[1]}</p>
+        <p>{custom_lines[2]}</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            <p>{temperature:.2f}&deg;C<p>{trend_line}
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # Sent when a probe is still below ALERT_TEMP but rising fast enough to reach it within PREDICTION_HORIZON.
+    # trend (degrees per second) and eta (seconds) are the estimate that triggered it
+    def build_predicted_breach(self, snapshot, probe, temperature, trend, eta):
+        settings = self.settings
+        custom_lines = settings.CUSTOM_WARNING_MESSAGE_LINES
+        label = self.probe_label(probe)
+        subject = f"PREDICTED: {label} temperature may exceed {probe.alert_temp}°C in about {format_duration(eta)}"
+        body = f"""
+        <p>The temperature for {label} is rising by {trend * 3600:.2f}&deg;C per hour and is expected to exceed {probe.alert_temp}&deg;C in about {format_duration(eta)}</p>
+        <p>{custom_lines[0]}</p>
+        <p>{custom_lines[1]}</p>
+        <p>{custom_lines[2]}</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            <p>{temperature:.2f}&deg;C<p>
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # Sent when a probe is back below RESET_TEMP after an alarm. peak is the highest temperature reached
+    # and duration the seconds since the alarm started
+    def build_recovered(self, snapshot, probe, temperature, peak, duration):
+        settings = self.settings
+        label = self.probe_label(probe)
+        subject = f"RECOVERED: {label} temperature is back below {probe.reset_temp}°C"
+        peak_line = f" and peaked at {peak:.2f}&deg;C" if peak is not None else ""
+        body = f"""
+        <p>The temperature for {label} is back below {probe.reset_temp}&deg;C. The alarm lasted {format_duration(duration)}{peak_line}</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            <p>{temperature:.2f}&deg;C<p>
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # Sent when every reading of a probe has been faulty for SENSOR_FAULT_TIME seconds. kind is the kind of
+    # fault (see sensors.FAULTS) and detail what the sensor or the acquisition thread reported
+    def build_sensor_fault(self, snapshot, probe, kind, detail):
+        settings = self.settings
+        label = self.probe_label(probe)
+        reading = snapshot.readings.get(probe.sensor_id)
+        if reading is not None:
+            last_line = f"{reading.temperature:.2f}&deg;C at {datetime.fromtimestamp(reading.timestamp).strftime('%Y-%m-%d %H:%M')}"
+        else:
+            last_line = "none since the monitor started"
+        subject = f"SENSOR FAULT: {label} temperature cannot be read"
+        body = f"""
+        <p>The temperature sensor for {label} is not working: {FAULTS[kind]} ({detail})</p>
+        <p>The temperature of {label} is not being monitored until the sensor works again. Please check the probe and its wiring</p>
+        <p>...</p>
+        <p>The last good reading was:</p>
+        <div style="margin-left: 30px;">
+            <p>{last_line}<p>
+        </div>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    # Sent when the readings of a probe with a sensor fault have been good again for SENSOR_FAULT_TIME seconds.
+    # duration is the seconds since the fault alarm was raised
+    def build_sensor_restored(self, snapshot, probe, kind, duration):
+        settings = self.settings
+        label = self.probe_label(probe)
+        subject = f"RESOLVED: {label} temperature sensor is working again"
+        body = f"""
+        <p>The temperature sensor for {label} is working again after {format_duration(duration)} ({FAULTS[kind]})</p>
+        <p>...</p>
+        <p>The temperature at the time of this notification was:</p>
+        <div style="margin-left: 30px;">
+            {self.temperatures_html(snapshot)}
+        </div>
+        <p><a href="{settings.SHARE_LINK}">CLICK HERE TO VIEW CURRENT TEMPERTURE</a></p>
+        <p>...</p>
+        <p>Access this device via ssh at: {settings.HOSTNAME}@{snapshot.ip_address}</p>"""
+        return subject, body
+
+    def build_warning(self, snapshot, probe, temperature):
+        return self.build_threshold_message(snapshot, probe, temperature, "WARNING", probe.warning_temp, "!",
+                                            self.settings.CUSTOM_WARNING_MESSAGE_LINES)
+
+    def build_alert(self, snapshot, probe, temperature):
+        return self.build_threshold_message(snapshot, probe, temperature, "ALERT", probe.alert_temp, "!",
+                                            self.settings.CUSTOM_ALERT_MESSAGE_LINES)
+
+    def build_panic(self, snapshot, probe, temperature):
+        return self.build_threshold_message(snapshot, probe, temperature, "PANIC", probe.panic_temp, "!!!",
+                                            self.settings.CUSTOM_PANIC_MESSAGE_LINES)
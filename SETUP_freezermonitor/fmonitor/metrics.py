@@ -0,0 +1,244 @@
+# Metrics
+#
+# Timings, counts and current values from the busy parts of the monitor (sensor reads, uploads, emails,
+# ip address lookups and the scheduler), kept in memory and served in the OpenMetrics text format by a
+# small HTTP server on a background thread when METRICS_PORT is set, e.g. for Prometheus or
+# curl http://<device>:<port>/metrics
+#
+# Recording a value takes a lock and a short search through the histogram buckets, a few microseconds
+# even on a Pi Zero. Nothing is formatted until the endpoint is read, and values that are already kept
+# elsewhere (queue depths, the latest readings, process memory and CPU) are only looked up then.
+# Metrics are created when their module is imported, like loggers, and are shared by every monitor
+# in the process.
+
+import bisect
+import os
+import threading
+import time
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Upper bounds in seconds for latency histograms, from a fast SPI read to a slow SMTP send
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Metrics by name, in the order they were created
+registry = {}
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+# A metric with optional labels. Values are kept per combination of label values, given as keyword
+# arguments when recording, e.g. failures.inc(dependency='email')
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry[name] = self
+
+    def key(self, labels):
+        if not labels:
+            return ()
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    # (name suffix, labels, value) for every sample of the metric
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield '', dict(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f'# TYPE {self.name} {self.kind}', f'# HELP {self.name} {self.help_text}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for suffix, labels, value in super().samples():
+            yield '_total', labels, value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+# A gauge whose values are looked up when the metrics are read. func returns a number, or a list of
+# (labels, value) pairs for a gauge with labels. Creating another one with the same name replaces it,
+# so a new monitor takes over from an old one
+class GaugeFunction(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        for labels, value in values:
+            if value is not None:
+                yield '', labels, value
+
+# A counter kept somewhere else, e.g. the CPU time used by the process, read when the metrics are read
+class CounterFunction(GaugeFunction):
+    kind = 'counter'
+
+    def samples(self):
+        for suffix, labels, value in super().samples():
+            yield '_total', labels, value
+
+# Counts of observations at or below each bucket bound, with their total
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum of the observed values
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(float(bound))), cumulative
+            yield '_count', labels, cumulative
+            yield '_sum', labels, counts[-1]
+
+# Time a block of code into a histogram:  with Timer(histogram): ...
+class Timer:
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+## ----- Shared metrics ----- ##
+
+# dependency is one of sensor, initialstate, collector, email and network
+dependency_failures = Counter('fmonitor_dependency_failures', "Failed calls to a dependency", ['dependency'])
+dependency_retries = Counter('fmonitor_dependency_retries', "Calls to a dependency repeating one that failed", ['dependency'])
+
+## ----- Process ----- ##
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+PROCESS_STARTED = time.time()
+
+# Seconds since the system booted, or None where /proc is not available
+def system_uptime():
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Seconds since the process was launched, including the time taken to start Python and import the
+# monitor. Counted from when this module was imported where /proc is not available
+def process_age():
+    uptime = system_uptime()
+    try:
+        with open('/proc/self/stat') as f:
+            # the start time is the 22nd field, in clock ticks after boot; the name in brackets may contain spaces
+            started = int(f.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        started = None
+    if uptime is None or started is None:
+        return time.time() - PROCESS_STARTED
+    return uptime - started
+
+GaugeFunction('process_resident_memory_bytes', "Resident memory size in bytes", resident_memory)
+CounterFunction('process_cpu_seconds', "User and system CPU time used by the monitor, in seconds", cpu_seconds)
+GaugeFunction('process_start_time_seconds', "Time the monitor started, in seconds since the epoch", lambda: PROCESS_STARTED)
+
+## ----- Endpoint ----- ##
+
+def render():
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+# Serve /metrics on a background thread. Returns the server, whose shutdown() stops it. http.server
+# is only imported when the endpoint is turned on
+def start_metrics_server(address, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,811 @@
+# The monitor ties the sensors, local store, uploads and notifications together and runs them
+#
+# The probes are read on their own acquisition thread (see acquisition.py), which hands every pass to the
+# event loop through a ring buffer. Checking readings, uploading, notifying and network lookups run as
+# separate asyncio tasks. Uploads, emails and network lookups run in worker threads with a timeout, so
+# one slow dependency never delays a reading or an alarm
+
+import asyncio
+import functools
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .acquisition import FAULT_CODE, FAULT_CODES, Acquisition
+from .alarms import ALERT, PANIC, RECOVERED, WARNING, AlarmStore
+from .eventlog import configure_logging, get_logger
+from .fleet import CollectorClient
+from .filters import Debounce, ReadingFilter, TrendEstimator
+from .messages import Messages
+from .metrics import (Counter, GaugeFunction, Histogram, Timer, dependency_failures, dependency_retries, process_age, start_metrics_server,
+                      system_uptime)
+from .network import get_wireless_ip_address
+from .notifications import EmailSender, NotificationDispatcher
+from .rollups import Rollups
+from .sampling import FAST, SamplingRate, is_steady
+from .scheduler import Scheduler, seconds_until_weekly_update
+from .sensors import FAULTS, create_sensor
+from .settings import load_settings
+from .state import MonitorState
+from .storage import FLAG_READ_ERROR, ReadingStore
+from .upload import InitialStateUploader, UploadQueue
+
+sensor_log = get_logger('sensor')
+threshold_log = get_logger('thresholds')
+upload_log = get_logger('upload')
+network_log = get_logger('network')
+health_log = get_logger('health')
+error_log = get_logger('unexpected')
+config_log = get_logger('config')
+startup_log = get_logger('startup')
+sampling_log = get_logger('sampling')
+
+upload_seconds = Histogram('fmonitor_upload_seconds', "Time to send one batch of readings to Initial State")
+ip_lookup_seconds = Histogram('fmonitor_ip_lookup_seconds', "Time to look up the device ip address")
+sampling_rate_changes = Counter('fmonitor_sampling_rate_changes', "Changes to the fast or slow sampling rate", ['rate'])
+sensor_faults = Counter('fmonitor_sensor_faults', "Faulty readings of each probe by kind of fault", ['probe', 'fault'])
+samples_missed = Counter('fmonitor_samples_missed', "Passes over the probes that were overwritten in the ring before they were checked")
+
+# A temperature probe: its settings, the sensor it is read from, its filters and its alarm state.
+# Each probe has its own alarm, so one freezer warming up does not silence another
+class Probe:
+    def __init__(self, settings, sensor, reading_filter, debounce, trend, alarm, fault_debounce, clear_debounce):
+        self.sensor_id = settings.sensor_id
+        self.configure(settings)
+        self.sensor = sensor
+        self.filter = reading_filter
+        self.debounce = debounce
+        self.trend = trend
+        self.alarm = alarm
+        # Time faulty and good readings in a row, to raise and clear the sensor fault alarm
+        self.fault_debounce = fault_debounce
+        self.clear_debounce = clear_debounce
+        # Latest filtered reading since readings were last reported, or None if every read failed
+        self.pending = None
+        # Latest raw reading
+        self.raw = None
+        # Kind of fault of the latest reading, None if it was good
+        self.fault = None
+
+    # Take the name, thresholds and stream key from new settings, keeping the alarm state
+    def configure(self, settings):
+        self.settings = settings
+        self.name = settings.name
+        self.warning_temp = settings.warning_temp
+        self.alert_temp = settings.alert_temp
+        self.panic_temp = settings.panic_temp
+        self.reset_temp = settings.reset_temp
+        self.stream_key = settings.stream_key
+
+    # Number of thresholds a temperature is at or above: 0 below WARNING_TEMP, up to 3 at or above PANIC_TEMP
+    def level(self, temperature):
+        return sum(temperature >= threshold for threshold in (self.warning_temp, self.alert_temp, self.panic_temp))
+
+class Monitor:
+    # sensor_factory opens the sensor of a probe, by default with the backend from config.ini. sensors gives
+    # the sensors to use instead, one per probe, and these are kept when config.ini changes.
+    # config_path is the file to watch for changes, or None to never reload the settings
+    def __init__(self, settings, sensors=None, sensor_factory=create_sensor, config_path=None):
+        self.settings = settings
+        self.sensor_factory = sensor_factory
+        self.fixed_sensors = sensors is not None
+        self.config_path = config_path
+        self.config_signature = self.read_config_signature()
+
+        # Create logs and data directories if they do not yet exist
+        os.makedirs('logs', exist_ok=True)
+        os.makedirs('data', exist_ok=True)
+        self.log_handler = configure_logging(settings)
+        self.alarms = AlarmStore('data/alarms.json')
+
+        if sensors is None:
+            sensors = [sensor_factory(probe) for probe in settings.probes]
+        self.probes = [self.create_probe(probe, sensor) for probe, sensor in zip(settings.probes, sensors)]
+
+        self.state = MonitorState(settings.RECENT_WINDOW, settings.IP_ADDRESS_TTL)
+        self.rollups = Rollups('data/rollups', self.max_reading_gap(settings))
+        self.messages = Messages(settings, self.probes, self.rollups)
+        self.email = EmailSender(settings)
+        self.uploader = self.create_uploader(settings)
+        self.dispatcher = NotificationDispatcher(self.email_send_func(), self.state.snapshot, settings.NOTIFICATION_QUEUE_SIZE,
+                                                 settings.NOTIFICATION_MAX_ATTEMPTS, settings.NOTIFICATION_RETRY_DELAY,
+                                                 settings.NOTIFICATION_MAX_RETRY_DELAY, settings.NOTIFICATION_MAX_AGE,
+                                                 settings.NOTIFICATION_COALESCE_WINDOW, settings.NOTIFICATION_TIMEOUT)
+        self.reading_store = ReadingStore('data/readings')
+        self.upload_queue = UploadQueue('data/upload_queue.jsonl')
+        self.upload_failing = False
+        self.scheduler = Scheduler()
+        self.sampling = SamplingRate()
+        self.next_report = time.monotonic()
+        self.last_email_sent_date = None
+        # When the last weekly update was sent, or the monitor started, and the count of failed uploads then
+        self.last_weekly_update = (self.state.started, 0)
+
+        # The acquisition thread is started in run() and wakes the event loop through samples_ready after
+        # every pass. ring_position is the number of passes in its ring that have been checked
+        self.acquisition = self.create_acquisition()
+        self.samples_ready = None
+        self.ring_position = 0
+
+        # The sampler hands new readings to the uploader through upload_readings (created in run()).
+        # Everything that touches the on-disk queue runs on the single upload worker thread, so writes
+        # and uploads never overlap and never hold up the event loop
+        self.upload_readings = None
+        self.upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload')
+        self.upload_in_progress = None
+        self.metrics_server = None
+
+        # Seconds from the process starting to each startup stage (see record_startup)
+        self.startup_times = {}
+        # Set in run() once the first reading has been stored and the first ip address lookup has finished
+        self.first_reading = None
+        self.network_checked = None
+        self.first_upload = None
+        self.register_metrics()
+
+    # Readings and emails go through the collector when COLLECTOR_URL is set, otherwise straight to
+    # Initial State and the mail server
+    def create_uploader(self, settings):
+        if settings.COLLECTOR_URL:
+            return CollectorClient(settings.COLLECTOR_URL, settings.COLLECTOR_TOKEN, settings.NODE_NAME, settings.UPLOAD_TIMEOUT)
+        return InitialStateUploader(settings.API_URL, settings.BUCKET_NAME, settings.BUCKET_KEY, settings.ACCESS_KEY,
+                                    settings.UPLOAD_TIMEOUT)
+
+    # Longest time expected between two stored readings of a probe
+    def max_reading_gap(self, settings):
+        return 2 * max(settings.SECONDS_BETWEEN_READINGS, settings.SLOW_SECONDS_BETWEEN_READINGS)
+
+    def email_send_func(self):
+        if isinstance(self.uploader, CollectorClient):
+            return self.uploader.send_email
+        return self.email.send
+
+    def create_probe(self, probe_settings, sensor):
+        settings = self.settings
+        return Probe(probe_settings, sensor, ReadingFilter(settings.MEDIAN_SAMPLES, settings.EMA_TIME_CONSTANT),
+                     Debounce(settings.ALARM_HOLD_TIME), TrendEstimator(settings.TREND_WINDOW), self.alarms.get(probe_settings.sensor_id),
+                     Debounce(settings.SENSOR_FAULT_TIME), Debounce(settings.SENSOR_FAULT_TIME))
+
+    # A new acquisition thread for the current probes, reading at the current sampling rate
+    def create_acquisition(self):
+        return Acquisition(list(self.probes), self.settings, self.sampling.intervals(self.settings)[0])
+
+    # Start reading with acquisition, which may be the one already in use if it was only stopped
+    def start_acquisition(self, acquisition):
+        if acquisition is not self.acquisition:
+            self.acquisition = acquisition
+            self.ring_position = 0
+        acquisition.start(functools.partial(asyncio.get_running_loop().call_soon_threadsafe, self.samples_ready.set))
+
+    ## ------ Startup ------ ##
+
+    # Log how long after the process started, and after the system booted, a startup stage was reached.
+    # Only the first time is kept for each stage. Called from the event loop and the upload thread
+    def record_startup(self, stage, description):
+        if stage in self.startup_times:
+            return
+        seconds = self.startup_times[stage] = process_age()
+        uptime = system_uptime()
+        after_boot = f", {uptime:.1f} s after boot" if uptime is not None else ''
+        startup_log.info(f"{description} {seconds:.2f} s after starting{after_boot}",
+                         extra={'event': 'startup', 'fields': {'stage': stage, 'seconds_since_start': round(seconds, 3), 'seconds_since_boot': uptime,
+                                           'at': round(time.time(), 3)}})
+
+    # Everything that is not needed to take readings and check alarms waits until the first reading has been
+    # stored, so that after a power cut the freezers are watched again as soon as possible. The boot message
+    # also waits for the ip address lookup so that it includes both, but no more than BOOT_MESSAGE_DELAY seconds
+    async def finish_startup(self):
+        try:
+            await asyncio.wait_for(asyncio.gather(self.first_reading.wait(), self.network_checked.wait()), self.settings.BOOT_MESSAGE_DELAY)
+        except asyncio.TimeoutError:
+            startup_log.warning("Sending the boot message without waiting any longer for the first reading or the ip address")
+        await asyncio.get_running_loop().run_in_executor(None, self.start_metrics_server)
+        self.send_boot_message()
+
+    ## ------ Notifications ------ ##
+
+    # Not sent again if the monitor restarts within BOOT_MESSAGE_MIN_INTERVAL seconds, e.g. in a crash loop
+    def send_boot_message(self):
+        if not self.alarms.boot_message_due(time.time(), self.settings.BOOT_MESSAGE_MIN_INTERVAL):
+            startup_log.info("Restarted soon after the last boot message, not sending another")
+            return
+        self.dispatcher.submit(self.messages.build_boot_message, self.settings.admin_email_list)
+        self.save_alarms()
+
+    # Upload failures are reported for the time since the last weekly update, or since the start for the first one
+    def send_weekly_update(self):
+        since, counted = self.last_weekly_update
+        self.last_weekly_update = (time.time(), self.state.upload_failures)
+        self.dispatcher.submit(functools.partial(self.messages.build_weekly_update, upload_failures=self.state.upload_failures - counted,
+                                                 upload_failures_since=since),
+                               self.settings.email_list, key='weekly_update')
+
+    # A newer temperature notification for the same probe replaces one that has not been sent yet
+    def send_warning(self, probe, temperature):
+        self.dispatcher.submit(functools.partial(self.messages.build_warning, probe=probe, temperature=temperature),
+                               self.settings.email_list, key=f'temperature:{probe.sensor_id}', priority=1)
+
+    def send_alert(self, probe, temperature):
+        self.dispatcher.submit(functools.partial(self.messages.build_alert, probe=probe, temperature=temperature),
+                               self.settings.email_list, key=f'temperature:{probe.sensor_id}', priority=2)
+
+    def send_panic(self, probe, temperature):
+        self.dispatcher.submit(functools.partial(self.messages.build_panic, probe=probe, temperature=temperature),
+                               self.settings.email_list, key=f'temperature:{probe.sensor_id}', priority=3)
+
+    def send_recovered(self, probe, temperature):
+        alarm = probe.alarm
+        self.dispatcher.submit(functools.partial(self.messages.build_recovered, probe=probe, temperature=temperature, peak=alarm.peak,
+                                                 duration=alarm.since - alarm.started),
+                               self.settings.email_list, key=f'temperature:{probe.sensor_id}', priority=1)
+
+    # Sent once per warming, before any ALERT or PANIC notification for the probe
+    def send_predicted_breach(self, probe, temperature, trend, eta):
+        self.dispatcher.submit(functools.partial(self.messages.build_predicted_breach, probe=probe, temperature=temperature, trend=trend, eta=eta),
+                               self.settings.email_list, key=f'temperature:{probe.sensor_id}', priority=1)
+
+    # A sensor fault or its end replaces one that has not been sent yet for the same probe
+    def send_sensor_fault(self, probe, kind, detail):
+        self.dispatcher.submit(functools.partial(self.messages.build_sensor_fault, probe=probe, kind=kind, detail=detail),
+                               self.settings.email_list, key=f'sensor:{probe.sensor_id}', priority=2)
+
+    def send_sensor_restored(self, probe, kind, duration):
+        self.dispatcher.submit(functools.partial(self.messages.build_sensor_restored, probe=probe, kind=kind, duration=duration),
+                               self.settings.email_list, key=f'sensor:{probe.sensor_id}', priority=1)
+
+    ## ----- Measuring temperatures ----- ##
+
+    # Move the probe's alarm on for a new reading and send the notification it calls for, if any.
+    # above is True once the probe has been above WARNING_TEMP for ALARM_HOLD_TIME seconds
+    def check_temperature_alerts(self, probe, temperature, above):
+        previous = probe.alarm.state
+        notify = probe.alarm.update(probe, temperature, above, time.time(), self.settings)
+        if probe.alarm.state != previous:
+            threshold_log.info(f"{probe.name} alarm changed from {previous} to {probe.alarm.state} with a sensor temperature of {temperature}°C",
+                               extra={'event': 'alarm_state', 'fields': {'probe': probe.name, 'from': previous, 'to': probe.alarm.state, 'temperature': temperature}})
+        if notify == WARNING:
+            self.log_temperature_threshold_exceeded(probe, temperature, "WARNING_TEMP")
+            self.send_warning(probe, temperature)
+        elif notify == ALERT:
+            self.log_temperature_threshold_exceeded(probe, temperature, "ALERT_TEMP")
+            self.send_alert(probe, temperature)
+        elif notify == PANIC:
+            self.log_temperature_threshold_exceeded(probe, temperature, "PANIC_TEMP")
+            self.send_panic(probe, temperature)
+        elif notify == RECOVERED:
+            self.send_recovered(probe, temperature)
+
+    # Write the alarm states out if they changed. Small and rare enough to write straight away
+    def save_alarms(self):
+        try:
+            self.alarms.save()
+        except OSError as e:
+            error_log.error(f"Could not save the alarm states: {e}", extra={'event': 'alarm_save_failed'})
+
+    # Rate of change (degrees per second) over the last TREND_WINDOW seconds and the seconds until ALERT_TEMP
+    # will be reached at that rate. Either is None until the window is at least half full, and the time is
+    # None unless the temperature is rising towards ALERT_TEMP
+    def estimate_trend(self, probe):
+        if probe.trend.span() < self.settings.TREND_WINDOW / 2:
+            return None, None
+        trend = probe.trend.slope()
+        if trend is None:
+            return None, None
+        fitted = probe.trend.fitted()
+        if trend <= 0 or fitted >= probe.alert_temp:
+            return trend, None
+        return trend, (probe.alert_temp - fitted) / trend
+
+    # Notify when a probe that has not yet reached ALERT_TEMP is expected to within PREDICTION_HORIZON seconds.
+    # A prediction usually comes while the temperature is still below RESET_TEMP, so another one is only
+    # sent once the probe is below RESET_TEMP and no longer expected to reach ALERT_TEMP within twice the horizon
+    def check_predicted_breach(self, probe, temperature):
+        horizon = self.settings.PREDICTION_HORIZON
+        if horizon <= 0:
+            return
+        trend, eta = self.estimate_trend(probe)
+        if probe.alarm.predicted:
+            if temperature < probe.reset_temp and (eta is None or eta > 2 * horizon):
+                probe.alarm.set_predicted(False)
+            return
+        if probe.alarm.level() >= 2:
+            return
+        if eta is not None and eta <= horizon:
+            threshold_log.warning(f"{probe.name} predicted to reach ALERT_TEMP in {eta / 60:.0f} minutes, rising {trend * 3600:.2f}°C per hour with a sensor temperature of {temperature}°C",
+                                  extra={'event': 'predicted_breach', 'fields': {'probe': probe.name, 'temperature': temperature, 'trend_per_hour': round(trend * 3600, 3), 'eta_seconds': round(eta)}})
+            self.send_predicted_breach(probe, temperature, trend, eta)
+            probe.alarm.set_predicted(True)
+
+    # Wait for the acquisition thread to store new passes and check them. If no pass arrives within
+    # SENSOR_TIMEOUT seconds of when it was due, the thread is stuck in a read and every probe gets a
+    # timeout fault until it comes back
+    async def consume_samples(self):
+        while True:
+            timeout = self.acquisition.interval + self.settings.SENSOR_TIMEOUT
+            try:
+                await asyncio.wait_for(self.samples_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                count = len(self.acquisition.probes)
+                self.sample_temperature(time.monotonic(), time.time(), [math.nan] * count, [FAULT_CODE['timeout']] * count,
+                                        [f"no reading for {timeout:g} seconds"] * count)
+                continue
+            self.samples_ready.clear()
+            try:
+                self.process_samples()
+            except Exception as e:
+                error_log.error(f"Unexpected error while checking readings: {str(e)}", extra={'event': 'check_failed'})
+
+    # Check every pass the acquisition thread has stored since the last call, oldest first. Each pass is
+    # copied out of the ring and only checked if the writer has not come round to its slot during the copy,
+    # so a pass that was overwritten while it was being read is counted as missed rather than torn
+    def process_samples(self):
+        ring = self.acquisition.ring
+        while self.ring_position < ring.written:
+            if ring.overwritten(self.ring_position):
+                missed = ring.written - self.ring_position - ring.capacity + 1
+                samples_missed.inc(missed)
+                sensor_log.warning(f"{missed} passes over the probes were overwritten before they could be checked", extra={'event': 'passes_missed', 'fields': {'missed': missed}})
+                self.ring_position += missed
+                continue
+            slot = self.ring_position % ring.capacity
+            base = slot * ring.width
+            end = base + ring.width
+            now, timestamp = ring.times[slot], ring.timestamps[slot]
+            values, faults, details = ring.values[base:end], ring.faults[base:end], ring.details[base:end]
+            if ring.overwritten(self.ring_position):
+                continue
+            self.ring_position += 1
+            self.sample_temperature(now, timestamp, values, faults, details)
+
+    # Filter one pass of readings and check them against each probe's alarm thresholds. now and timestamp
+    # are the monotonic and wall clock time of the pass, and values, fault codes and fault details hold
+    # each probe's reading at base + its index. Every SECONDS_BETWEEN_READINGS seconds (or
+    # SLOW_SECONDS_BETWEEN_READINGS at the slow rate) the latest filtered readings are logged to the local
+    # store and queued to be sent to initialstate.
+    # Alarms are only raised once a probe has been above WARNING_TEMP for ALARM_HOLD_TIME seconds
+    def sample_temperature(self, now, timestamp, values, faults, details, base=0):
+        steady = True
+        for i, probe in enumerate(self.acquisition.probes):
+            fault = faults[base + i]
+            if fault:
+                self.check_sensor_fault(probe, FAULT_CODES[fault], details[base + i], now)
+                steady = False
+                continue
+            self.check_sensor_restored(probe, now)
+            raw = values[base + i]
+            probe.raw = raw
+            temperature = float('{0:0.2f}'.format(probe.filter.add(raw, now)))
+            probe.pending = temperature
+            probe.trend.add(now, temperature)
+            self.check_temperature_alerts(probe, temperature, probe.debounce.update(temperature >= probe.warning_temp, now))
+            self.check_predicted_breach(probe, temperature)
+            steady = steady and is_steady(probe, raw, temperature, self.settings)
+        if now >= self.next_report:
+            interval = self.sampling.intervals(self.settings)[1]
+            self.next_report += interval
+            if self.next_report <= now:
+                self.next_report = now + interval
+            self.report_readings(timestamp)
+        self.save_alarms()
+        self.update_sampling_rate(steady, now)
+
+    # A faulty reading is counted and never used for the temperature alarms. It is only logged when the
+    # probe's fault starts or changes kind, not for every pass it lasts. Once a probe has had nothing but
+    # faulty readings for SENSOR_FAULT_TIME seconds its sensor fault alarm is raised
+    def check_sensor_fault(self, probe, kind, detail, now):
+        dependency_failures.inc(dependency='sensor')
+        sensor_faults.inc(probe=probe.name, fault=kind)
+        if probe.fault != kind:
+            sensor_log.error(f"Sensor fault on {probe.name}: {FAULTS[kind]}", extra={'event': 'sensor_fault', 'fields': {'probe': probe.name, 'fault': kind, 'detail': detail}})
+            probe.fault = kind
+        probe.clear_debounce.update(False, now)
+        if not probe.fault_debounce.update(True, now):
+            return
+        raised = probe.alarm.fault is None
+        if probe.alarm.set_fault(kind, time.time(), self.settings):
+            if raised:
+                threshold_log.warning(f"{probe.name} sensor fault alarm raised: {FAULTS[kind]}", extra={'event': 'fault_alarm_raised', 'fields': {'probe': probe.name, 'fault': kind}})
+            self.send_sensor_fault(probe, kind, detail)
+
+    # A good reading. The sensor fault alarm is cleared once a probe's readings have been good for SENSOR_FAULT_TIME seconds
+    def check_sensor_restored(self, probe, now):
+        if probe.fault is not None:
+            sensor_log.info(f"Readings of {probe.name} are good again", extra={'event': 'sensor_restored', 'fields': {'probe': probe.name, 'fault': probe.fault}})
+            probe.fault = None
+        probe.fault_debounce.update(False, now)
+        alarm = probe.alarm
+        if alarm.fault is None or not probe.clear_debounce.update(True, now):
+            return
+        kind = alarm.fault
+        alarm.clear_fault()
+        threshold_log.info(f"{probe.name} sensor fault alarm cleared", extra={'event': 'fault_alarm_cleared', 'fields': {'probe': probe.name, 'fault': kind}})
+        self.send_sensor_restored(probe, kind, time.time() - alarm.fault_since)
+
+    # Store and queue for upload the latest filtered reading of every probe, or a failed reading for
+    # probes that could not be read at all since the last report
+    def report_readings(self, timestamp):
+        for probe in self.probes:
+            if probe.pending is None:
+                self.reading_store.append(timestamp, probe.sensor_id, math.nan, FLAG_READ_ERROR)
+                self.rollups.add(timestamp, probe.sensor_id, math.nan, 0)
+                continue
+            self.state.record(probe, probe.pending, timestamp, *self.estimate_trend(probe))
+            self.reading_store.append(timestamp, probe.sensor_id, probe.pending)
+            self.rollups.add(timestamp, probe.sensor_id, probe.pending, probe.level(probe.pending))
+            self.upload_readings.put_nowait((probe.stream_key, probe.pending, timestamp))
+            probe.pending = None
+            if not self.first_reading.is_set():
+                self.record_startup('first_reading', "First reading stored")
+                self.first_reading.set()
+
+    # save a log every time a temperature threshold is exceeded
+    def log_temperature_threshold_exceeded(self, probe, temperature, threshold_type):
+        threshold_log.warning(f"{probe.name} {threshold_type} exceeded with a sensor temperature of {temperature}°C",
+                              extra={'event': 'threshold_exceeded', 'fields': {'probe': probe.name, 'threshold': threshold_type, 'temperature': temperature}})
+
+    # Switch between the fast and slow sampling rates (see sampling.py)
+    def update_sampling_rate(self, steady, now):
+        rate = self.sampling.update(steady, now, self.settings)
+        if rate is None:
+            return
+        sample, report, upload = self.sampling.intervals(self.settings)
+        self.acquisition.set_interval(sample)
+        self.scheduler.set_interval('upload', upload)
+        if rate == FAST:
+            # Store the reading that ended the slow rate with the next sample rather than a slow interval later
+            self.next_report = min(self.next_report, now)
+        sampling_rate_changes.inc(rate=rate)
+        sampling_log.info(f"Switched to the {rate} sampling rate: reading every {sample:g} s, storing every {report:g} s, uploading every {upload:g} s",
+                          extra={'event': 'sampling_rate', 'fields': {'rate': rate, 'sample_interval': sample, 'report_interval': report, 'upload_interval': upload}})
+
+    ## ----- Uploading readings to initialstate ----- ##
+
+    # Move readings from the sampler into the on-disk queue, as many at a time as are waiting
+    async def queue_uploads(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            events = [await self.upload_readings.get()]
+            while not self.upload_readings.empty():
+                events.append(self.upload_readings.get_nowait())
+            try:
+                await loop.run_in_executor(self.upload_executor, self.upload_queue.extend, events)
+            except Exception as e:
+                error_log.error(f"Unexpected error while queueing readings for upload: {str(e)}", extra={'event': 'upload_queue_failed'})
+            # Send the first readings straight away rather than an UPLOAD_INTERVAL after starting
+            if self.first_upload is None:
+                self.first_upload = asyncio.create_task(self.flush_uploads())
+
+    # Run an upload on the upload worker thread. If the previous upload is somehow still running, this one
+    # is skipped; the wait is capped so the uploader task always comes back on schedule
+    async def flush_uploads(self):
+        if self.upload_in_progress is not None and not self.upload_in_progress.done():
+            return
+        self.upload_in_progress = asyncio.get_running_loop().run_in_executor(self.upload_executor, self.upload_batches)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.upload_in_progress), self.settings.UPLOAD_TIMEOUT * (self.settings.UPLOAD_MAX_BATCHES + 1))
+        except asyncio.TimeoutError:
+            pass
+
+    # Upload queued readings in batches. After an outage the backlog is sent oldest first,
+    # at most UPLOAD_MAX_BATCHES batches per run so that catching up does not swamp the connection
+    def upload_batches(self):
+        for _ in range(self.settings.UPLOAD_MAX_BATCHES):
+            events, end = self.upload_queue.read_batch(self.settings.UPLOAD_BATCH_SIZE)
+            if not events:
+                if end > self.upload_queue.offset:
+                    self.upload_queue.commit(end)
+                break
+            if self.upload_failing:
+                dependency_retries.inc(dependency=self.uploader.dependency)
+            try:
+                with Timer(upload_seconds):
+                    self.uploader.send(events)
+            except Exception as e:
+                dependency_failures.inc(dependency=self.uploader.dependency)
+                self.state.upload_failures += 1
+                # Log once when uploads start failing rather than on every attempt
+                if not self.upload_failing:
+                    upload_log.error(f"Failed to send sensor data to {self.uploader.name}, readings will be kept and sent later. Error: {e}", extra={'event': 'upload_failed'})
+                self.upload_failing = True
+                return
+            self.upload_queue.commit(end)
+            self.record_startup('first_upload', f"First readings sent to {self.uploader.name}")
+        if self.upload_failing:
+            backlog = self.upload_queue.backlog_bytes()
+            upload_log.warning(f"Sending sensor data to {self.uploader.name} resumed, {backlog} bytes of readings still queued", extra={'event': 'upload_resumed', 'fields': {'backlog_bytes': backlog}})
+            self.upload_failing = False
+
+    ## ------ Housekeeping ------ ##
+
+    # Logic for weekly update timing (8am mondays)
+    def check_weekly_updates(self):
+        current_time = datetime.now()
+        current_date = current_time.date()
+        day_of_week = current_time.weekday()
+        if day_of_week == 0 and current_time.hour == 8 and 0 <= current_time.minute <= 10:
+            if self.last_email_sent_date is None or (current_date - self.last_email_sent_date).days >= 6:
+                self.send_weekly_update()
+                self.last_email_sent_date = current_date
+
+    def weekly_update(self):
+        self.check_weekly_updates()
+        # stay clear of the window that was just handled before looking for the next one
+        return max(seconds_until_weekly_update(), 60.0)
+
+    # Look up the ip address used in emails in the background, so that building an email never waits on it.
+    # A single lookup is cheap, so it is repeated every NETWORK_INFO_INTERVAL seconds to pick up changes
+    async def refresh_network_info(self):
+        loop = asyncio.get_running_loop()
+        timeout = self.settings.NETWORK_TIMEOUT
+        started = time.perf_counter()
+        try:
+            ip_address = await asyncio.wait_for(loop.run_in_executor(None, get_wireless_ip_address, self.settings.WIRELESS_INTERFACE, 1, 0), timeout)
+            self.state.update_ip_address(ip_address)
+            if ip_address is None:
+                dependency_failures.inc(dependency='network')
+        except asyncio.TimeoutError:
+            dependency_failures.inc(dependency='network')
+            network_log.error(f"Looking up the ip address took longer than {timeout} seconds", extra={'event': 'ip_lookup_timeout'})
+        ip_lookup_seconds.observe(time.perf_counter() - started)
+        self.network_checked.set()
+
+    def flush_storage(self):
+        self.reading_store.flush()
+        self.rollups.flush()
+
+    async def sync_reading_store(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.flush_storage)
+
+    # Seal old raw readings into the archive and delete readings and 1 minute summaries that are past their
+    # retention time. Readings are sealed before they would be deleted
+    def expire_old_data(self):
+        now = time.time()
+        settings = self.settings
+        if settings.ARCHIVE_AFTER_DAYS > 0:
+            days = settings.ARCHIVE_AFTER_DAYS
+            if settings.RAW_RETENTION_DAYS > 0:
+                days = min(days, settings.RAW_RETENTION_DAYS)
+            started = time.perf_counter()
+            sealed = self.reading_store.seal(now - days * 86400)
+            if sealed:
+                size = self.reading_store.archive.size()
+                health_log.info(f"Sealed {sealed} segment(s) of readings older than {days:g} days into the archive in {time.perf_counter() - started:.1f} s, archive is now {size} bytes",
+                                extra={'event': 'archive_sealed', 'fields': {'segments': sealed, 'archive_bytes': size}})
+        if settings.RAW_RETENTION_DAYS > 0:
+            removed = self.reading_store.expire(now - settings.RAW_RETENTION_DAYS * 86400)
+            if removed:
+                health_log.info(f"Deleted {removed} segment(s) of readings older than {settings.RAW_RETENTION_DAYS:g} days", extra={'event': 'readings_expired'})
+        if settings.ARCHIVE_RETENTION_DAYS > 0:
+            removed = self.reading_store.archive.expire(now - settings.ARCHIVE_RETENTION_DAYS * 86400)
+            if removed:
+                health_log.info(f"Deleted {removed} archived segment(s) of readings older than {settings.ARCHIVE_RETENTION_DAYS:g} days", extra={'event': 'archive_expired'})
+        if self.settings.MINUTE_ROLLUP_RETENTION_DAYS > 0:
+            self.rollups.expire('1m', now - self.settings.MINUTE_ROLLUP_RETENTION_DAYS * 86400)
+
+    async def apply_retention(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.expire_old_data)
+
+    # Record how well the scheduler is keeping time and check that notifications are still being delivered
+    def health_check(self):
+        self.dispatcher.ensure_running()
+        for name, stats in dict(self.scheduler.stats(), sample=self.acquisition.stats()).items():
+            health_log.info(f"{name} ran {stats['runs']} times, skipped {stats['skipped']}, lateness mean {stats['mean_lateness']:.3f} s, max {stats['max_lateness']:.3f} s",
+                            extra={'event': 'job_stats', 'fields': dict(stats, job=name)})
+        sample, report, upload = self.sampling.intervals(self.settings)
+        health_log.info(f"Sampling at the {self.sampling.mode} rate: reading every {sample:g} s, storing every {report:g} s, uploading every {upload:g} s",
+                        extra={'event': 'sampling_status', 'fields': {'rate': self.sampling.mode, 'sample_interval': sample, 'report_interval': report, 'upload_interval': upload}})
+        backlog = self.upload_queue.backlog_bytes()
+        health_log.info(f"{backlog} bytes of readings waiting to be uploaded, {self.upload_readings.qsize()} readings waiting to be queued",
+                        extra={'event': 'upload_backlog', 'fields': {'backlog_bytes': backlog, 'waiting_readings': self.upload_readings.qsize()}})
+        stats = self.dispatcher.stats()
+        health_log.info(f"notifications queued {stats['queue_depth']}, delivered {stats['delivered']}, failed {stats['failed']}, dropped {stats['dropped']}, max latency {stats['max_latency']:.1f} s",
+                        extra={'event': 'notification_stats', 'fields': stats})
+
+    # Values that are read from the monitor when the metrics endpoint is read
+    def register_metrics(self):
+        def probe_values(field):
+            readings = self.state.readings
+            return [({'probe': probe.name}, getattr(readings[probe.sensor_id], field))
+                    for probe in self.probes if probe.sensor_id in readings]
+        GaugeFunction('fmonitor_temperature_celsius', "Latest reported temperature of each probe", lambda: probe_values('temperature'))
+        GaugeFunction('fmonitor_reading_timestamp_seconds', "Time of the latest reported temperature of each probe", lambda: probe_values('timestamp'))
+        GaugeFunction('fmonitor_alarm_level', "Alarm level of each probe: 0 normal or recovered, 1 warning, 2 alert, 3 panic",
+                      lambda: [({'probe': probe.name}, probe.alarm.level()) for probe in self.probes])
+        GaugeFunction('fmonitor_sensor_fault', "1 while the sensor fault alarm of a probe is raised, 0 otherwise",
+                      lambda: [({'probe': probe.name}, int(probe.alarm.fault is not None)) for probe in self.probes])
+        def sampling_intervals():
+            sample, report, upload = self.sampling.intervals(self.settings)
+            return [({'interval': 'sample'}, sample), ({'interval': 'report'}, report), ({'interval': 'upload'}, upload)]
+        GaugeFunction('fmonitor_sampling_interval_seconds', "Seconds between samples, stored readings and uploads at the current sampling rate", sampling_intervals)
+        GaugeFunction('fmonitor_sampling_slow', "1 while the slow sampling rate is in use, 0 otherwise", lambda: int(self.sampling.mode != FAST))
+        GaugeFunction('fmonitor_startup_seconds', "Seconds from the process starting to its first stored reading and first upload",
+                      lambda: [({'stage': stage}, seconds) for stage, seconds in list(self.startup_times.items())])
+        GaugeFunction('fmonitor_notification_queue_depth', "Notifications waiting to be sent", self.dispatcher.queue_depth)
+        GaugeFunction('fmonitor_archive_bytes', "Bytes of readings sealed into the compressed archive", self.reading_store.archive.size)
+        GaugeFunction('fmonitor_upload_backlog_bytes', "Bytes of readings waiting to be uploaded", self.upload_queue.backlog_bytes)
+        GaugeFunction('fmonitor_readings_waiting', "Readings waiting to be added to the upload queue",
+                      lambda: self.upload_readings.qsize() if self.upload_readings is not None else None)
+
+    # Write out buffered log records and rotate the log when it is due
+    async def maintain_log(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.log_handler.maintain)
+
+    ## ----- Reloading config.ini ----- ##
+
+    # Modification time and size of config.ini, or None if it cannot be read
+    def read_config_signature(self):
+        if self.config_path is None:
+            return None
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # Read config.ini again if it has changed. A file that cannot be read or is not valid is logged and
+    # the current settings are kept until the file changes again. Settings that could not be applied yet
+    # are tried again at the next check
+    async def check_config(self):
+        signature = self.read_config_signature()
+        if signature is None or signature == self.config_signature:
+            return
+        self.config_signature = signature
+        try:
+            settings = await asyncio.get_running_loop().run_in_executor(None, load_settings, self.config_path)
+        except Exception as e:
+            config_log.error(f"{self.config_path} was changed but could not be read, keeping the current settings: {e}", extra={'event': 'config_unreadable'})
+            return
+        if not await self.apply_settings(settings):
+            self.config_signature = None
+
+    # Swap in new settings. Parts that only hold values pick up the new ones, while sensors, the mail
+    # connection, the Initial State client, the log file and the metrics endpoint are only opened again
+    # when their own settings changed. Alarm flags, trends and queued notifications and readings are kept.
+    # Returns False if the settings were not applied because the acquisition thread is stuck in a read
+    async def apply_settings(self, settings):
+        old = self.settings
+        changed = old.changed_sections(settings)
+        # A reload that was put off left the acquisition thread stopping, so it is still carried out to
+        # start the thread again even if the file has since been changed back
+        if not changed and not self.acquisition.stopping.is_set():
+            return True
+        loop = asyncio.get_running_loop()
+        # Sensors are only opened and closed while the acquisition thread is stopped, so never during a read.
+        # Passes it stored before stopping are checked first
+        stopped = await loop.run_in_executor(None, self.acquisition.stop, old.SENSOR_TIMEOUT)
+        self.process_samples()
+        if not stopped:
+            config_log.error(f"{self.config_path} was changed but the sensor thread is stuck in a read, trying again at the next check",
+                             extra={'event': 'config_reload_deferred', 'fields': {'sections': sorted(changed)}})
+            return False
+        try:
+            sensors = await loop.run_in_executor(None, self.reopen_sensors, settings)
+        except Exception:
+            self.start_acquisition(self.acquisition)
+            raise
+        self.settings = settings
+        self.messages.settings = settings
+
+        current = {probe.sensor_id: probe for probe in self.probes}
+        probes = []
+        for probe_settings in settings.probes:
+            probe = current.get(probe_settings.sensor_id)
+            if probe is None:
+                probe = self.create_probe(probe_settings, sensors[probe_settings.sensor_id])
+            else:
+                probe.configure(probe_settings)
+                probe.sensor = sensors.get(probe.sensor_id, probe.sensor)
+            probes.append(probe)
+        # Change the list in place, as the messages hold on to it
+        self.probes[:] = probes
+        for probe in self.probes:
+            if (settings.MEDIAN_SAMPLES, settings.EMA_TIME_CONSTANT) != (old.MEDIAN_SAMPLES, old.EMA_TIME_CONSTANT):
+                probe.filter = ReadingFilter(settings.MEDIAN_SAMPLES, settings.EMA_TIME_CONSTANT)
+            probe.debounce.hold = settings.ALARM_HOLD_TIME
+            probe.fault_debounce.hold = probe.clear_debounce.hold = settings.SENSOR_FAULT_TIME
+            probe.trend.window = settings.TREND_WINDOW
+        self.start_acquisition(self.create_acquisition())
+
+        self.state.window = settings.RECENT_WINDOW
+        for extremes in self.state.extremes.values():
+            extremes.window = settings.RECENT_WINDOW
+        self.state.ip_address_ttl = settings.IP_ADDRESS_TTL
+        self.rollups.max_gap = self.max_reading_gap(settings)
+        self.dispatcher.configure(settings.NOTIFICATION_QUEUE_SIZE, settings.NOTIFICATION_MAX_ATTEMPTS, settings.NOTIFICATION_RETRY_DELAY,
+                                  settings.NOTIFICATION_MAX_RETRY_DELAY, settings.NOTIFICATION_MAX_AGE,
+                                  settings.NOTIFICATION_COALESCE_WINDOW, settings.NOTIFICATION_TIMEOUT)
+        if 'EmailSettings' in changed:
+            # An email may still be going out over the old session, so that one is left to time out
+            self.email = EmailSender(settings)
+        if changed & {'InitialState', 'Collector'}:
+            self.uploader = self.create_uploader(settings)
+        self.dispatcher.send_func = self.email_send_func()
+        if 'Logging' in changed:
+            self.log_handler = await loop.run_in_executor(None, configure_logging, settings)
+        if 'Metrics' in changed:
+            await loop.run_in_executor(None, self.restart_metrics_server)
+        for name, interval in self.job_intervals().items():
+            self.scheduler.set_interval(name, interval)
+        config_log.warning(f"Reloaded {self.config_path}, changed sections: {', '.join(sorted(changed))}",
+                           extra={'event': 'config_reloaded', 'fields': {'sections': sorted(changed)}})
+        return True
+
+    # Open the sensor of every new probe and of every probe whose sensor settings changed, closing the
+    # sensors that are no longer used. Returns the new sensors by sensor id. Runs while the acquisition thread is stopped
+    def reopen_sensors(self, settings):
+        current = {probe.sensor_id: probe for probe in self.probes}
+        sensors = {}
+        for probe_settings in settings.probes:
+            probe = current.pop(probe_settings.sensor_id, None)
+            if probe is not None and (self.fixed_sensors or probe.settings.hardware == probe_settings.hardware):
+                continue
+            if probe is not None:
+                probe.sensor.close()
+            try:
+                sensors[probe_settings.sensor_id] = self.sensor_factory(probe_settings)
+            except Exception as e:
+                sensor_log.error(f"Could not open the sensor for {probe_settings.name} with the new settings: {e}",
+                                 extra={'event': 'sensor_open_failed', 'fields': {'probe': probe_settings.name}})
+                if probe is None:
+                    raise
+                # fall back to the settings the sensor was working with
+                sensors[probe_settings.sensor_id] = self.sensor_factory(probe.settings)
+        for probe in current.values():
+            probe.sensor.close()
+        return sensors
+
+    def restart_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        self.start_metrics_server()
+
+    def start_metrics_server(self):
+        settings = self.settings
+        if not settings.METRICS_PORT:
+            return
+        try:
+            self.metrics_server = start_metrics_server(settings.METRICS_ADDRESS, settings.METRICS_PORT)
+        except OSError as e:
+            error_log.error(f"Could not start the metrics endpoint on {settings.METRICS_ADDRESS}:{settings.METRICS_PORT}: {e}", extra={'event': 'metrics_failed'})
+
+    # Jobs that run at a fixed interval taken from the settings
+    def job_intervals(self):
+        settings = self.settings
+        upload = self.sampling.intervals(settings)[2]
+        return {
+            'network_info': settings.NETWORK_INFO_INTERVAL,
+            'upload': upload,
+            'store_sync': settings.STORE_SYNC_INTERVAL,
+            'log_flush': settings.LOG_FLUSH_INTERVAL,
+            'health_check': settings.HEALTH_CHECK_INTERVAL,
+            'config': settings.CONFIG_CHECK_INTERVAL,
+        }
+
+    async def run(self):
+        settings = self.settings
+        self.upload_readings = asyncio.Queue()
+        self.first_reading = asyncio.Event()
+        self.network_checked = asyncio.Event()
+        self.samples_ready = asyncio.Event()
+
+        # The acquisition thread is started first so that the first reading is taken before anything else
+        # runs. The metrics endpoint and the boot message to admin_email_list follow once it has been stored
+        self.start_acquisition(self.acquisition)
+        self.dispatcher.start()
+        self.scheduler.add('network_info', self.refresh_network_info, interval=settings.NETWORK_INFO_INTERVAL)
+        self.scheduler.add('upload', self.flush_uploads, interval=settings.UPLOAD_INTERVAL, delay=settings.UPLOAD_INTERVAL)
+        self.scheduler.add('store_sync', self.sync_reading_store, interval=settings.STORE_SYNC_INTERVAL, delay=settings.STORE_SYNC_INTERVAL)
+        self.scheduler.add('retention', self.apply_retention, interval=86400, delay=settings.STORE_SYNC_INTERVAL)
+        self.scheduler.add('weekly_update', self.weekly_update, delay=seconds_until_weekly_update())
+        self.scheduler.add('log_flush', self.maintain_log, interval=settings.LOG_FLUSH_INTERVAL, delay=settings.LOG_FLUSH_INTERVAL)
+        self.scheduler.add('health_check', self.health_check, interval=settings.HEALTH_CHECK_INTERVAL, delay=settings.HEALTH_CHECK_INTERVAL)
+        if self.config_path is not None:
+            self.scheduler.add('config', self.check_config, interval=settings.CONFIG_CHECK_INTERVAL, delay=settings.CONFIG_CHECK_INTERVAL)
+        try:
+            await asyncio.gather(self.scheduler.run(), self.consume_samples(), self.queue_uploads(), self.finish_startup())
+        finally:
+            self.acquisition.stop(self.settings.SENSOR_TIMEOUT)
@@ -0,0 +1,26 @@
+# Network information used in emails
+
+import time
+
+from .eventlog import get_logger
+
+network_log = get_logger('network')
+
+# Get current ip address. netifaces is only needed to look up the ip address, which is left out of
+# emails without it. It is imported on the first lookup, which runs in the background
+def get_wireless_ip_address(interface, retries=10, delay=3):
+    try:
+        import netifaces
+    except ImportError:
+        return None
+    for i in range(retries):
+        try:
+            if interface in netifaces.interfaces():
+                addr_list = netifaces.ifaddresses(interface)
+                if netifaces.AF_INET in addr_list:
+                    return addr_list[netifaces.AF_INET][0]['addr']
+        except Exception as e:
+            if i == retries - 1:
+                network_log.error(f"Failed to acquire ip address after {retries} tries: {e}", extra={'event': 'ip_lookup_failed'})
+        time.sleep(delay)
+    return None
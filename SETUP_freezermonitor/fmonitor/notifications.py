@@ -0,0 +1,299 @@
+# Email notifications
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .eventlog import get_logger
+from .metrics import Histogram, Timer, dependency_failures, dependency_retries
+
+email_log = get_logger('email')
+notification_log = get_logger('notifications')
+email_send_seconds = Histogram('fmonitor_email_send_seconds', "Time to build and send one email")
+notification_delivery_seconds = Histogram('fmonitor_notification_delivery_seconds', "Time from a notification being queued to its email being sent",
+                                          buckets=(1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 21600.0))
+
+# Notifications are handed to a dispatcher running as its own asyncio task so that a slow or
+# missing network never holds up temperature readings. Messages are built and sent in a worker
+# thread of their own, and a send that takes longer than NOTIFICATION_TIMEOUT seconds counts as a
+# failure. The thread cannot be stopped, so a retry waits in line behind a send that is still running
+# rather than going out next to it.
+# Each job is a message builder, its recipients and a key: a new job with the same key as one still waiting in the queue replaces it (e.g. an ALERT
+# supersedes a WARNING that has not gone out yet). Jobs for the same recipients that are queued
+# within NOTIFICATION_COALESCE_WINDOW seconds of each other are sent as a single email, headed
+# by the most urgent one.
+# Failed jobs are retried with exponential backoff, and jobs that could not be delivered within
+# NOTIFICATION_MAX_AGE seconds are dropped.
+class NotificationJob:
+    def __init__(self, key, build_func, recipients, priority):
+        self.key = key
+        self.priority = priority
+        self.build_func = build_func
+        self.recipients = recipients
+        self.name = getattr(build_func, 'func', build_func).__name__
+        self.queued_at = time.monotonic()
+        self.due = self.queued_at
+        self.attempts = 0
+
+class NotificationDispatcher:
+    def __init__(self, send_func, snapshot_func, maxsize, max_attempts, retry_delay, max_retry_delay, max_age, coalesce_window, timeout):
+        self.send_func = send_func
+        self.snapshot_func = snapshot_func
+        self.jobs = deque(maxlen=maxsize)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notifier')
+        self.configure(maxsize, max_attempts, retry_delay, max_retry_delay, max_age, coalesce_window, timeout)
+        self.wakeup = None
+        self.task = None
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.merged = 0
+        self.coalesced = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+
+    # Change the delivery settings. Jobs already queued are kept, the newest if the queue is now smaller
+    def configure(self, maxsize, max_attempts, retry_delay, max_retry_delay, max_age, coalesce_window, timeout):
+        if maxsize != self.jobs.maxlen:
+            self.jobs = deque(self.jobs, maxlen=maxsize)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+
+    # Start the notifier task. Must be called from within the running event loop
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run(), name='notifier')
+
+    # Replace the notifier task if it has stopped
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            notification_log.warning("Notification task was not running and has been restarted")
+            self.start()
+
+    # Queue a notification and return immediately
+    def submit(self, build_func, recipients, key=None, priority=0):
+        job = NotificationJob(key or build_func.__name__, build_func, recipients, priority)
+        for i, pending in enumerate(self.jobs):
+            if pending.key == job.key:
+                self.jobs[i] = job
+                self.merged += 1
+                break
+        else:
+            if len(self.jobs) == self.jobs.maxlen:
+                self.drop(self.jobs.popleft(), "the notification queue was full")
+            self.jobs.append(job)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def queue_depth(self):
+        return len(self.jobs)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'merged': self.merged,
+            'coalesced': self.coalesced,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+        }
+
+    def drop(self, job, reason):
+        self.dropped += 1
+        notification_log.warning(f"Dropped '{job.name}' because {reason}", extra={'event': 'notification_dropped', 'fields': {'notification': job.name}})
+
+    # Wait for the earliest due job, discarding stale jobs. A failed job waiting out its backoff never
+    # holds up a newer one that is already due, and of jobs due at the same time the most urgent goes first
+    async def next_job(self):
+        while True:
+            now = time.monotonic()
+            for job in [job for job in self.jobs if now - job.queued_at > self.max_age]:
+                self.jobs.remove(job)
+                self.drop(job, f"it was older than {self.max_age} seconds")
+            job = min(self.jobs, key=lambda job: (job.due, -job.priority), default=None)
+            if job is not None and job.due <= now:
+                self.jobs.remove(job)
+                return job
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), job.due - now if job is not None else None)
+            except asyncio.TimeoutError:
+                pass
+
+    # Give related notifications a moment to arrive, then take every due job for the same recipients
+    async def collect_batch(self, job):
+        if job.attempts == 0 and self.coalesce_window > 0:
+            await asyncio.sleep(self.coalesce_window)
+        now = time.monotonic()
+        batch = [job]
+        remaining = []
+        for pending in self.jobs:
+            if pending.recipients == job.recipients and pending.due <= now:
+                batch.append(pending)
+            else:
+                remaining.append(pending)
+        self.jobs.clear()
+        self.jobs.extend(remaining)
+        return batch
+
+    # Build and send one email for a batch of jobs. Runs in a worker thread
+    def deliver(self, ordered, snapshot):
+        with Timer(email_send_seconds):
+            subject, body = merge_messages([job.build_func(snapshot) for job in ordered])
+            self.send_func(ordered[0].recipients, subject, body)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect_batch(await self.next_job())
+            for job in batch:
+                job.attempts += 1
+            if any(job.attempts > 1 for job in batch):
+                dependency_retries.inc(dependency='email')
+            ordered = sorted(reversed(batch), key=lambda job: job.priority, reverse=True)
+            try:
+                snapshot = self.snapshot_func()
+                await asyncio.wait_for(loop.run_in_executor(self.executor, self.deliver, ordered, snapshot), self.timeout)
+            except Exception as e:
+                dependency_failures.inc(dependency='email')
+                if isinstance(e, asyncio.TimeoutError):
+                    e = f"no response within {self.timeout} seconds"
+                for job in reversed(batch):
+                    self.retry(job, e)
+            else:
+                now = time.monotonic()
+                self.coalesced += len(batch) - 1
+                for job in batch:
+                    latency = now - job.queued_at
+                    self.delivered += 1
+                    self.last_latency = latency
+                    self.max_latency = max(self.max_latency, latency)
+                    notification_delivery_seconds.observe(latency)
+                    notification_log.info(f"Delivered '{job.name}' after {job.attempts} attempt(s) in {latency:.1f} seconds, {self.queue_depth()} notification(s) still queued",
+                                          extra={'event': 'notification_delivered', 'fields': {'notification': job.name, 'attempts': job.attempts, 'latency': round(latency, 3)}})
+
+    # Put a failed job back in the queue, due after its backoff, unless it has been superseded or is out of attempts
+    def retry(self, job, error):
+        if job.attempts >= self.max_attempts:
+            self.failed += 1
+            email_log.error(f"Failed to send email using '{job.name}' after {job.attempts} attempts. Error: {error}",
+                            extra={'event': 'email_failed', 'fields': {'notification': job.name, 'attempts': job.attempts}})
+            print(f"Failed to send email using '{job.name}' after {job.attempts} attempts. Error: {error}")
+            return
+        delay = min(self.retry_delay * 2 ** (job.attempts - 1), self.max_retry_delay)
+        job.due = time.monotonic() + delay
+        if any(pending.key == job.key for pending in self.jobs):
+            return
+        if len(self.jobs) == self.jobs.maxlen:
+            self.drop(job, "the notification queue was full")
+            return
+        self.jobs.appendleft(job)
+
+# Keeps one authenticated SMTP session open between notifications so that back-to-back emails
+# do not each pay for a TLS handshake and login. A session that has been idle for a while is
+# checked with NOOP before use, and a dead session is replaced on the next send.
+# smtplib (with ssl) and the email package take a while to load on a Pi, so they are only imported
+# when the first email goes out, in the dispatcher's worker thread rather than before the first reading
+class SMTPConnection:
+    # security is 'ssl' (connect over TLS), 'starttls' (upgrade a plain connection) or 'none'
+    def __init__(self, host, port, account, password, timeout, noop_after, idle_timeout, security='ssl'):
+        self.host = host
+        self.port = port
+        self.security = security
+        self.account = account
+        self.password = password
+        self.timeout = timeout
+        self.noop_after = noop_after
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.last_used = 0.0
+        self.connects = 0
+        # One smtplib session must only be used by one thread at a time
+        self.lock = threading.Lock()
+
+    def connect(self):
+        import smtplib
+        if self.security == 'ssl':
+            self.server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            self.server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        self.server.ehlo()
+        if self.security == 'starttls':
+            self.server.starttls()
+            self.server.ehlo()
+        self.server.login(self.account, self.password)
+        self.connects += 1
+
+    def is_alive(self):
+        import smtplib
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        import smtplib
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def sendmail(self, recipients, message):
+        with self.lock:
+            self.send_locked(recipients, message)
+
+    def send_locked(self, recipients, message):
+        import smtplib
+        idle = time.monotonic() - self.last_used
+        if self.server is not None and (idle > self.idle_timeout or (idle > self.noop_after and not self.is_alive())):
+            self.close()
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.sendmail(self.account, recipients, message)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            raise
+        self.last_used = time.monotonic()
+
+# Sends html emails through the SMTP connection. This is the only place emails leave the device
+class EmailSender:
+    def __init__(self, settings):
+        self.account = settings.gmail_account
+        self.smtp = SMTPConnection(settings.SMTP_SERVER, settings.SMTP_PORT, settings.gmail_account, settings.gmail_password,
+                                   settings.SMTP_TIMEOUT, settings.SMTP_NOOP_AFTER, settings.SMTP_IDLE_TIMEOUT, settings.SMTP_SECURITY)
+
+    def send(self, recipients, subject, body):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        msg = MIMEMultipart()
+        msg['Subject'] = subject
+        msg['From'] = self.account
+        msg['To'] = ', '.join(recipients)
+        msg['Reply-To'] = ', '.join(recipients)
+        msg.attach(MIMEText(f"""
+    <html>
+    <body>
+{body}
+    </body>
+    </html>
+    """, 'html'))
+        self.smtp.sendmail(recipients, msg.as_string())
+
+# Combine messages sent together into one email under the subject of the first
+def merge_messages(messages):
+    if len(messages) == 1:
+        return messages[0]
+    subject = f"{messages[0][0]} (+{len(messages) - 1} more)"
+    body = '\n        <hr>\n'.join(body for _, body in messages)
+    return subject, body
@@ -0,0 +1,363 @@
+# Looking up, exporting and serving the recorded readings
+#
+#   python3 fmquery.py readings --sensor 3 --start 2026-10-13T02:00 --end 2026-10-13T04:00
+#   python3 fmquery.py readings --start 7d --above -70          readings at or above -70°C in the last week
+#   python3 fmquery.py rollups --resolution 1h --start 30d --output last-month.csv
+#   python3 fmquery.py readings --start 0 --output everything.parquet
+#   python3 fmquery.py serve --port 8788
+#
+# (python3 -m fmonitor.query does the same.) Times are seconds since the epoch, ISO 8601 dates and times
+# (local time unless an offset is given) or a duration before now such as 30m, 2h or 7d. Without --start the
+# last day is shown. --sensor takes a SENSOR_ID or the name of a probe in config.ini.
+#
+# readings are the raw readings from data/readings. The time index of the store and of its archive means
+# only the segments and archived blocks that overlap the time asked for are read, and with --above or
+# --below archived blocks whose temperatures are all outside that range are skipped as well. rollups are the
+# 1 minute, 1 hour or 1 day summaries from data/rollups, one file per month, and --above and --below keep the
+# buckets whose highest or lowest temperature reached them.
+#
+# Rows are written out as they are read, so an export of years of readings takes no more memory than a
+# few pages of them. --format is table (the default on the terminal), csv, json, jsonl or parquet (a columnar
+# format that needs pyarrow: pip3 install pyarrow). Without --format it follows the extension of --output.
+#
+# serve answers the same queries over HTTP, e.g. for a dashboard on the local network, streaming the rows:
+#
+#   GET /sensors     the probes in config.ini
+#   GET /readings    ?sensor=&start=&end=&above=&below=&format=json|jsonl|csv
+#   GET /rollups     the same, and &resolution=1m|1h|1d
+#
+# It only listens on 127.0.0.1 unless --address is given, and never writes to the data directory, so it can
+# run alongside the monitor.
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+from .rollups import RESOLUTIONS, Rollups
+from .settings import load_settings
+from .storage import ReadingStore
+
+READING_COLUMNS = ('timestamp', 'sensor_id', 'probe', 'temperature', 'flags')
+ROLLUP_COLUMNS = ('start', 'sensor_id', 'probe', 'count', 'errors', 'minimum', 'maximum', 'mean', 'stddev', 'seconds_warning',
+                  'seconds_alert', 'seconds_panic')
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'json', '.parquet': 'parquet'}
+
+# Rows per Parquet row group
+PARQUET_ROWS = 16384
+
+DURATION = re.compile(r'^-?(\d+(?:\.\d+)?)([smhd])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+## ----- Queries ----- ##
+
+# Time given on the command line or in a request, as seconds since the epoch
+def parse_time(text, now):
+    text = text.strip()
+    if text == 'now':
+        return now
+    match = DURATION.match(text)
+    if match:
+        return now - float(match.group(1)) * UNITS[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f"'{text}' is not a time: give seconds since the epoch, an ISO 8601 date and time or a duration such as 2h")
+
+def parse_temperature(options, name):
+    if not options.get(name):
+        return None
+    try:
+        return float(options[name])
+    except ValueError:
+        raise ValueError(f"{name} must be a temperature in °C")
+
+def temperature(value):
+    if value is None or math.isnan(value) or math.isinf(value):
+        return None
+    # Temperatures are stored as 32-bit floats, which are given back to the digits they were stored with
+    return float(f'{value:.7g}')
+
+# Readings and rollups of the data directory the monitor writes to. Every query opens the store again, so it
+# sees the readings stored since the last one
+class History:
+    def __init__(self, directory, names):
+        self.directory = directory
+        # Probe names by sensor id
+        self.names = names
+
+    def sensor_id(self, text):
+        if text is None:
+            return None
+        text = text.strip()
+        if text.isdigit():
+            return int(text)
+        for sensor_id, name in self.names.items():
+            if name.lower() == text.lower():
+                return sensor_id
+        raise ValueError(f"No probe named '{text}'")
+
+    def name(self, sensor_id):
+        return self.names.get(sensor_id, str(sensor_id))
+
+    # Rows of READING_COLUMNS with start <= timestamp < end, oldest first. above and below keep readings at
+    # or above and at or below a temperature
+    def readings(self, start, end, sensor_id=None, above=None, below=None):
+        directory = os.path.join(self.directory, 'readings')
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No readings in {directory}")
+        store = ReadingStore(directory, writable=False)
+        try:
+            for timestamp, sensor, value, flags in store.query(start, end, sensor_id, above, below):
+                yield timestamp, sensor, self.name(sensor), temperature(value), flags
+        finally:
+            # The segment being written by the monitor stays open until the rows have been read
+            if store.active is not None:
+                store.active.close()
+
+    # Rows of ROLLUP_COLUMNS for the buckets of one resolution starting from start to before end, oldest
+    # first. above and below keep the buckets whose highest reading was at or above, or lowest at or below,
+    # a temperature
+    def rollups(self, resolution, start, end, sensor_id=None, above=None, below=None):
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"The resolution must be one of {', '.join(RESOLUTIONS)}")
+        directory = os.path.join(self.directory, 'rollups')
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No rollups in {directory}")
+        # Nothing is summarised ahead of the clock, and the monthly files are found from the end time
+        end = min(end, time.time() + RESOLUTIONS[resolution])
+        for bucket in Rollups(directory, 0, writable=False).iterate(resolution, start, end, sensor_id):
+            if (above is not None and not bucket.maximum >= above) or (below is not None and not bucket.minimum <= below):
+                continue
+            variance = bucket.variance()
+            yield (bucket.start, bucket.sensor_id, self.name(bucket.sensor_id), bucket.count, bucket.errors, temperature(bucket.minimum),
+                   temperature(bucket.maximum), round(bucket.mean, 3) if bucket.count else None,
+                   round(math.sqrt(variance), 3) if variance is not None else None, round(bucket.seconds_warning, 1),
+                   round(bucket.seconds_alert, 1), round(bucket.seconds_panic, 1))
+
+    # Columns and rows for a query given as strings by name, as on the command line or in a request. The
+    # first row is read straight away, so that a missing store or bad option is reported before any output
+    def select(self, kind, options, now):
+        start = parse_time(options['start'], now) if options.get('start') else now - 86400
+        end = parse_time(options['end'], now) if options.get('end') else math.inf
+        sensor_id = self.sensor_id(options.get('sensor'))
+        above = parse_temperature(options, 'above')
+        below = parse_temperature(options, 'below')
+        if kind == 'readings':
+            columns, rows = READING_COLUMNS, self.readings(start, end, sensor_id, above, below)
+        else:
+            columns, rows = ROLLUP_COLUMNS, self.rollups(options.get('resolution') or '1h', start, end, sensor_id, above, below)
+        first = next(rows, None)
+        return columns, itertools.chain([first] if first is not None else [], rows)
+
+## ----- Output ----- ##
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp).astimezone().isoformat(timespec='milliseconds')
+
+# The first column of every row is a time in seconds since the epoch, which text formats follow with the
+# same time in ISO 8601
+def with_time(rows):
+    for row in rows:
+        yield (row[0], iso_time(row[0])) + row[1:]
+
+def text_columns(columns):
+    return (columns[0], 'time') + columns[1:]
+
+def write_csv(columns, rows, out):
+    writer = csv.writer(out)
+    writer.writerow(text_columns(columns))
+    writer.writerows(with_time(rows))
+
+def write_jsonl(columns, rows, out):
+    columns = text_columns(columns)
+    for row in with_time(rows):
+        out.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+# One JSON array, written a row at a time
+def write_json(columns, rows, out):
+    columns = text_columns(columns)
+    separator = '['
+    for row in with_time(rows):
+        out.write(separator + json.dumps(dict(zip(columns, row))))
+        separator = ',\n'
+    out.write('[]\n' if separator == '[' else ']\n')
+
+def write_table(columns, rows, out):
+    widths = [19] + [max(len(name), 20 if name == 'probe' else 8) for name in columns[1:]]
+    out.write('  '.join(name.ljust(width) for name, width in zip(('time',) + columns[1:], widths)).rstrip() + '\n')
+    for row in rows:
+        cells = [datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S')]
+        cells.extend('' if value is None else f'{value:.2f}' if isinstance(value, float) else str(value) for value in row[1:])
+        out.write('  '.join(cell.ljust(width) for cell, width in zip(cells, widths)).rstrip() + '\n')
+
+# Column types for Parquet. The time is stored as a timestamp in UTC, which tools show in local time
+def parquet_schema(pyarrow, columns):
+    types = {'timestamp': pyarrow.float64(), 'start': pyarrow.float64(), 'sensor_id': pyarrow.int32(), 'probe': pyarrow.string(),
+             'flags': pyarrow.int32(), 'count': pyarrow.int64(), 'errors': pyarrow.int64()}
+    return pyarrow.schema([(columns[0], types[columns[0]]), ('time', pyarrow.timestamp('ms', tz='UTC'))] +
+                          [(name, types.get(name, pyarrow.float64())) for name in columns[1:]])
+
+# Parquet is written one row group at a time
+def write_parquet(columns, rows, path):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        sys.exit("Writing Parquet needs pyarrow: pip3 install pyarrow")
+    schema = parquet_schema(pyarrow, columns)
+    rows = iter(rows)
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        while True:
+            batch = list(itertools.islice(rows, PARQUET_ROWS))
+            if not batch:
+                break
+            data = list(zip(*batch))
+            arrays = [pyarrow.array(data[0], schema.field(0).type),
+                      pyarrow.array([round(timestamp * 1000) for timestamp in data[0]], schema.field(1).type)]
+            arrays.extend(pyarrow.array(values, schema.field(i + 2).type) for i, values in enumerate(data[1:]))
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'json': write_json, 'table': write_table}
+
+## ----- HTTP API ----- ##
+
+CONTENT_TYPES = {'json': 'application/json', 'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# Serve queries on a thread per request until interrupted. http.server is only imported when serving
+def serve(history, address, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            options = {name: values[0] for name, values in parse_qs(url.query).items()}
+            if url.path == '/sensors':
+                self.send_json(200, [{'sensor_id': sensor_id, 'probe': name} for sensor_id, name in sorted(history.names.items())])
+                return
+            if url.path not in ('/readings', '/rollups'):
+                self.send_json(404, {'error': f"nothing at {url.path}"})
+                return
+            output = options.get('format', 'json')
+            try:
+                if output not in CONTENT_TYPES:
+                    raise ValueError(f"The format must be one of {', '.join(CONTENT_TYPES)}")
+                columns, rows = history.select(url.path[1:], options, time.time())
+            except (ValueError, FileNotFoundError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_rows(output, columns, rows)
+
+        def send_json(self, status, result):
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Rows are streamed without a Content-Length and the connection closed at the end
+        def send_rows(self, output, columns, rows):
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES[output])
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            out = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='')
+            try:
+                WRITERS[output](columns, rows, out)
+                out.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                out.detach()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), QueryHandler)
+    server.daemon_threads = True
+    print(f"Serving the readings in {history.directory} on http://{address}:{port}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+## ----- Command line ----- ##
+
+# Probe names from config.ini. The readings can be looked up by SENSOR_ID without it
+def probe_names(path):
+    try:
+        settings = load_settings(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not read the probe names from {path}: {e}", file=sys.stderr)
+        return {}
+    return {probe.sensor_id: probe.name for probe in settings.probes}
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default='config.ini', help="settings file, for the names of the probes (default: config.ini in the current directory)")
+    common.add_argument('--data', default='data', help="data directory of the monitor (default: data)")
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument('--sensor', help="SENSOR_ID or name of the probe (default: every probe)")
+    selection.add_argument('--start', help="first time to include (default: a day ago)")
+    selection.add_argument('--end', help="time to stop before (default: the latest)")
+    selection.add_argument('--above', help="only temperatures at or above this")
+    selection.add_argument('--below', help="only temperatures at or below this")
+    selection.add_argument('--format', choices=sorted(WRITERS) + ['parquet'], help="output format (default: from the --output extension, or table)")
+    selection.add_argument('--output', help="write to this file instead of the terminal")
+
+    parser = argparse.ArgumentParser(prog='fmquery.py', description="Look up, export and serve the readings recorded by the monitor.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('readings', parents=[common, selection], help="raw readings")
+    rollups = commands.add_parser('rollups', parents=[common, selection], help="1 minute, 1 hour or 1 day summaries")
+    rollups.add_argument('--resolution', choices=list(RESOLUTIONS), default='1h', help="length of each summary (default 1h)")
+    server = commands.add_parser('serve', parents=[common], help="answer queries over HTTP")
+    server.add_argument('--address', default='127.0.0.1', help="address to listen on (default: 127.0.0.1, this machine only)")
+    server.add_argument('--port', type=int, default=8788, help="port to listen on (default 8788)")
+    args = parser.parse_args(argv)
+
+    history = History(args.data, probe_names(args.config))
+    if args.command == 'serve':
+        serve(history, args.address, args.port)
+        return
+
+    output = args.format
+    if output is None:
+        output = FORMATS.get(os.path.splitext(args.output)[1].lower(), 'csv') if args.output else 'table'
+    if output == 'parquet' and not args.output:
+        sys.exit("Parquet can only be written to a file: give --output")
+    options = {name: getattr(args, name, None) for name in ('sensor', 'start', 'end', 'above', 'below', 'resolution')}
+    try:
+        columns, rows = history.select(args.command, options, time.time())
+        if output == 'parquet':
+            write_parquet(columns, rows, args.output)
+        elif args.output:
+            with open(args.output, 'w', newline='', encoding='utf-8') as f:
+                WRITERS[output](columns, rows, f)
+        else:
+            WRITERS[output](columns, rows, sys.stdout)
+            sys.stdout.flush()
+    except (ValueError, FileNotFoundError) as e:
+        sys.exit(str(e))
+    except BrokenPipeError:
+        # The output was piped into something like head, which has seen enough
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+if __name__ == '__main__':
+    main()
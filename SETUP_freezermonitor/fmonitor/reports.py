@@ -0,0 +1,143 @@
+# Weekly report
+#
+# The weekly report is built from the hourly rollups and the excursion log, never from the raw readings,
+# so it reads a few hundred 56 byte records per probe however often the probes are sampled and takes a
+# few milliseconds to build even on a Pi Zero. Days are local days made up of hourly buckets.
+
+from collections import namedtuple
+from datetime import datetime
+
+from .metrics import system_uptime
+from .rollups import Bucket
+
+REPORT_DAYS = 7
+
+DayStats = namedtuple('DayStats', ['date', 'minimum', 'maximum', 'mean', 'count', 'errors'])
+# seconds_above holds the seconds at or above WARNING_TEMP, ALERT_TEMP and PANIC_TEMP, and hourly_means
+# the mean temperature of every hour of the week, None for hours without readings
+ProbeReport = namedtuple('ProbeReport', ['probe', 'days', 'seconds_above', 'excursions', 'longest_excursion',
+                                         'errors', 'hourly_means'])
+
+SPARK_CHARACTERS = '▁▂▃▄▅▆▇█'
+
+def probe_report(rollups, probe, end, days=REPORT_DAYS):
+    start = end - days * 86400
+    first_hour = start - start % 3600
+    buckets = rollups.query('1h', first_hour, end, probe.sensor_id)
+
+    totals = {}
+    total = Bucket(first_hour, probe.sensor_id)
+    hourly_means = [None] * (int(end - first_hour) // 3600 + 1)
+    for bucket in buckets:
+        date = datetime.fromtimestamp(bucket.start).date()
+        if date not in totals:
+            totals[date] = Bucket(bucket.start, probe.sensor_id)
+        totals[date].merge(bucket)
+        total.merge(bucket)
+        if bucket.count:
+            hourly_means[int(bucket.start - first_hour) // 3600] = bucket.mean
+    days_stats = [DayStats(date, day.minimum, day.maximum, day.mean, day.count, day.errors) for date, day in sorted(totals.items())]
+
+    excursions = rollups.query_excursions(start, end, probe.sensor_id)
+    longest = max(excursions, key=lambda excursion: excursion.end - excursion.start, default=None)
+    return ProbeReport(probe, days_stats, (total.seconds_warning, total.seconds_alert, total.seconds_panic),
+                       len(excursions), longest, total.errors, hourly_means)
+
+# Compact inline chart of the hourly means with a dashed line at WARNING_TEMP. Gaps without readings
+# break the line
+def sparkline_svg(values, warning_temp, width=336, height=48):
+    known = [value for value in values if value is not None]
+    if not known:
+        return ""
+    low = min(min(known), warning_temp) - 0.5
+    high = max(max(known), warning_temp) + 0.5
+    step = width / max(len(values) - 1, 1)
+
+    def y(value):
+        return height - (value - low) / (high - low) * height
+
+    lines = []
+    points = []
+    for i, value in enumerate(values + [None]):
+        if value is None:
+            if points:
+                lines.append(f'<polyline fill="none" stroke="#1f77b4" stroke-width="1.5" points="{" ".join(points)}"/>')
+            points = []
+            continue
+        points.append(f"{i * step:.1f},{y(value):.1f}")
+    warning_y = y(warning_temp)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+            f'<line x1="0" y1="{warning_y:.1f}" x2="{width}" y2="{warning_y:.1f}" stroke="#d62728" stroke-dasharray="4,3" stroke-width="1"/>'
+            f'{"".join(lines)}</svg>')
+
+# The same chart as text, for email clients that do not show inline svg. Each character covers
+# len(values) / width hours
+def sparkline_text(values, width=42):
+    known = [value for value in values if value is not None]
+    if not known:
+        return ""
+    low, high = min(known), max(known)
+    per_character = max(len(values) / width, 1)
+    characters = []
+    for i in range(min(width, len(values))):
+        chunk = [value for value in values[int(i * per_character):int((i + 1) * per_character)] if value is not None]
+        if not chunk:
+            characters.append(' ')
+            continue
+        level = 0 if high == low else int((sum(chunk) / len(chunk) - low) / (high - low) * (len(SPARK_CHARACTERS) - 1) + 0.5)
+        characters.append(SPARK_CHARACTERS[level])
+    return ''.join(characters)
+
+def format_days(seconds):
+    days, rest = divmod(int(seconds), 86400)
+    hours = rest // 3600
+    if days:
+        return f"{days} day{'s' if days != 1 else ''} {hours} h"
+    if hours:
+        return f"{hours} h {rest % 3600 // 60:02d} min"
+    return f"{rest // 60} min"
+
+def probe_report_html(report, label):
+    probe = report.probe
+    lines = [f"<p><b>{label}</b><p>"]
+    if not report.days:
+        lines.append("<p>No readings were recorded this week<p>")
+        return lines
+    lines.append('<table style="border-collapse: collapse;" cellpadding="3">')
+    lines.append('<tr><th align="left">Day</th><th align="right">Lowest</th><th align="right">Highest</th><th align="right">Mean</th></tr>')
+    for day in report.days:
+        if day.count:
+            lines.append(f'<tr><td>{day.date.strftime("%a %d %b")}</td><td align="right">{day.minimum:.2f}&deg;C</td>'
+                         f'<td align="right">{day.maximum:.2f}&deg;C</td><td align="right">{day.mean:.2f}&deg;C</td></tr>')
+        else:
+            lines.append(f'<tr><td>{day.date.strftime("%a %d %b")}</td><td colspan="3">no readings</td></tr>')
+    lines.append('</table>')
+    svg = sparkline_svg(report.hourly_means, probe.warning_temp)
+    if svg:
+        lines.append(f"<p>{svg}<p>")
+        lines.append(f'<p style="font-family: monospace;">{sparkline_text(report.hourly_means)}<p>')
+    warning, alert, panic = report.seconds_above
+    lines.append(f"<p>Time at or above the warning temp ({probe.warning_temp}&deg;C): {round(warning / 60)} min, "
+                 f"alert temp ({probe.alert_temp}&deg;C): {round(alert / 60)} min, panic temp ({probe.panic_temp}&deg;C): {round(panic / 60)} min<p>")
+    if report.excursions:
+        longest = report.longest_excursion
+        lines.append(f"<p>Excursions above the warning temp: {report.excursions}, the longest lasting "
+                     f"{format_days(longest.end - longest.start)} from {datetime.fromtimestamp(longest.start).strftime('%a %H:%M')} "
+                     f"and peaking at {longest.peak:.2f}&deg;C<p>")
+    else:
+        lines.append("<p>Excursions above the warning temp: none<p>")
+    lines.append(f"<p>Logged readings missing because the probe could not be read: {report.errors}<p>")
+    return lines
+
+# Report section of the weekly email. started is when the monitoring software started and
+# upload_failures the number of failed uploads since upload_failures_since
+def weekly_report_html(rollups, probes, label, end, started, upload_failures, upload_failures_since):
+    lines = []
+    for probe in probes:
+        lines.extend(probe_report_html(probe_report(rollups, probe, end), label(probe)))
+    lines.append(f"<p>Monitoring software running for {format_days(end - started)}<p>")
+    uptime = system_uptime()
+    if uptime is not None:
+        lines.append(f"<p>Device running for {format_days(uptime)}<p>")
+    lines.append(f"<p>Failed uploads to InitialState since {datetime.fromtimestamp(upload_failures_since).strftime('%a %d %b %H:%M')}: {upload_failures}<p>")
+    return '\n            '.join(lines)
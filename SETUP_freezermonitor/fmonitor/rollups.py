@@ -0,0 +1,283 @@
+# Summaries of readings at 1 minute, 1 hour and 1 day resolution
+#
+# Every reading is added to the current 1 minute, 1 hour and 1 day bucket of its probe as it arrives,
+# so summaries never need the raw readings to be read again. A bucket keeps the number of readings and
+# of failed reads, the lowest, highest and mean temperature, the variance (using Welford's method) and
+# the number of seconds spent at or above each of WARNING_TEMP, ALERT_TEMP and PANIC_TEMP. Buckets start
+# on whole minutes, hours and days in UTC. When a bucket is over it is appended to
+# data/rollups/<resolution>-<year>-<month>.bin, one 56 byte record per bucket, and the buckets still
+# being filled are saved every STORE_SYNC_INTERVAL seconds so that a restart loses at most a few minutes
+# of them. A week of hourly summaries is 168 records per probe, and years of daily and hourly summaries
+# take a few MB.
+#
+# Excursions (stretches of time at or above WARNING_TEMP) are recorded in data/rollups/excursions.bin
+# when they end, with their start and end times and the highest temperature reached.
+
+import heapq
+import itertools
+import math
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+ROLLUP = struct.Struct('<dIIIffddfff')
+# The start and sensor id at the beginning of a record
+KEY = struct.Struct('<dI')
+OPEN_ROLLUP = struct.Struct('<B' + ROLLUP.format[1:])
+EXCURSION = struct.Struct('<Iddf')
+
+Excursion = namedtuple('Excursion', ['sensor_id', 'start', 'end', 'peak'])
+
+# seconds_warning, seconds_alert and seconds_panic are the seconds spent at or above each threshold
+class Bucket:
+    def __init__(self, start, sensor_id, count=0, errors=0, minimum=math.inf, maximum=-math.inf, mean=0.0, m2=0.0,
+                 seconds_warning=0.0, seconds_alert=0.0, seconds_panic=0.0):
+        self.start = start
+        self.sensor_id = sensor_id
+        self.count = count
+        self.errors = errors
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.m2 = m2
+        self.seconds_warning = seconds_warning
+        self.seconds_alert = seconds_alert
+        self.seconds_panic = seconds_panic
+
+    # level is the number of thresholds the reading is at or above (0 to 3), and gap the seconds it stands for
+    def add(self, value, level, gap):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        if level >= 1:
+            self.seconds_warning += gap
+        if level >= 2:
+            self.seconds_alert += gap
+        if level >= 3:
+            self.seconds_panic += gap
+
+    # Combine the readings of another bucket into this one
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.errors += other.errors
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.seconds_warning += other.seconds_warning
+        self.seconds_alert += other.seconds_alert
+        self.seconds_panic += other.seconds_panic
+
+    # Buckets are kept in order of start, then sensor id
+    def key(self):
+        return (self.start, self.sensor_id)
+
+    def variance(self):
+        return self.m2 / self.count if self.count else None
+
+    def pack(self):
+        return ROLLUP.pack(self.start, self.sensor_id, self.count, self.errors, self.minimum, self.maximum, self.mean, self.m2,
+                           self.seconds_warning, self.seconds_alert, self.seconds_panic)
+
+    @classmethod
+    def unpack(cls, record):
+        return cls(*record)
+
+class Rollups:
+    # max_gap caps the time counted for a single reading, so that time above WARNING_TEMP is not
+    # overstated after a pause in readings (e.g. a restart)
+    def __init__(self, directory, max_gap, writable=True):
+        self.directory = directory
+        self.max_gap = max_gap
+        self.writable = writable
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        # add() runs on the event loop while flush() runs on a worker thread
+        self.lock = threading.Lock()
+        self.open = {name: {} for name in RESOLUTIONS}
+        self.files = {}
+        self.last_timestamps = {}
+        # Excursions that have not ended yet, by sensor id
+        self.excursions = {}
+        self.open_path = os.path.join(directory, 'open')
+        self.excursions_path = os.path.join(directory, 'excursions.bin')
+        self.open_excursions_path = os.path.join(directory, 'open-excursions')
+        self.load_open()
+
+    def path(self, name, start):
+        year, month = time.gmtime(start)[:2]
+        return os.path.join(self.directory, f'{name}-{year:04d}-{month:02d}.bin')
+
+    # Add a reading. level is the number of thresholds it is at or above (0 to 3).
+    # A failed read (NaN) is only counted as an error
+    def add(self, timestamp, sensor_id, value, level):
+        gap = min(max(timestamp - self.last_timestamps.get(sensor_id, timestamp), 0.0), self.max_gap)
+        self.last_timestamps[sensor_id] = timestamp
+        with self.lock:
+            if not math.isnan(value):
+                self.track_excursion(timestamp, sensor_id, value, level)
+            for name, resolution in RESOLUTIONS.items():
+                start = timestamp - timestamp % resolution
+                bucket = self.open[name].get(sensor_id)
+                if bucket is None or bucket.start != start:
+                    if bucket is not None:
+                        self.write(name, bucket)
+                    bucket = self.open[name][sensor_id] = Bucket(start, sensor_id)
+                if math.isnan(value):
+                    bucket.errors += 1
+                else:
+                    bucket.add(value, level, gap)
+
+    def track_excursion(self, timestamp, sensor_id, value, level):
+        excursion = self.excursions.get(sensor_id)
+        if level >= 1:
+            if excursion is None:
+                self.excursions[sensor_id] = Excursion(sensor_id, timestamp, timestamp, value)
+            else:
+                self.excursions[sensor_id] = excursion._replace(end=timestamp, peak=max(excursion.peak, value))
+        elif excursion is not None:
+            del self.excursions[sensor_id]
+            with open(self.excursions_path, 'ab') as f:
+                f.write(EXCURSION.pack(*excursion._replace(end=timestamp)))
+
+    def write(self, name, bucket):
+        path = self.path(name, bucket.start)
+        f = self.files.get(name)
+        if f is None or f.name != path:
+            if f is not None:
+                f.close()
+            f = self.files[name] = open(path, 'ab')
+        f.write(bucket.pack())
+
+    # Write out finished buckets and save the ones still being filled
+    def flush(self):
+        with self.lock:
+            for f in self.files.values():
+                f.flush()
+                os.fsync(f.fileno())
+            data = b''.join(OPEN_ROLLUP.pack(index, *ROLLUP.unpack(bucket.pack()))
+                            for index, name in enumerate(RESOLUTIONS) for bucket in self.open[name].values())
+            excursions = b''.join(EXCURSION.pack(*excursion) for excursion in self.excursions.values())
+        self.replace_file(self.open_path, data)
+        self.replace_file(self.open_excursions_path, excursions)
+
+    @staticmethod
+    def replace_file(path, data):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def read_records(path, record_struct):
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            data = f.read()
+        return list(record_struct.iter_unpack(data[:len(data) - len(data) % record_struct.size]))
+
+    def load_open(self):
+        names = list(RESOLUTIONS)
+        for index, *record in self.read_records(self.open_path, OPEN_ROLLUP):
+            if index < len(names):
+                bucket = Bucket.unpack(record)
+                self.open[names[index]][bucket.sensor_id] = bucket
+        for record in self.read_records(self.open_excursions_path, EXCURSION):
+            excursion = Excursion(*record)
+            self.excursions[excursion.sensor_id] = excursion
+
+    # Excursions of a probe that overlap start <= time < end, oldest first, including one still going on
+    def query_excursions(self, start, end, sensor_id=None):
+        with self.lock:
+            ongoing = list(self.excursions.values())
+        found = [Excursion(*record) for record in self.read_records(self.excursions_path, EXCURSION)] + ongoing
+        return sorted(excursion for excursion in found
+                      if excursion.end >= start and excursion.start < end and (sensor_id is None or excursion.sensor_id == sensor_id))
+
+    # Buckets of one resolution with start <= bucket start < end, oldest first. Records for the same
+    # bucket (e.g. after the clock was set back) are merged
+    def query(self, name, start, end, sensor_id=None):
+        return list(self.iterate(name, start, end, sensor_id))
+
+    # The same, one monthly file at a time and without holding its buckets in memory, so that going through
+    # years of buckets takes no more memory than reading one of the files
+    def iterate(self, name, start, end, sensor_id=None):
+        first, last = self.path(name, start), self.path(name, end)
+        # Finished buckets may still be in the file buffer until the next flush()
+        with self.lock:
+            if name in self.files:
+                self.files[name].flush()
+            current = sorted((Bucket.unpack(ROLLUP.unpack(bucket.pack())) for bucket in self.open[name].values()), key=Bucket.key)
+        paths = [os.path.join(self.directory, filename) for filename in sorted(os.listdir(self.directory)) if filename.startswith(name + '-')]
+        for path in paths:
+            if not first <= path <= last:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            finished = (Bucket.unpack(ROLLUP.unpack_from(data, offset)) for offset in self.in_order(data, start, end, sensor_id))
+            opened = [bucket for bucket in current if self.path(name, bucket.start) == path]
+            yield from self.merged(heapq.merge(finished, opened, key=Bucket.key), start, end, sensor_id)
+        # Buckets still being filled in a month with none finished yet
+        yield from self.merged((bucket for bucket in current if self.path(name, bucket.start) not in paths), start, end, sensor_id)
+
+    # Offsets of the records of a monthly file for start <= bucket start < end, in order of start and sensor
+    # id. Buckets are written as they end, which is nearly always in that order, so they are only sorted
+    # when they are not
+    @staticmethod
+    def in_order(data, start, end, sensor_id):
+        offsets = []
+        for offset in range(0, len(data) - len(data) % ROLLUP.size, ROLLUP.size):
+            bucket_start, bucket_sensor = KEY.unpack_from(data, offset)
+            if start <= bucket_start < end and (sensor_id is None or bucket_sensor == sensor_id):
+                offsets.append(offset)
+        keys = map(KEY.unpack_from, itertools.repeat(data), offsets)
+        following = map(KEY.unpack_from, itertools.repeat(data), offsets[1:])
+        if not all(key <= next_key for key, next_key in zip(keys, following)):
+            offsets.sort(key=lambda offset: KEY.unpack_from(data, offset))
+        return offsets
+
+    # Buckets in order with those for the same start and probe merged, for start <= bucket start < end
+    @staticmethod
+    def merged(buckets, start, end, sensor_id):
+        previous = None
+        for bucket in buckets:
+            if not start <= bucket.start < end or (sensor_id is not None and bucket.sensor_id != sensor_id):
+                continue
+            if previous is not None and previous.key() == bucket.key():
+                previous.merge(bucket)
+                continue
+            if previous is not None:
+                yield previous
+            previous = bucket
+        if previous is not None:
+            yield previous
+
+    # One bucket combining everything for a probe between start and end
+    def summary(self, name, start, end, sensor_id):
+        total = Bucket(start, sensor_id)
+        for bucket in self.query(name, start, end, sensor_id):
+            total.merge(bucket)
+        return total
+
+    # Delete the monthly files of one resolution that only hold buckets from before the given time
+    def expire(self, name, before):
+        cutoff = self.path(name, before)
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.startswith(name + '-') and path < cutoff:
+                with self.lock:
+                    f = self.files.get(name)
+                    if f is not None and f.name == path:
+                        f.close()
+                        del self.files[name]
+                    os.remove(path)
@@ -0,0 +1,62 @@
+# Adaptive sampling rate
+#
+# A freezer that has sat at -80°C for months does not need reading, storing and uploading every few
+# seconds. When SLOW_SECONDS_BETWEEN_READINGS is set, the monitor drops to a slow rate while every probe
+# is steady and well below its WARNING_TEMP: the probes are read every SLOW_SECONDS_BETWEEN_SAMPLES
+# seconds, readings are stored and queued every SLOW_SECONDS_BETWEEN_READINGS seconds and uploads are
+# sent every SLOW_UPLOAD_INTERVAL seconds. That means fewer SPI transfers, less CPU and network use and
+# less data on the dashboard.
+#
+# A probe is steady when, over the last TREND_WINDOW seconds, its temperature has changed by no more than
+# STABLE_TREND degrees per hour and scattered around that trend by no more than STABLE_DEVIATION degrees,
+# and its raw and filtered readings are both at least STABLE_MARGIN degrees below its WARNING_TEMP. The raw
+# reading is checked so that a sudden warming is caught on the first sample, before it gets through the
+# rolling median. The monitor only slows down once every probe has been steady for STABLE_TIME seconds,
+# and goes back to the fast rate on the first sample where any probe is not: one that is warming, noisy or
+# close to a threshold, in an alarm or predicted to reach ALERT_TEMP, or could not be read.
+
+from .alarms import NORMAL
+
+FAST = 'fast'
+SLOW = 'slow'
+
+def is_steady(probe, raw, temperature, settings):
+    if probe.alarm.state != NORMAL or probe.alarm.predicted:
+        return False
+    limit = probe.warning_temp - settings.STABLE_MARGIN
+    if raw > limit or temperature > limit:
+        return False
+    if probe.trend.span() < settings.TREND_WINDOW / 2:
+        return False
+    slope = probe.trend.slope()
+    deviation = probe.trend.deviation()
+    if slope is None or deviation is None:
+        return False
+    return abs(slope) * 3600 <= settings.STABLE_TREND and deviation <= settings.STABLE_DEVIATION
+
+class SamplingRate:
+    def __init__(self):
+        self.mode = FAST
+        # When every probe became steady, None while any probe is not
+        self.steady_since = None
+
+    # Seconds between samples, between reported readings and between uploads at the current rate
+    def intervals(self, settings):
+        if self.mode == SLOW:
+            return settings.SLOW_SECONDS_BETWEEN_SAMPLES, settings.SLOW_SECONDS_BETWEEN_READINGS, settings.SLOW_UPLOAD_INTERVAL
+        return settings.SECONDS_BETWEEN_SAMPLES, settings.SECONDS_BETWEEN_READINGS, settings.UPLOAD_INTERVAL
+
+    # Pick the rate after a sample. steady is True if every probe was steady. Returns the new rate if it
+    # changed, otherwise None
+    def update(self, steady, now, settings):
+        if not steady or not settings.SLOW_SECONDS_BETWEEN_READINGS:
+            self.steady_since = None
+            mode = FAST
+        else:
+            if self.steady_since is None:
+                self.steady_since = now
+            mode = SLOW if now - self.steady_since >= settings.STABLE_TIME else self.mode
+        if mode == self.mode:
+            return None
+        self.mode = mode
+        return mode
@@ -0,0 +1,108 @@
+# Job scheduler
+
+import asyncio
+import inspect
+import time
+from datetime import datetime, timedelta
+
+from .eventlog import get_logger
+from .metrics import Histogram
+
+error_log = get_logger('unexpected')
+lateness_seconds = Histogram('fmonitor_scheduler_lateness_seconds', "Seconds a job started after it was due", ['job'])
+
+# Runs jobs at fixed intervals measured on the monotonic clock, so the time between readings does not
+# drift with the time spent doing work and is not thrown off by changes to the system clock.
+# Every job runs as its own asyncio task and sleeps until it is next due, so a slow upload or email
+# never delays a reading. If a job falls more than one interval behind, the missed ticks are skipped
+# rather than run back to back. Jobs without a fixed interval return the number of seconds until they
+# next need to run. Jobs may be plain functions or coroutines.
+class ScheduledJob:
+    def __init__(self, name, func, interval, due):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.due = due
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+            'mean_lateness': self.total_lateness / self.runs if self.runs else 0.0,
+        }
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+
+    # interval=None means func returns the delay in seconds before it should run again
+    def add(self, name, func, interval=None, delay=0.0):
+        self.jobs.append(ScheduledJob(name, func, interval, time.monotonic() + delay))
+
+    def stats(self):
+        return {job.name: job.stats() for job in self.jobs}
+
+    # Change how often a job runs, counting from when it is next due. A job that changes its own
+    # interval while running is next due one new interval after the current run was due
+    def set_interval(self, name, interval):
+        for job in self.jobs:
+            if job.name == name and job.interval != interval:
+                if not job.running:
+                    job.due += interval - job.interval
+                job.interval = interval
+
+    async def run_job(self, job):
+        now = time.monotonic()
+        lateness = now - job.due
+        job.runs += 1
+        job.last_lateness = lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job.total_lateness += lateness
+        lateness_seconds.observe(lateness, job=job.name)
+        next_delay = None
+        job.running = True
+        try:
+            next_delay = job.func()
+            if inspect.isawaitable(next_delay):
+                next_delay = await next_delay
+        except Exception as e:
+            error_log.error(f"Unexpected error in '{job.name}': {str(e)}", extra={'event': 'job_failed', 'fields': {'job': job.name}})
+        finally:
+            job.running = False
+        if job.interval is None:
+            job.due = time.monotonic() + (next_delay if next_delay is not None else 60.0)
+            return
+        job.due += job.interval
+        behind = time.monotonic() - job.due
+        if behind >= 0:
+            missed = int(behind // job.interval) + 1
+            job.skipped += missed
+            job.due += missed * job.interval
+
+    async def run_forever(self, job):
+        while True:
+            delay = job.due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self.run_job(job)
+
+    async def run(self):
+        await asyncio.gather(*(asyncio.create_task(self.run_forever(job), name=job.name) for job in self.jobs))
+
+# Seconds until the next weekly update window opens. The wait is capped at an hour so that a
+# wall-clock jump (e.g. NTP setting the clock after boot on a Pi without an RTC) is picked up
+def seconds_until_weekly_update():
+    current_time = datetime.now()
+    window = current_time.replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=-current_time.weekday())
+    if current_time >= window + timedelta(minutes=10):
+        window += timedelta(days=7)
+    return min(max((window - current_time).total_seconds(), 0.0), 3600.0)
@@ -0,0 +1,257 @@
+# Temperature sensor backends
+#
+# Every probe is read through a Sensor. A read is split in two so that several probes can convert
+# at the same time: start_conversion() starts a measurement and read_temperature() returns it once
+# conversion_time seconds have passed. Backends that measure instantly have a conversion_time of 0.
+#
+#   max31865   - a MAX31865 board with a platinum RTD on the SPI bus (the default)
+#   simulated  - a synthetic temperature profile, for testing without hardware
+#   replay     - readings recorded earlier, from a CSV file or the local reading store
+#
+# The backend is chosen with BACKEND in the probe's config section; see config.ini for the options.
+# A read that fails raises an exception. A fault the sensor itself reports, such as a broken wire,
+# raises SensorFault with the kind of fault.
+
+import csv
+import math
+import random
+import time
+
+# Kinds of sensor fault with the description used in logs and emails. The first three are reported by
+# the MAX31865, the others are found by the acquisition thread (see acquisition.py)
+FAULTS = {
+    'open': "open RTD or broken wire",
+    'short': "shorted RTD",
+    'voltage': "over or under voltage on the sensor inputs",
+    'read_error': "the sensor could not be read",
+    'timeout': "the sensor did not answer in time",
+    'implausible': "impossible temperature reading",
+    'stuck': "the reading has stopped changing",
+}
+
+class SensorFault(Exception):
+    def __init__(self, kind, detail):
+        super().__init__(detail)
+        self.kind = kind
+
+class Sensor:
+    conversion_time = 0.0
+
+    def start_conversion(self):
+        pass
+
+    def read_temperature(self):
+        raise NotImplementedError
+
+    # Release the hardware, e.g. before the sensor is opened again with new settings
+    def close(self):
+        pass
+
+## ----- MAX31865 ----- ##
+
+# The Blinka libraries are only imported when a board is actually used, so the rest of the
+# package works on machines without them. All boards share one SPI bus
+spi_bus = None
+
+def open_spi_bus():
+    global spi_bus
+    if spi_bus is None:
+        import board
+        spi_bus = board.SPI()
+    return spi_bus
+
+class MAX31865Sensor(Sensor):
+    def __init__(self, cs_pin, wires):
+        import board
+        import digitalio
+        import adafruit_max31865
+        self.cs = digitalio.DigitalInOut(getattr(board, cs_pin))
+        self.device = adafruit_max31865.MAX31865(open_spi_bus(), self.cs, wires=wires)
+        # Older versions of the driver only offer blocking reads
+        self.non_blocking = hasattr(self.device, 'initiate_one_shot_measurement') and hasattr(self.device, 'unblocking_temperature')
+        self.conversion_time = 0.065 if self.non_blocking else 0.0
+
+    def start_conversion(self):
+        if self.non_blocking:
+            self.device.initiate_one_shot_measurement()
+
+    def read_temperature(self):
+        if self.non_blocking:
+            temperature = self.device.unblocking_temperature
+        else:
+            temperature = self.device.temperature
+        self.check_faults()
+        return temperature
+
+    # Read the fault status register and raise SensorFault if any fault is set. The driver returns the
+    # bits as (RTD high threshold, RTD low threshold, REFIN- > 0.85 x VBIAS, REFIN- < 0.85 x VBIAS with
+    # FORCE- open, RTDIN- < 0.85 x VBIAS with FORCE- open, over or under voltage). The thresholds are
+    # left at their power-on values, so the high threshold is only reached by an open RTD and the low
+    # one by a short. The faults are cleared so that the next read starts afresh
+    def check_faults(self):
+        high, low, refin_high, refin_low, rtdin_low, voltage = self.device.fault
+        if not (high or low or refin_high or refin_low or rtdin_low or voltage):
+            return
+        self.device.clear_faults()
+        if voltage:
+            raise SensorFault('voltage', "MAX31865 over or under voltage fault")
+        if low:
+            raise SensorFault('short', "MAX31865 RTD low threshold fault")
+        names = [name for name, bit in (("RTD high threshold", high), ("REFIN- high", refin_high), ("REFIN- low", refin_low),
+                                        ("RTDIN- low", rtdin_low)) if bit]
+        raise SensorFault('open', f"MAX31865 {', '.join(names)} fault")
+
+    def close(self):
+        self.cs.deinit()
+
+## ----- Simulated probes ----- ##
+
+# Synthetic temperature profiles. Each returns a function of the seconds since the probe started
+def steady_profile(base):
+    return lambda elapsed: base
+
+# Temperature changing at a constant rate (degrees C per hour)
+def ramp_profile(base, rate):
+    return lambda elapsed: base + rate * elapsed / 3600
+
+# A short rise every period seconds, as when the freezer door is opened and shut again
+def door_profile(base, period, duration, rise):
+    def profile(elapsed):
+        into_period = elapsed % period
+        if into_period < duration:
+            return base + rise * math.sin(math.pi * into_period / duration)
+        return base
+    return profile
+
+# Steady until the compressor fails after start seconds, then warming towards the room temperature
+# with the given time constant (seconds)
+def compressor_failure_profile(base, start, ambient, time_constant):
+    def profile(elapsed):
+        if elapsed < start:
+            return base
+        return ambient - (ambient - base) * math.exp(-(elapsed - start) / time_constant)
+    return profile
+
+PROFILES = {
+    'steady': lambda options, base: steady_profile(base),
+    'ramp': lambda options, base: ramp_profile(base, options.getfloat('RAMP_RATE', 1.0)),
+    'door': lambda options, base: door_profile(base, options.getfloat('DOOR_PERIOD', 3600), options.getfloat('DOOR_DURATION', 60),
+                                               options.getfloat('DOOR_RISE', 10.0)),
+    'compressor_failure': lambda options, base: compressor_failure_profile(base, options.getfloat('FAILURE_START', 600),
+                                                                           options.getfloat('AMBIENT_TEMP', 22.0),
+                                                                           options.getfloat('WARMING_TIME', 7200)),
+}
+
+# Reads a profile with optional gaussian noise. By default the profile follows the clock. With a
+# time_step every read advances the profile by that many seconds instead, so hours of simulated
+# readings can be produced as fast as they are requested. fault_rate is the chance a read fails
+class SimulatedSensor(Sensor):
+    def __init__(self, profile, noise=0.0, time_step=None, fault_rate=0.0, seed=None):
+        self.profile = profile
+        self.noise = noise
+        self.time_step = time_step
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def read_temperature(self):
+        if self.time_step is None:
+            elapsed = time.monotonic() - self.started
+        else:
+            elapsed = self.elapsed
+            self.elapsed += self.time_step
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            raise RuntimeError("simulated sensor fault")
+        temperature = self.profile(elapsed)
+        if self.noise:
+            temperature += self.random.gauss(0.0, self.noise)
+        return temperature
+
+## ----- Replayed readings ----- ##
+
+# Feeds back recorded temperatures one per read, starting over at the end if loop is set.
+# Readings recorded as failed (NaN) fail again when replayed
+class ReplaySensor(Sensor):
+    def __init__(self, temperatures, loop=True):
+        if not temperatures:
+            raise ValueError("No readings to replay")
+        self.temperatures = temperatures
+        self.loop = loop
+        self.position = 0
+
+    def read_temperature(self):
+        if self.position >= len(self.temperatures):
+            if not self.loop:
+                raise EOFError("replay finished")
+            self.position = 0
+        temperature = self.temperatures[self.position]
+        self.position += 1
+        if math.isnan(temperature):
+            raise RuntimeError("recorded reading failed")
+        return temperature
+
+# Temperatures from a CSV file with the temperature in the last column. Other columns (such as a
+# timestamp) and a header line are ignored
+def read_replay_csv(path):
+    temperatures = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            try:
+                temperatures.append(float(row[-1]))
+            except ValueError:
+                continue
+    return temperatures
+
+# Temperatures of one probe from the local reading store, oldest first
+def read_replay_store(directory, sensor_id, start=0.0, end=math.inf):
+    from .storage import ReadingStore
+    return [value for _, _, value, _ in ReadingStore(directory, writable=False).query(start, end, sensor_id)]
+
+## ----- Creating sensors from config.ini ----- ##
+
+# A simulated sensor for a probe's config section, using the named profile
+def simulated_sensor(options, profile):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown PROFILE '{profile}', expected one of {', '.join(PROFILES)}")
+    return SimulatedSensor(PROFILES[profile](options, options.getfloat('BASE_TEMP', -80.0)), options.getfloat('NOISE', 0.05),
+                           options.getfloat('TIME_STEP', None), options.getfloat('FAULT_RATE', 0.0))
+
+def create_sensor(probe):
+    options = probe.options
+    if probe.backend == 'max31865':
+        return MAX31865Sensor(probe.cs_pin, probe.wires)
+    if probe.backend == 'simulated':
+        return simulated_sensor(options, options.get('PROFILE', 'steady'))
+    if probe.backend == 'replay':
+        path = options.get('REPLAY_FILE', 'data/readings')
+        if path.endswith('.csv'):
+            temperatures = read_replay_csv(path)
+        else:
+            temperatures = read_replay_store(path, options.getint('REPLAY_SENSOR_ID', probe.sensor_id))
+        return ReplaySensor(temperatures, options.getboolean('REPLAY_LOOP', True))
+    raise ValueError(f"Unknown BACKEND '{probe.backend}' for {probe.name}, expected max31865, simulated or replay")
+
+# Read every sensor in one pass. All sensors start converting together and are read after a single
+# conversion time, so a pass takes about as long for several probes as for one.
+# Returns a temperature or the exception for each sensor, in order
+def read_sensors(sensors):
+    results = [None] * len(sensors)
+    converting = []
+    for i, sensor in enumerate(sensors):
+        try:
+            sensor.start_conversion()
+            converting.append(i)
+        except Exception as e:
+            results[i] = e
+    wait = max((sensors[i].conversion_time for i in converting), default=0.0)
+    if wait > 0:
+        time.sleep(wait)
+    for i in converting:
+        try:
+            results[i] = sensors[i].read_temperature()
+        except Exception as e:
+            results[i] = e
+    return results
@@ -0,0 +1,329 @@
+# Reads settings from config.ini
+#
+# Settings are read into a Settings object. Every value keeps the name it has in config.ini.
+# Optional settings fall back to the defaults documented in config.ini, so older config files keep working.
+# Settings objects cannot be changed once read: when config.ini is edited, the monitor reads it into a
+# new Settings object and swaps that in, so no part of the monitor ever sees a half-updated mix.
+
+import configparser
+import ipaddress
+
+expected_params = {
+    'DeviceSettings': ['HOSTNAME','DEVICE_LOCATION_NAME'],
+    'NetworkSettings': ['WirelessInterface'],
+    'EmailSettings': ['admin_email_list', 'email_list', 'gmail_account', 'gmail_password'],
+    'EmailCustomText': [
+        'CUSTOM_BOOT_MESSAGE_LINE_1','CUSTOM_BOOT_MESSAGE_LINE_2','CUSTOM_BOOT_MESSAGE_LINE_3',
+        'CUSTOM_WEEKLY_MESSAGE_LINE_1','CUSTOM_WEEKLY_MESSAGE_LINE_2','CUSTOM_WEEKLY_MESSAGE_LINE_3',
+        'CUSTOM_WARNING_MESSAGE_LINE_1','CUSTOM_WARNING_MESSAGE_LINE_2','CUSTOM_WARNING_MESSAGE_LINE_3',
+        'CUSTOM_ALERT_MESSAGE_LINE_1','CUSTOM_ALERT_MESSAGE_LINE_2','CUSTOM_ALERT_MESSAGE_LINE_3',
+        'CUSTOM_PANIC_MESSAGE_LINE_1','CUSTOM_PANIC_MESSAGE_LINE_2','CUSTOM_PANIC_MESSAGE_LINE_3'
+    ],
+    'AlarmThresholds': ['WARNING_TEMP', 'ALERT_TEMP', 'PANIC_TEMP', 'RESET_TEMP', 'SECONDS_BETWEEN_READINGS'],
+    'RTDSetup': ['CSBoardLocation', 'SensorWires'],
+    'InitialState': ['SENSOR_LOCATION_NAME', 'BUCKET_NAME', 'BUCKET_KEY', 'ACCESS_KEY', 'SHARE_LINK'],
+}
+
+# Check that all parameters are present in config.ini
+# [RTDSetup] is only needed when no [Sensor:...] sections are defined
+def validate_config_params(config):
+    has_sensor_sections = any(section.startswith('Sensor:') for section in config.sections())
+    for section, params in expected_params.items():
+        if section == 'RTDSetup' and has_sensor_sections:
+            continue
+        if section not in config:
+            raise ValueError(f"Missing section '[{section}]' in config.ini")
+        for param in params:
+            if param not in config[section]:
+                raise ValueError(f"Missing parameter '{param}' in section '{section}' of config.ini")
+
+class ReadOnly:
+    def __setattr__(self, name, value):
+        if self.__dict__.get('read_only'):
+            raise AttributeError(f"{type(self).__name__} cannot be changed once read, load config.ini again instead")
+        super().__setattr__(name, value)
+
+# Groups of settings shared by the monitor's Settings and the collector's CollectorSettings
+class BaseSettings(ReadOnly):
+    # Get the account and mail server settings used to send email
+    def read_smtp_settings(self, config):
+        self.gmail_account = config.get('EmailSettings', 'gmail_account')
+        self.gmail_password = config.get('EmailSettings', 'gmail_password')
+        self.SMTP_SERVER = config.get('EmailSettings', 'SMTP_SERVER', fallback='smtp.gmail.com')
+        self.SMTP_PORT = config.getint('EmailSettings', 'SMTP_PORT', fallback=465)
+        self.SMTP_SECURITY = config.get('EmailSettings', 'SMTP_SECURITY', fallback='ssl')
+        if self.SMTP_SECURITY not in ('ssl', 'starttls', 'none'):
+            raise ValueError("SMTP_SECURITY in config.ini must be ssl, starttls or none")
+        self.SMTP_TIMEOUT = config.getint('EmailSettings', 'SMTP_TIMEOUT', fallback=30)
+        self.SMTP_NOOP_AFTER = config.getint('EmailSettings', 'SMTP_NOOP_AFTER', fallback=30)
+        self.SMTP_IDLE_TIMEOUT = config.getint('EmailSettings', 'SMTP_IDLE_TIMEOUT', fallback=240)
+
+    # Get notification delivery settings (optional section, defaults are used if missing)
+    def read_notification_settings(self, config):
+        self.NOTIFICATION_QUEUE_SIZE = config.getint('Notifications', 'NOTIFICATION_QUEUE_SIZE', fallback=20)
+        self.NOTIFICATION_MAX_ATTEMPTS = config.getint('Notifications', 'NOTIFICATION_MAX_ATTEMPTS', fallback=10)
+        self.NOTIFICATION_RETRY_DELAY = config.getint('Notifications', 'NOTIFICATION_RETRY_DELAY', fallback=30)
+        self.NOTIFICATION_MAX_RETRY_DELAY = config.getint('Notifications', 'NOTIFICATION_MAX_RETRY_DELAY', fallback=600)
+        self.NOTIFICATION_MAX_AGE = config.getint('Notifications', 'NOTIFICATION_MAX_AGE', fallback=21600)
+        self.NOTIFICATION_COALESCE_WINDOW = config.getfloat('Notifications', 'NOTIFICATION_COALESCE_WINDOW', fallback=5)
+        self.NOTIFICATION_TIMEOUT = config.getint('Notifications', 'NOTIFICATION_TIMEOUT', fallback=120)
+        # Connecting, logging in and sending can each take up to SMTP_TIMEOUT seconds. A send given up on
+        # before then would still be running when the email is tried again
+        if self.NOTIFICATION_TIMEOUT <= 3 * self.SMTP_TIMEOUT:
+            raise ValueError(f"NOTIFICATION_TIMEOUT in config.ini must be more than 3 times SMTP_TIMEOUT (over {3 * self.SMTP_TIMEOUT} seconds)")
+
+    # Get Initial State upload settings (the bucket and keys are read separately)
+    def read_upload_settings(self, config):
+        self.API_URL = config.get('InitialState', 'API_URL', fallback='https://groker.init.st/api')
+        self.UPLOAD_INTERVAL = config.getint('InitialState', 'UPLOAD_INTERVAL', fallback=60)
+        self.UPLOAD_BATCH_SIZE = config.getint('InitialState', 'UPLOAD_BATCH_SIZE', fallback=500)
+        self.UPLOAD_MAX_BATCHES = config.getint('InitialState', 'UPLOAD_MAX_BATCHES', fallback=5)
+        self.UPLOAD_TIMEOUT = config.getint('InitialState', 'UPLOAD_TIMEOUT', fallback=20)
+
+    # Get logging settings (optional section, defaults are used if missing)
+    def read_logging_settings(self, config):
+        self.LOG_FLUSH_INTERVAL = config.getfloat('Logging', 'LOG_FLUSH_INTERVAL', fallback=10)
+        self.LOG_BUFFER_RECORDS = config.getint('Logging', 'LOG_BUFFER_RECORDS', fallback=200)
+        self.LOG_MAX_FILE_BYTES = config.getint('Logging', 'LOG_MAX_FILE_BYTES', fallback=1048576)
+        self.LOG_MAX_FILE_AGE_HOURS = config.getfloat('Logging', 'LOG_MAX_FILE_AGE_HOURS', fallback=24)
+        self.LOG_BACKUP_COUNT = config.getint('Logging', 'LOG_BACKUP_COUNT', fallback=30)
+        self.LOG_RATE_LIMIT = config.getint('Logging', 'LOG_RATE_LIMIT', fallback=5)
+        self.LOG_RATE_WINDOW = config.getfloat('Logging', 'LOG_RATE_WINDOW', fallback=600)
+
+# Probe options that can change without opening the sensor again
+PROBE_KEYS = {'name', 'sensor_id', 'warning_temp', 'alert_temp', 'panic_temp', 'reset_temp', 'stream_key'}
+
+# Settings for one temperature probe. BACKEND selects how it is read (see sensors.py), and
+# options holds the probe's config section for backend-specific settings
+class ProbeSettings(ReadOnly):
+    def __init__(self, name, sensor_id, backend, cs_pin, wires, warning_temp, alert_temp, panic_temp, reset_temp, stream_key, options):
+        self.name = name
+        self.sensor_id = sensor_id
+        self.backend = backend
+        self.cs_pin = cs_pin
+        self.wires = wires
+        self.warning_temp = warning_temp
+        self.alert_temp = alert_temp
+        self.panic_temp = panic_temp
+        self.reset_temp = reset_temp
+        self.stream_key = stream_key
+        self.options = options
+        # Everything that decides how the sensor is opened, to tell whether it must be opened again after a reload
+        backend_options = sorted((key, value) for key, value in options.parser.items(options.name, raw=True) if key not in PROBE_KEYS)
+        self.hardware = (backend, cs_pin, wires, tuple(backend_options))
+        self.read_only = True
+
+class Settings(BaseSettings):
+    def __init__(self, config):
+        validate_config_params(config)
+
+        # Raw values of every section, to tell which sections changed when config.ini is read again
+        self.sections = {name: dict(config.items(name, raw=True)) for name in config.sections()}
+
+        # Get device location from config.ini
+        self.HOSTNAME = config.get('DeviceSettings', 'HOSTNAME')
+        self.DEVICE_LOCATION_NAME = config.get('DeviceSettings', 'DEVICE_LOCATION_NAME')
+        self.HEALTH_CHECK_INTERVAL = config.getint('DeviceSettings', 'HEALTH_CHECK_INTERVAL', fallback=3600)
+        self.CONFIG_CHECK_INTERVAL = config.getfloat('DeviceSettings', 'CONFIG_CHECK_INTERVAL', fallback=10)
+        self.SENSOR_TIMEOUT = config.getfloat('DeviceSettings', 'SENSOR_TIMEOUT', fallback=5)
+        self.RECENT_WINDOW = config.getint('DeviceSettings', 'RECENT_WINDOW', fallback=3600)
+
+        # Get network settings from config.ini
+        self.WIRELESS_INTERFACE = config.get('NetworkSettings', 'WirelessInterface').strip()
+        self.NETWORK_INFO_INTERVAL = config.getint('NetworkSettings', 'NETWORK_INFO_INTERVAL', fallback=60)
+        self.NETWORK_TIMEOUT = config.getint('NetworkSettings', 'NETWORK_TIMEOUT', fallback=10)
+        self.IP_ADDRESS_TTL = config.getint('NetworkSettings', 'IP_ADDRESS_TTL', fallback=3600)
+
+        # Get email settings from config.ini
+        self.admin_email_list = config.get('EmailSettings', 'admin_email_list').split(',')
+        self.email_list = config.get('EmailSettings', 'email_list').split(',')
+        self.read_smtp_settings(config)
+
+        # Get custom message text from config.ini (up to 3 lines each)
+        self.CUSTOM_BOOT_MESSAGE_LINES = self.custom_lines(config, 'BOOT')
+        self.CUSTOM_WEEKLY_MESSAGE_LINES = self.custom_lines(config, 'WEEKLY')
+        self.CUSTOM_WARNING_MESSAGE_LINES = self.custom_lines(config, 'WARNING')
+        self.CUSTOM_ALERT_MESSAGE_LINES = self.custom_lines(config, 'ALERT')
+        self.CUSTOM_PANIC_MESSAGE_LINES = self.custom_lines(config, 'PANIC')
+
+        # Get temperature thresholds from config.ini
+        self.WARNING_TEMP = config.getfloat('AlarmThresholds', 'WARNING_TEMP')
+        self.ALERT_TEMP = config.getfloat('AlarmThresholds', 'ALERT_TEMP')
+        self.PANIC_TEMP = config.getfloat('AlarmThresholds', 'PANIC_TEMP')
+        self.RESET_TEMP = config.getfloat('AlarmThresholds', 'RESET_TEMP')
+        self.SECONDS_BETWEEN_READINGS = config.getfloat('AlarmThresholds', 'SECONDS_BETWEEN_READINGS')
+        self.ALARM_HYSTERESIS = config.getfloat('AlarmThresholds', 'ALARM_HYSTERESIS', fallback=0.5)
+        self.ALARM_RENOTIFY_INTERVAL = config.getfloat('AlarmThresholds', 'ALARM_RENOTIFY_INTERVAL', fallback=0)
+        self.ALARM_RECOVERY_NOTIFICATION = config.getboolean('AlarmThresholds', 'ALARM_RECOVERY_NOTIFICATION', fallback=True)
+        self.ALARM_CLEAR_TIME = config.getfloat('AlarmThresholds', 'ALARM_CLEAR_TIME', fallback=3600)
+
+        # Get sampling and filtering settings from config.ini (optional section, by default every reading is reported unfiltered)
+        self.SECONDS_BETWEEN_SAMPLES = min(config.getfloat('Filtering', 'SECONDS_BETWEEN_SAMPLES', fallback=self.SECONDS_BETWEEN_READINGS),
+                                           self.SECONDS_BETWEEN_READINGS)
+        self.MEDIAN_SAMPLES = config.getint('Filtering', 'MEDIAN_SAMPLES', fallback=1)
+        self.EMA_TIME_CONSTANT = config.getfloat('Filtering', 'EMA_TIME_CONSTANT', fallback=0)
+        self.ALARM_HOLD_TIME = config.getfloat('Filtering', 'ALARM_HOLD_TIME', fallback=0)
+
+        # Get sensor fault settings from config.ini (optional section, defaults are used if missing)
+        self.SENSOR_FAULT_TIME = config.getfloat('SensorFaults', 'SENSOR_FAULT_TIME', fallback=30)
+        self.SENSOR_MIN_TEMP = config.getfloat('SensorFaults', 'SENSOR_MIN_TEMP', fallback=-200)
+        self.SENSOR_MAX_TEMP = config.getfloat('SensorFaults', 'SENSOR_MAX_TEMP', fallback=100)
+        self.STUCK_TIME = config.getfloat('SensorFaults', 'STUCK_TIME', fallback=1800)
+
+        # Get trend settings from config.ini (optional section, predicted breach notifications are off if missing)
+        self.TREND_WINDOW = config.getfloat('Trend', 'TREND_WINDOW', fallback=1800)
+        self.PREDICTION_HORIZON = config.getfloat('Trend', 'PREDICTION_HORIZON', fallback=0)
+
+        # Get notification delivery settings from config.ini
+        self.read_notification_settings(config)
+        self.BOOT_MESSAGE_MIN_INTERVAL = config.getint('Notifications', 'BOOT_MESSAGE_MIN_INTERVAL', fallback=900)
+        self.BOOT_MESSAGE_DELAY = config.getfloat('Notifications', 'BOOT_MESSAGE_DELAY', fallback=30)
+
+        # Get InitialState settings from config.ini
+        self.SENSOR_LOCATION_NAME = config.get('InitialState', 'SENSOR_LOCATION_NAME')
+        self.BUCKET_NAME = config.get('InitialState', 'BUCKET_NAME')
+        self.BUCKET_KEY = config.get('InitialState', 'BUCKET_KEY')
+        self.ACCESS_KEY = config.get('InitialState', 'ACCESS_KEY')
+        self.SHARE_LINK = config.get('InitialState', 'SHARE_LINK')
+        self.read_upload_settings(config)
+
+        # Get fleet collector settings from config.ini (optional section, the collector is not used if missing)
+        self.COLLECTOR_URL = config.get('Collector', 'COLLECTOR_URL', fallback='').strip()
+        self.COLLECTOR_TOKEN = config.get('Collector', 'COLLECTOR_TOKEN', fallback='')
+        self.NODE_NAME = config.get('Collector', 'NODE_NAME', fallback='').strip() or self.HOSTNAME
+
+        # Get adaptive sampling settings from config.ini (optional section, the rate is fixed if missing)
+        self.SLOW_SECONDS_BETWEEN_READINGS = config.getfloat('AdaptiveSampling', 'SLOW_SECONDS_BETWEEN_READINGS', fallback=0)
+        if self.SLOW_SECONDS_BETWEEN_READINGS > 0:
+            self.SLOW_SECONDS_BETWEEN_READINGS = max(self.SLOW_SECONDS_BETWEEN_READINGS, self.SECONDS_BETWEEN_READINGS)
+            self.SLOW_SECONDS_BETWEEN_SAMPLES = min(max(config.getfloat('AdaptiveSampling', 'SLOW_SECONDS_BETWEEN_SAMPLES', fallback=self.SLOW_SECONDS_BETWEEN_READINGS),
+                                                        self.SECONDS_BETWEEN_SAMPLES), self.SLOW_SECONDS_BETWEEN_READINGS)
+            self.SLOW_UPLOAD_INTERVAL = max(config.getint('AdaptiveSampling', 'SLOW_UPLOAD_INTERVAL', fallback=self.UPLOAD_INTERVAL), self.UPLOAD_INTERVAL)
+        else:
+            self.SLOW_SECONDS_BETWEEN_READINGS = 0
+            self.SLOW_SECONDS_BETWEEN_SAMPLES = self.SECONDS_BETWEEN_SAMPLES
+            self.SLOW_UPLOAD_INTERVAL = self.UPLOAD_INTERVAL
+        self.STABLE_MARGIN = config.getfloat('AdaptiveSampling', 'STABLE_MARGIN', fallback=10)
+        self.STABLE_TREND = config.getfloat('AdaptiveSampling', 'STABLE_TREND', fallback=0.5)
+        self.STABLE_DEVIATION = config.getfloat('AdaptiveSampling', 'STABLE_DEVIATION', fallback=0.3)
+        self.STABLE_TIME = config.getfloat('AdaptiveSampling', 'STABLE_TIME', fallback=900)
+
+        # Get local data storage settings from config.ini (optional section, defaults are used if missing)
+        self.STORE_SYNC_INTERVAL = config.getint('DataStorage', 'STORE_SYNC_INTERVAL', fallback=300)
+        self.RAW_RETENTION_DAYS = config.getfloat('DataStorage', 'RAW_RETENTION_DAYS', fallback=0)
+        self.MINUTE_ROLLUP_RETENTION_DAYS = config.getfloat('DataStorage', 'MINUTE_ROLLUP_RETENTION_DAYS', fallback=0)
+        self.ARCHIVE_AFTER_DAYS = config.getfloat('DataStorage', 'ARCHIVE_AFTER_DAYS', fallback=0)
+        self.ARCHIVE_RETENTION_DAYS = config.getfloat('DataStorage', 'ARCHIVE_RETENTION_DAYS', fallback=0)
+
+        # Get logging settings from config.ini
+        self.read_logging_settings(config)
+
+        # Get metrics settings from config.ini (optional section, the endpoint is off if missing)
+        self.METRICS_PORT = config.getint('Metrics', 'METRICS_PORT', fallback=0)
+        self.METRICS_ADDRESS = config.get('Metrics', 'METRICS_ADDRESS', fallback='127.0.0.1')
+
+        # Get RTD sensor settings from config.ini
+        self.probes = self.load_probes(config)
+        self.read_only = True
+
+    # Names of the sections that differ between these settings and others
+    def changed_sections(self, other):
+        return {name for name in set(self.sections) | set(other.sections) if self.sections.get(name) != other.sections.get(name)}
+
+    @staticmethod
+    def custom_lines(config, kind):
+        return tuple(config.get('EmailCustomText', f'CUSTOM_{kind}_MESSAGE_LINE_{i}') for i in (1, 2, 3))
+
+    # Probes are defined in [Sensor:<name>] sections. Without any, the single probe described by
+    # [RTDSetup], [AlarmThresholds] and SENSOR_LOCATION_NAME is used.
+    def load_probes(self, config):
+        sections = [section for section in config.sections() if section.startswith('Sensor:')]
+        if not sections:
+            section = config['RTDSetup']
+            return [ProbeSettings(self.SENSOR_LOCATION_NAME, 0, section.get('BACKEND', 'max31865'),
+                                  section.get('CSBoardLocation'), section.getint('SensorWires'),
+                                  self.WARNING_TEMP, self.ALERT_TEMP, self.PANIC_TEMP, self.RESET_TEMP,
+                                  self.SENSOR_LOCATION_NAME + " Temperature", section)]
+        loaded = []
+        for position, name in enumerate(sections):
+            section = config[name]
+            probe_name = section.get('NAME', name[len('Sensor:'):].strip())
+            backend = section.get('BACKEND', 'max31865')
+            cs_pin = section.get('CSBoardLocation')
+            wires = section.getint('SensorWires')
+            if backend == 'max31865' and (cs_pin is None or wires is None):
+                raise ValueError(f"Missing parameter 'CSBoardLocation' or 'SensorWires' in section '{name}' of config.ini")
+            # Stored data keeps the sensor id in 16 bits
+            sensor_id = section.getint('SENSOR_ID', position)
+            if not 0 <= sensor_id <= 65535:
+                raise ValueError(f"SENSOR_ID in section '{name}' of config.ini must be between 0 and 65535")
+            loaded.append(ProbeSettings(
+                probe_name,
+                sensor_id,
+                backend,
+                cs_pin,
+                wires,
+                section.getfloat('WARNING_TEMP', self.WARNING_TEMP),
+                section.getfloat('ALERT_TEMP', self.ALERT_TEMP),
+                section.getfloat('PANIC_TEMP', self.PANIC_TEMP),
+                section.getfloat('RESET_TEMP', self.RESET_TEMP),
+                section.get('STREAM_KEY', probe_name + " Temperature"),
+                section,
+            ))
+        if len({probe.sensor_id for probe in loaded}) != len(loaded):
+            raise ValueError("Each [Sensor:...] section in config.ini must have a different SENSOR_ID")
+        return loaded
+
+# True for an address only this machine can connect to
+def is_loopback(address):
+    if address == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+# Settings of the fleet collector (see collector.py), read from collector.ini
+class CollectorSettings(BaseSettings):
+    def __init__(self, config):
+        for param in ('gmail_account', 'gmail_password'):
+            if not config.has_option('EmailSettings', param):
+                raise ValueError(f"Missing parameter '{param}' in section 'EmailSettings' of collector.ini")
+
+        self.LISTEN_ADDRESS = config.get('Collector', 'LISTEN_ADDRESS', fallback='127.0.0.1')
+        self.LISTEN_PORT = config.getint('Collector', 'LISTEN_PORT', fallback=8787)
+        self.COLLECTOR_TOKEN = config.get('Collector', 'COLLECTOR_TOKEN', fallback='')
+        # Without a token anyone who can reach the collector could store readings and send email through it
+        if not self.COLLECTOR_TOKEN and not is_loopback(self.LISTEN_ADDRESS):
+            raise ValueError(f"COLLECTOR_TOKEN in collector.ini must be set to listen on {self.LISTEN_ADDRESS or 'every address'}")
+        self.DATABASE = config.get('Collector', 'DATABASE', fallback='data/collector.sqlite3')
+        self.INGEST_QUEUE_EVENTS = config.getint('Collector', 'INGEST_QUEUE_EVENTS', fallback=100000)
+        self.INGEST_FLUSH_INTERVAL = config.getfloat('Collector', 'INGEST_FLUSH_INTERVAL', fallback=1)
+        self.MAX_REQUEST_BYTES = config.getint('Collector', 'MAX_REQUEST_BYTES', fallback=8388608)
+        self.RETRY_AFTER = config.getint('Collector', 'RETRY_AFTER', fallback=30)
+
+        self.read_smtp_settings(config)
+        # Notifications from the monitors are only sent to these addresses
+        self.RECIPIENTS = [address.strip() for address in config.get('EmailSettings', 'RECIPIENTS', fallback='').split(',') if address.strip()]
+        self.read_notification_settings(config)
+
+        # Readings are only forwarded to Initial State if an access key is given
+        self.BUCKET_NAME = config.get('InitialState', 'BUCKET_NAME', fallback='Freezermonitor fleet')
+        self.BUCKET_KEY = config.get('InitialState', 'BUCKET_KEY', fallback='freezermonitor-fleet')
+        self.ACCESS_KEY = config.get('InitialState', 'ACCESS_KEY', fallback='')
+        self.read_upload_settings(config)
+
+        self.read_logging_settings(config)
+        self.read_only = True
+
+def load_collector_settings(path='collector.ini'):
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(f"Could not read {path}")
+    return CollectorSettings(config)
+
+def load_settings(path='config.ini'):
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(f"Could not read {path}")
+    return Settings(config)
@@ -0,0 +1,67 @@
+# Latest readings and device status
+
+import time
+from collections import deque, namedtuple
+
+# The sampler keeps the latest reading of every probe here, along with the lowest and highest values
+# over the last RECENT_WINDOW seconds, and the network task keeps the device ip address. Emails are
+# built from a snapshot of this state, so building one never touches the sensors or the network and
+# an alarm email always reports the reading that triggered it.
+# trend is the rate of change in degrees per second and eta the seconds until ALERT_TEMP is reached,
+# or None when not known. started is when the monitoring software started and upload_failures the
+# number of failed uploads since then
+ProbeReading = namedtuple('ProbeReading', ['temperature', 'timestamp', 'minimum', 'maximum', 'trend', 'eta'])
+Snapshot = namedtuple('Snapshot', ['taken_at', 'readings', 'ip_address', 'started', 'upload_failures'])
+
+# Lowest and highest values over a sliding time window, in O(1) amortised time per value
+class RollingExtremes:
+    def __init__(self, window):
+        self.window = window
+        self.lows = deque()
+        self.highs = deque()
+
+    def add(self, now, value):
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((now, value))
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((now, value))
+        while self.lows[0][0] < now - self.window:
+            self.lows.popleft()
+        while self.highs[0][0] < now - self.window:
+            self.highs.popleft()
+
+    def minimum(self):
+        return self.lows[0][1]
+
+    def maximum(self):
+        return self.highs[0][1]
+
+class MonitorState:
+    def __init__(self, window, ip_address_ttl):
+        self.window = window
+        self.ip_address_ttl = ip_address_ttl
+        self.readings = {}
+        self.extremes = {}
+        self.ip_address = None
+        self.ip_address_updated = None
+        self.started = time.time()
+        self.upload_failures = 0
+
+    def record(self, probe, temperature, timestamp, trend=None, eta=None):
+        extremes = self.extremes.setdefault(probe.sensor_id, RollingExtremes(self.window))
+        extremes.add(time.monotonic(), temperature)
+        self.readings[probe.sensor_id] = ProbeReading(temperature, timestamp, extremes.minimum(), extremes.maximum(), trend, eta)
+
+    # Keep the last address that was found for up to ip_address_ttl seconds if a lookup fails
+    def update_ip_address(self, ip_address):
+        now = time.monotonic()
+        if ip_address is not None:
+            self.ip_address = ip_address
+            self.ip_address_updated = now
+        elif self.ip_address_updated is not None and now - self.ip_address_updated > self.ip_address_ttl:
+            self.ip_address = None
+
+    def snapshot(self):
+        return Snapshot(time.time(), dict(self.readings), self.ip_address, self.started, self.upload_failures)
@@ -0,0 +1,234 @@
+# Local store of every reading
+
+import mmap
+import os
+import struct
+import threading
+
+from .archive import Archive
+
+# Every reading is kept in a local store made of fixed-size segment files under data/readings.
+# Each record is 16 bytes: timestamp, sensor id, temperature and fault flags. Segments are
+# preallocated and memory-mapped, so adding a reading is a single write into memory. The
+# operating system writes changes out to the SD card in the background and the 'store_sync'
+# job forces this every STORE_SYNC_INTERVAL seconds, instead of syncing every sample.
+# Unused records are all zero, so the number of readings in a segment is found again after
+# a restart with a binary search for the first empty record.
+# Readings within a segment are in time order (a new segment is started if the clock goes
+# backwards) and data/readings/index holds the time span of every full segment, so a time range
+# query only opens the segments it needs and binary searches inside them.
+# Old segments can be sealed into a compressed archive in the same directory (see archive.py).
+# Queries read the archive first, then the segments, so they see every reading either way.
+RECORD = struct.Struct('<dHfH')
+INDEX_RECORD = struct.Struct('<IddI')
+SEGMENT_RECORDS = 65536
+
+# Fault flags stored with each reading
+FLAG_READ_ERROR = 1
+
+class Segment:
+    def __init__(self, path, writable=False):
+        self.path = path
+        if writable and not os.path.exists(path):
+            open(path, 'wb').close()
+        self.file = open(path, 'r+b' if writable else 'rb')
+        if writable and os.path.getsize(path) < SEGMENT_RECORDS * RECORD.size:
+            self.file.truncate(SEGMENT_RECORDS * RECORD.size)
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.capacity = len(self.mm) // RECORD.size
+        self.count = self.find_count()
+
+    def timestamp(self, i):
+        return RECORD.unpack_from(self.mm, i * RECORD.size)[0]
+
+    def find_count(self):
+        low, high = 0, self.capacity
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamp(mid) != 0.0:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def first_timestamp(self):
+        return self.timestamp(0) if self.count else None
+
+    def last_timestamp(self):
+        return self.timestamp(self.count - 1) if self.count else None
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def append(self, timestamp, sensor_id, value, flags):
+        RECORD.pack_into(self.mm, self.count * RECORD.size, timestamp, sensor_id, value, flags)
+        self.count += 1
+
+    # Index of the first record at or after timestamp
+    def bisect(self, timestamp):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamp(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def read(self, start, end):
+        for i in range(self.bisect(start), self.count):
+            record = RECORD.unpack_from(self.mm, i * RECORD.size)
+            if record[0] >= end:
+                break
+            yield record
+
+    # Every record, in the order they were written
+    def records(self):
+        return [RECORD.unpack_from(self.mm, i * RECORD.size) for i in range(self.count)]
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+class ReadingStore:
+    # A store opened with writable=False can only be queried, e.g. while the monitor is running
+    def __init__(self, directory, writable=True):
+        self.directory = directory
+        self.writable = writable
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        # flush() may run on a worker thread, so it must not see a segment that is being closed
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, 'index')
+        self.index = self.read_index()
+        numbers = [int(name[4:-4]) for name in os.listdir(directory) if name.startswith('seg-') and name.endswith('.bin')]
+        self.active_number = max(numbers, default=1)
+        # A segment that is already in the index was filled just before a restart
+        if any(entry[0] == self.active_number for entry in self.index):
+            self.active_number += 1
+        self.active = None
+        if os.path.exists(self.segment_path(self.active_number)):
+            self.active = Segment(self.segment_path(self.active_number), writable=writable)
+        self.archive = Archive(directory)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f'seg-{number:06d}.bin')
+
+    def read_index(self):
+        index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            for offset in range(0, len(data) - len(data) % INDEX_RECORD.size, INDEX_RECORD.size):
+                index.append(INDEX_RECORD.unpack_from(data, offset))
+        return index
+
+    # Record the active segment in the index and start a new one
+    def rotate(self):
+        with self.lock:
+            self.rotate_locked()
+
+    def rotate_locked(self):
+        if self.active.count:
+            entry = (self.active_number, self.active.first_timestamp(), self.active.last_timestamp(), self.active.count)
+            self.active.flush()
+            with open(self.index_path, 'ab') as f:
+                f.write(INDEX_RECORD.pack(*entry))
+                f.flush()
+                os.fsync(f.fileno())
+            self.index.append(entry)
+            self.active_number += 1
+        self.active.close()
+        self.active = Segment(self.segment_path(self.active_number), writable=True)
+
+    def append(self, timestamp, sensor_id, value, flags=0):
+        if self.active is None:
+            self.active = Segment(self.segment_path(self.active_number), writable=True)
+        last = self.active.last_timestamp()
+        if self.active.is_full() or (last is not None and timestamp < last):
+            self.rotate()
+        self.active.append(timestamp, sensor_id, value, flags)
+
+    def flush(self):
+        with self.lock:
+            if self.active is not None:
+                self.active.flush()
+
+    # Yield (timestamp, sensor_id, value, flags) for readings with start <= timestamp < end. With low or
+    # high, only readings from low to high degrees are returned (never failed readings), and archived
+    # blocks without any are not read
+    def query(self, start, end, sensor_id=None, low=None, high=None):
+        yield from self.archive.query(start, end, sensor_id, low, high)
+        # A segment stays in the index for a moment after it has been archived
+        archived = self.archive.segments()
+        for number, first, last, count in self.index:
+            if last < start or first >= end or number in archived:
+                continue
+            try:
+                segment = Segment(self.segment_path(number))
+            except FileNotFoundError:
+                # removed by expire() or seal() since the index was read
+                continue
+            try:
+                yield from self.select(segment.read(start, end), sensor_id, low, high)
+            finally:
+                segment.close()
+        if self.active is not None:
+            yield from self.select(self.active.read(start, end), sensor_id, low, high)
+
+    @staticmethod
+    def select(records, sensor_id, low, high):
+        for record in records:
+            if sensor_id is not None and record[1] != sensor_id:
+                continue
+            if (low is not None and not record[2] >= low) or (high is not None and not record[2] <= high):
+                continue
+            yield record
+
+    # Seal full segments whose readings are all older than before into the archive and delete them.
+    # Returns the number of segments sealed
+    def seal(self, before):
+        sealed = [entry for entry in self.index if entry[2] < before]
+        if not sealed:
+            return 0
+        archived = self.archive.segments()
+        for number, first, last, count in sealed:
+            if number in archived:
+                # archived just before a restart, only the raw segment is left to delete
+                continue
+            segment = Segment(self.segment_path(number))
+            try:
+                records = segment.records()
+            finally:
+                segment.close()
+            self.archive.add(number, records)
+        self.remove_segments(sealed)
+        return len(sealed)
+
+    # Delete full segments whose readings are all older than before
+    def expire(self, before):
+        expired = [entry for entry in self.index if entry[2] < before]
+        if expired:
+            self.remove_segments(expired)
+        return len(expired)
+
+    # Drop segments from the index and delete them. The index is replaced atomically before any segment
+    # is removed, so a power cut never leaves it pointing at a missing file
+    def remove_segments(self, entries):
+        removed = {entry[0] for entry in entries}
+        with self.lock:
+            kept = [entry for entry in self.index if entry[0] not in removed]
+            with open(self.index_path + '.tmp', 'wb') as f:
+                f.write(b''.join(INDEX_RECORD.pack(*entry) for entry in kept))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.index_path + '.tmp', self.index_path)
+            self.index = kept
+        for number in removed:
+            try:
+                os.remove(self.segment_path(number))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,112 @@
+# Uploading readings to initialstate
+
+import json
+import os
+
+# Readings waiting to be uploaded are appended to an on-disk queue (one JSON event per line) so
+# that nothing is lost while the network is down or the device restarts. A second small file holds
+# the byte offset of the first reading that has not been uploaded yet; it is replaced atomically
+# after each successful upload. Once everything has been sent the queue is emptied.
+class UploadQueue:
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.file = open(path, 'ab')
+        # Finish off a line left incomplete by a power cut, so the next reading starts on its own line
+        if self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write(b'\n')
+                    self.file.flush()
+        self.offset = self.read_offset()
+
+    def read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                offset = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            offset = 0
+        return min(offset, self.file.tell())
+
+    def write_offset(self, offset):
+        with open(self.offset_path + '.tmp', 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.offset_path + '.tmp', self.offset_path)
+        self.offset = offset
+
+    # Add (key, value, epoch) events to the end of the queue
+    def extend(self, events):
+        self.file.write(b''.join(json.dumps({'key': key, 'value': value, 'epoch': round(epoch, 3)}).encode() + b'\n'
+                                 for key, value, epoch in events))
+        self.file.flush()
+
+    def backlog_bytes(self):
+        return self.file.tell() - self.offset
+
+    # Return up to max_events queued events (as encoded JSON) and the offset just past them
+    def read_batch(self, max_events):
+        events = []
+        end = self.offset
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                end += len(line)
+                try:
+                    json.loads(line)
+                except ValueError:
+                    continue
+                events.append(line.rstrip(b'\n'))
+                if len(events) >= max_events:
+                    break
+        return events, end
+
+    # Mark everything before end as uploaded. The offset is reset before the file is emptied, so a
+    # crash in between can at worst upload a batch twice, never skip one.
+    def commit(self, end):
+        if end >= self.file.tell():
+            self.write_offset(0)
+            self.file.truncate(0)
+            self.file.seek(0)
+        else:
+            self.write_offset(end)
+
+# Sends batches of events to the Initial State events API in a single request
+class InitialStateUploader:
+    # Used in log messages and as the dependency label of the failure metrics
+    name = 'InitialState'
+    dependency = 'initialstate'
+
+    def __init__(self, api_url, bucket_name, bucket_key, access_key, timeout):
+        self.api_url = api_url.rstrip('/')
+        self.bucket_name = bucket_name
+        self.bucket_key = bucket_key
+        self.access_key = access_key
+        self.timeout = timeout
+        self.bucket_ready = False
+
+    def post(self, resource, data):
+        # Only imported once there is something to upload, so it does not hold up the first reading
+        import urllib.request
+        request = urllib.request.Request(self.api_url + resource, data=data, method='POST', headers={
+            'Content-Type': 'application/json',
+            'Accept-Version': '~0',
+            'X-IS-AccessKey': self.access_key,
+            'X-IS-BucketKey': self.bucket_key,
+        })
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    # Create the bucket the first time something is sent (this does nothing if it already exists)
+    def ensure_bucket(self):
+        if not self.bucket_ready:
+            self.post('/buckets', json.dumps({'bucketKey': self.bucket_key, 'bucketName': self.bucket_name}).encode())
+            self.bucket_ready = True
+
+    def send(self, events):
+        self.ensure_bucket()
+        self.post('/events', b'[' + b','.join(events) + b']')
@@ -0,0 +1,32 @@
+#! /usr/bin/python3
+
+########################################################################
+#	     This script was written by E. Bentz: ejb345@cornell.edu       #
+########################################################################
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or any
+# later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# Author: Ehren Bentz
+# Project: Freezermonitor
+# License: GNU General Public License v3.0
+
+# Purpose:
+# Looks up, exports and serves the temperature readings recorded by freezermonitor.py, e.g. what one freezer
+# was doing between 2 and 4 a.m. last Tuesday, without going through Initial State.
+#
+# Run it from the directory freezermonitor.py runs in, so that it finds the data directory and config.ini.
+# The fmonitor directory must be kept next to this file.
+# Run "python3 fmquery.py --help" for the commands and "python3 fmquery.py readings --help" for their options
+#
+#########################################################################
+
+from fmonitor.query import main
+
+main()
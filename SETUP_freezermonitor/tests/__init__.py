@@ -0,0 +1,2 @@
+# Tests for the fmonitor package. They need nothing beyond the standard library and no sensor, so
+# they run anywhere. From the directory holding fmonitor, run: python3 -m unittest discover tests
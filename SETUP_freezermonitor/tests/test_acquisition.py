@@ -0,0 +1,81 @@
+# Passes stored in the sample ring by the acquisition thread, and how the monitor reads them back
+
+import math
+import unittest
+from types import SimpleNamespace
+
+from fmonitor.acquisition import FAULT_CODE, FAULT_CODES, Acquisition
+from fmonitor.monitor import Monitor
+from fmonitor.sensors import ReplaySensor
+
+SETTINGS = SimpleNamespace(SENSOR_TIMEOUT=5.0, SENSOR_MIN_TEMP=-100.0, SENSOR_MAX_TEMP=60.0, STUCK_TIME=0.0)
+
+# An acquisition over two replayed probes, the second failing every third read
+def acquisition(capacity):
+    probes = [SimpleNamespace(sensor=ReplaySensor([-80.0, -80.5, 150.0])), SimpleNamespace(sensor=ReplaySensor([-20.0, -20.5, math.nan]))]
+    return Acquisition(probes, SETTINGS, 10.0, capacity)
+
+class SampleRingTest(unittest.TestCase):
+    # Every pass keeps its own readings, fault codes and fault descriptions
+    def test_passes(self):
+        reader = acquisition(4)
+        for _ in range(3):
+            reader.read_pass()
+        ring = reader.ring
+        self.assertEqual(ring.written, 3)
+        self.assertEqual(list(ring.values[:4]), [-80.0, -20.0, -80.5, -20.5])
+        self.assertTrue(math.isnan(ring.values[4]) and math.isnan(ring.values[5]))
+        self.assertEqual([FAULT_CODES[code] for code in ring.faults[:6]], [None, None, None, None, 'implausible', 'read_error'])
+        self.assertEqual(ring.details[4:6], ["read 150.00°C", "recorded reading failed"])
+
+    def test_overwritten(self):
+        reader = acquisition(4)
+        for _ in range(5):
+            reader.read_pass()
+        self.assertTrue(reader.ring.overwritten(0))
+        self.assertTrue(reader.ring.overwritten(1))
+        self.assertFalse(reader.ring.overwritten(2))
+
+    # Passes the writer may be coming round to are counted as missed, the rest are checked in order with
+    # their own fault descriptions
+    def test_process_samples(self):
+        reader = acquisition(4)
+        for _ in range(6):
+            reader.read_pass()
+        checked = []
+        monitor = SimpleNamespace(acquisition=reader, ring_position=0,
+                                  sample_temperature=lambda now, timestamp, values, faults, details: checked.append((list(faults), list(details))))
+        with self.assertLogs('fmonitor.sensor', 'WARNING'):
+            Monitor.process_samples(monitor)
+        self.assertEqual(monitor.ring_position, 6)
+        fault = FAULT_CODE['implausible'], FAULT_CODE['read_error']
+        self.assertEqual([faults for faults, _ in checked], [[0, 0], [0, 0], list(fault)])
+        self.assertEqual(checked[2][1], ["read 150.00°C", "recorded reading failed"])
+
+    # A pass the writer comes round to while it is being copied is missed rather than checked
+    def test_lapped_during_copy(self):
+        reader = acquisition(4)
+        reader.read_pass()
+        ring = reader.ring
+        overwritten = ring.overwritten
+
+        def lapping(position):
+            found = overwritten(position)
+            if ring.written == 1:
+                for _ in range(4):
+                    reader.read_pass()
+            return found
+
+        ring.overwritten = lapping
+        checked = []
+        monitor = SimpleNamespace(acquisition=reader, ring_position=0,
+                                  sample_temperature=lambda now, timestamp, values, faults, details: checked.append(list(values[:1])))
+        with self.assertLogs('fmonitor.sensor', 'WARNING'):
+            Monitor.process_samples(monitor)
+        # Passes 2 to 4, the first of them an implausible reading
+        self.assertEqual(monitor.ring_position, 5)
+        self.assertTrue(math.isnan(checked[0][0]))
+        self.assertEqual(checked[1:], [[-80.0], [-80.5]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+# Alarm states of a probe through a warming and back, and their persistence in alarms.json
+
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from fmonitor.alarms import ALERT, NORMAL, PANIC, RECOVERED, WARNING, AlarmState, AlarmStore
+from fmonitor.monitor import Probe
+
+# Thresholds of a -80 freezer, using the monitor's own count of thresholds reached
+class Thresholds:
+    warning_temp = -60.0
+    alert_temp = -40.0
+    panic_temp = -20.0
+    reset_temp = -70.0
+    level = Probe.level
+
+def alarm_settings(**changes):
+    settings = {'ALARM_HYSTERESIS': 2.0, 'ALARM_RENOTIFY_INTERVAL': 3600.0, 'ALARM_RECOVERY_NOTIFICATION': True, 'ALARM_CLEAR_TIME': 600.0}
+    settings.update(changes)
+    return SimpleNamespace(**settings)
+
+class AlarmStateTest(unittest.TestCase):
+    def setUp(self):
+        self.alarm = AlarmState()
+        self.probe = Thresholds()
+        self.settings = alarm_settings()
+
+    # Feed one reading and check what is notified and the state it leaves the alarm in
+    def step(self, now, temperature, notified, state, above=True):
+        self.assertEqual(self.alarm.update(self.probe, temperature, above, now, self.settings), notified)
+        self.assertEqual(self.alarm.state, state)
+
+    def test_warming_and_recovery(self):
+        self.step(0, -75.0, None, NORMAL, above=False)
+        self.step(10, -55.0, WARNING, WARNING)
+        self.assertEqual(self.alarm.started, 10)
+        self.step(20, -50.0, None, WARNING)
+        # Straight past ALERT to PANIC, with one notification
+        self.step(30, -15.0, PANIC, PANIC)
+        # Within ALARM_HYSTERESIS of PANIC_TEMP, then below it: down a level without a notification
+        self.step(40, -21.0, None, PANIC)
+        self.step(50, -23.0, None, ALERT)
+        self.step(60, -41.0, None, ALERT)
+        self.step(70, -45.0, None, WARNING)
+        # Back up a level notifies again
+        self.step(80, -35.0, ALERT, ALERT)
+        # Repeated every ALARM_RENOTIFY_INTERVAL while it lasts
+        self.step(3679, -35.0, None, ALERT)
+        self.step(3680, -35.0, ALERT, ALERT)
+        # Below WARNING_TEMP but above RESET_TEMP is still an alarm
+        self.step(3690, -65.0, None, WARNING)
+        self.step(3700, -71.0, RECOVERED, RECOVERED, above=False)
+        self.assertEqual(self.alarm.peak, -15.0)
+        self.step(4000, -75.0, None, RECOVERED, above=False)
+        self.step(4300, -75.0, None, NORMAL, above=False)
+
+    # A fast drop goes down every level it passes at once
+    def test_drop_several_levels(self):
+        self.step(0, -10.0, PANIC, PANIC)
+        self.step(10, -65.0, None, WARNING)
+
+    # Readings at or above WARNING_TEMP only count once they have held for ALARM_HOLD_TIME
+    def test_not_held(self):
+        self.step(0, -10.0, None, NORMAL, above=False)
+
+    def test_recovery_without_notification(self):
+        self.settings = alarm_settings(ALARM_RECOVERY_NOTIFICATION=False)
+        self.step(0, -50.0, WARNING, WARNING)
+        self.step(10, -75.0, None, RECOVERED, above=False)
+
+    # A new warming while RECOVERED starts a new alarm
+    def test_warming_again(self):
+        self.step(0, -50.0, WARNING, WARNING)
+        self.step(10, -75.0, RECOVERED, RECOVERED, above=False)
+        self.step(20, -30.0, ALERT, ALERT)
+        self.assertEqual(self.alarm.started, 20)
+        self.assertEqual(self.alarm.peak, -30.0)
+
+    # Readings from a broken probe never move the alarm
+    def test_impossible_reading(self):
+        self.step(0, 150.0, None, NORMAL)
+
+    def test_fault(self):
+        self.assertTrue(self.alarm.set_fault('open', 0, self.settings))
+        self.assertFalse(self.alarm.set_fault('short', 10, self.settings))
+        self.assertEqual(self.alarm.fault, 'short')
+        self.assertEqual(self.alarm.fault_since, 0)
+        self.assertTrue(self.alarm.set_fault('short', 3600, self.settings))
+        self.alarm.clear_fault()
+        self.assertIsNone(self.alarm.fault)
+
+class AlarmStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'alarms.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # A monitor restarted in the middle of a warming carries on where it left off
+    def test_reload(self):
+        store = AlarmStore(self.path)
+        settings = alarm_settings()
+        alarm = store.get(3)
+        alarm.update(Thresholds(), -30.0, True, 100.0, settings)
+        alarm.set_predicted(True)
+        alarm.set_fault('stuck', 120.0, settings)
+        store.get(5)
+        self.assertTrue(store.boot_message_due(90.0, 900))
+        store.save()
+
+        reloaded = AlarmStore(self.path)
+        self.assertEqual(sorted(reloaded.states), [3, 5])
+        self.assertEqual(reloaded.get(3).to_json(), alarm.to_json())
+        self.assertEqual(reloaded.get(5).state, NORMAL)
+        self.assertFalse(reloaded.boot_message_due(500.0, 900))
+        # No repeat of the ALERT notification for the same reading after the restart
+        self.assertIsNone(reloaded.get(3).update(Thresholds(), -30.0, True, 130.0, settings))
+
+    # Nothing is written when nothing has changed
+    def test_save_only_changes(self):
+        store = AlarmStore(self.path)
+        store.save()
+        self.assertFalse(os.path.exists(self.path))
+        store.get(1).enter(WARNING, 10.0)
+        store.save()
+        self.assertTrue(os.path.exists(self.path))
+        os.remove(self.path)
+        store.save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unreadable_file(self):
+        with open(self.path, 'w') as f:
+            f.write('{"probes": {"3": {"state": "ALE')
+        with self.assertLogs('fmonitor.alarms', 'ERROR'):
+            store = AlarmStore(self.path)
+        self.assertEqual(store.states, {})
+
+    # Unknown states and faults from a damaged or newer file fall back to NORMAL and no fault
+    def test_unknown_values(self):
+        with open(self.path, 'w') as f:
+            json.dump({'probes': {'3': {'state': 'MELTING', 'fault': 'gremlins', 'since': 5}}}, f)
+        alarm = AlarmStore(self.path).get(3)
+        self.assertEqual(alarm.state, NORMAL)
+        self.assertIsNone(alarm.fault)
+        self.assertEqual(alarm.since, 5.0)
+
+if __name__ == '__main__':
+    unittest.main()
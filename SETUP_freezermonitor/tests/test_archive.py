@@ -0,0 +1,194 @@
+# Archived readings must come back exactly as they were stored: timestamps to the millisecond, values
+# as the 32-bit floats of the raw segments, failed reads as NaN and flags unchanged
+
+import math
+import os
+import random
+import tempfile
+import unittest
+import zlib
+from array import array
+
+from fmonitor.archive import BLOCK_READINGS, FIXED_POINT, XOR, Archive, decode_block, encode_block
+from fmonitor.storage import ReadingStore
+
+# Readings every 10 seconds with a little jitter, as the monitor takes them
+def readings(values, sensor_id=0, start=1.7e9, flags=None):
+    rng = random.Random(len(values))
+    records = []
+    timestamp = start
+    for i, value in enumerate(values):
+        timestamp += 10 + rng.gauss(0, 0.005)
+        records.append((timestamp, sensor_id, value, flags[i] if flags else 0))
+    return records
+
+# What the raw segments hold for a value: a 32-bit float
+def stored(value):
+    return array('f', [value])[0]
+
+class BlockTest(unittest.TestCase):
+    def assert_round_trip(self, records, encoding):
+        block = encode_block(records)
+        self.assertEqual(zlib.decompress(block)[0], encoding)
+        times, values, flags = decode_block(block)
+        self.assertEqual(len(times), len(records))
+        for record, timestamp, value, flag in zip(records, times, values, flags):
+            self.assertEqual(timestamp, round(record[0] * 1000) / 1000)
+            if math.isnan(record[2]):
+                self.assertTrue(math.isnan(value))
+            else:
+                self.assertEqual(value, stored(record[2]))
+            self.assertEqual(flag, record[3])
+
+    # Readings rounded to 0.01 degrees, with failed reads, use the fixed point encoding
+    def test_hundredths(self):
+        rng = random.Random(1)
+        values = [round(-80 + rng.gauss(0, 0.05), 2) for _ in range(2000)]
+        flags = [0] * len(values)
+        for i in range(0, len(values), 97):
+            values[i] = math.nan
+            flags[i] = 1
+        self.assert_round_trip(readings(values, flags=flags), FIXED_POINT)
+
+    # Values that are not whole hundredths fall back to XOR of the float bits
+    def test_not_hundredths(self):
+        rng = random.Random(2)
+        values = [-80 + rng.gauss(0, 0.05) for _ in range(2000)]
+        values[10] = math.nan
+        self.assert_round_trip(readings(values), XOR)
+
+    def test_infinities(self):
+        values = [-80.0, math.inf, -79.99, -math.inf, math.nan, 1e-3, -273.15, 3.4e38]
+        self.assert_round_trip(readings(values), XOR)
+
+    # Extreme hundredths, large jumps and irregular gaps between readings
+    def test_large_steps(self):
+        values = [-200.0, 200.0, -200.0, 0.0, 0.01, -0.01, 850.0, math.nan, -80.0]
+        records = readings(values)
+        records = [(timestamp + i * i * 3600.25, sensor_id, value, flags) for i, (timestamp, sensor_id, value, flags) in enumerate(records)]
+        self.assert_round_trip(records, FIXED_POINT)
+
+    def test_single_reading(self):
+        self.assert_round_trip(readings([-80.5]), FIXED_POINT)
+        self.assert_round_trip(readings([math.nan], flags=[1]), FIXED_POINT)
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = Archive(self.directory.name)
+        rng = random.Random(3)
+        count = BLOCK_READINGS + 500
+        self.records = sorted(readings([round(-80 + rng.gauss(0, 0.05), 2) for _ in range(count)], 0) +
+                              readings([round(-20 + rng.gauss(0, 0.05), 2) for _ in range(count)], 1, start=1.7e9 + 3))
+        self.records[100] = (self.records[100][0], self.records[100][1], math.nan, 1)
+        self.archive.add(0, self.records)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # The readings a query should return. Ranges of temperatures are checked against the stored values,
+    # as they are for the raw segments
+    def expected(self, start, end, sensor_id=None, low=None, high=None):
+        records = [(timestamp, sensor, stored(value), flags) for timestamp, sensor, value, flags in self.records]
+        return [record for record in records if start <= record[0] < end and (sensor_id is None or record[1] == sensor_id)
+                and (low is None or record[2] >= low) and (high is None or record[2] <= high)]
+
+    def assert_query(self, *query):
+        found = list(self.archive.query(*query))
+        expected = self.expected(*query)
+        self.assertEqual(len(found), len(expected))
+        for record, reading in zip(expected, found):
+            self.assertEqual(reading[0], round(record[0] * 1000) / 1000)
+            self.assertEqual(reading[1], record[1])
+            self.assertTrue(reading[2] == record[2] or math.isnan(reading[2]) and math.isnan(record[2]))
+            self.assertEqual(reading[3], record[3])
+
+    def test_everything(self):
+        self.assert_query(0, math.inf)
+
+    # Several blocks per probe, queried across block boundaries
+    def test_time_range(self):
+        middle = self.records[len(self.records) // 2][0]
+        self.assert_query(middle - 3600, middle + 3600)
+        self.assert_query(middle, middle + 86400, 1)
+
+    def test_temperature_range(self):
+        self.assert_query(0, math.inf, None, -80.05, -79.95)
+        self.assert_query(0, math.inf, 1, -20.0)
+        self.assertEqual(list(self.archive.query(0, math.inf, None, 0.0)), [])
+
+    # The index is read back from disk
+    def test_reopen(self):
+        self.archive = Archive(self.directory.name)
+        self.assertEqual(self.archive.segments(), {0})
+        self.assert_query(0, math.inf)
+
+# Sealing full segments of the reading store: queries see the same readings before and after, whether they
+# come from the archive, the segments or both
+class SealTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ReadingStore(self.directory.name)
+        self.records = []
+        rng = random.Random(4)
+        for part in range(3):
+            for i in range(1000):
+                timestamp = 1.7e9 + (part * 1000 + i) * 10
+                for sensor_id, base in ((0, -80.0), (1, -20.0)):
+                    value = round(base + rng.gauss(0, 0.05), 2)
+                    self.store.append(timestamp, sensor_id, value, 0)
+                    self.records.append((timestamp, sensor_id, stored(value), 0))
+            if part < 2:
+                self.store.rotate()
+
+    def tearDown(self):
+        self.store.active.close()
+        self.directory.cleanup()
+
+    def reopen(self):
+        self.store.flush()
+        self.store.active.close()
+        self.store = ReadingStore(self.directory.name)
+
+    def expected(self, start, end, sensor_id=None):
+        return [record for record in self.records if start <= record[0] < end and (sensor_id is None or record[1] == sensor_id)]
+
+    def test_seal(self):
+        self.assertEqual(self.store.seal(1.7e9 + 20000), 2)
+        self.assertEqual(self.store.index, [])
+        self.assertEqual(self.store.archive.segments(), {1, 2})
+        self.assertFalse(os.path.exists(self.store.segment_path(1)))
+        self.assertLess(self.store.archive.size(), 2 * 2000 * 16 / 4)
+        self.assertEqual(self.store.seal(1.7e9 + 20000), 0)
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+        # Across the archive and the active segment, for one probe and a range of temperatures
+        for start, end in ((1.7e9 + 15005, 1.7e9 + 25005), (1.7e9 + 19990, 1.7e9 + 20010)):
+            self.assertEqual(list(self.store.query(start, end)), self.expected(start, end))
+            self.assertEqual(list(self.store.query(start, end, 1)), self.expected(start, end, 1))
+        self.assertEqual(list(self.store.query(0, math.inf, None, -80.02, -79.98)),
+                         [record for record in self.records if -80.02 <= record[2] <= -79.98])
+
+    # Only segments whose readings are all older than the cutoff are sealed
+    def test_partly_old(self):
+        self.assertEqual(self.store.seal(1.7e9 + 15000), 1)
+        self.assertEqual([entry[0] for entry in self.store.index], [2])
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+
+    # A segment archived just before a power cut, but not yet deleted, is read once and deleted next time
+    def test_archived_before_restart(self):
+        segment = self.store.segment_path(1)
+        with open(segment, 'rb') as f:
+            data = f.read()
+        self.store.seal(1.7e9 + 10000)
+        with open(segment, 'wb') as f:
+            f.write(data)
+        self.store.index.insert(0, (1, 1.7e9, 1.7e9 + 9990, 2000))
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+        self.assertEqual(self.store.seal(1.7e9 + 10000), 1)
+        self.assertFalse(os.path.exists(segment))
+        self.reopen()
+        self.assertEqual(self.store.archive.segments(), {1})
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# The fleet collector: who it accepts requests from, where it sends email, and readings stored and read back
+
+import asyncio
+import configparser
+import json
+import os
+import tempfile
+import unittest
+
+from fmonitor.collector import Collector, HTTPError, ReadingDatabase
+from fmonitor.eventlog import stop_logging
+from fmonitor.settings import CollectorSettings
+
+def collector_config(**collector):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'Collector': collector,
+        'EmailSettings': {'gmail_account': 'collector@localhost', 'gmail_password': 'secret', 'SMTP_SERVER': '127.0.0.1',
+                          'SMTP_PORT': '1', 'SMTP_SECURITY': 'none', 'RECIPIENTS': 'lab@localhost, Admin@Localhost'},
+    })
+    return config
+
+class CollectorSettingsTest(unittest.TestCase):
+    def test_defaults(self):
+        settings = CollectorSettings(collector_config())
+        self.assertEqual(settings.LISTEN_ADDRESS, '127.0.0.1')
+        self.assertEqual(settings.COLLECTOR_TOKEN, '')
+        self.assertEqual(settings.RECIPIENTS, ['lab@localhost', 'Admin@Localhost'])
+
+    # Only this machine may connect without a token
+    def test_token_required(self):
+        for address in ('0.0.0.0', '', '192.168.1.20', '::'):
+            with self.assertRaises(ValueError):
+                CollectorSettings(collector_config(LISTEN_ADDRESS=address))
+        CollectorSettings(collector_config(LISTEN_ADDRESS='::1'))
+        CollectorSettings(collector_config(LISTEN_ADDRESS='localhost'))
+        CollectorSettings(collector_config(LISTEN_ADDRESS='0.0.0.0', COLLECTOR_TOKEN='s3cret'))
+
+class ReadingDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = ReadingDatabase(os.path.join(self.directory.name, 'collector.sqlite3'))
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def test_insert(self):
+        self.database.insert([('lab-1', '10.0.0.5', [('Freezer', -80.0, 100.0), ('Freezer', -79.5, 110.0)]),
+                              ('lab-2', '10.0.0.6', [('Fridge', 4.0, 105.0)])], 120.0)
+        self.database.insert([('lab-1', '10.0.0.7', [('Freezer', -79.0, 120.0)])], 130.0)
+        self.assertEqual([row['value'] for row in self.database.query()], [-80.0, 4.0, -79.5, -79.0])
+        self.assertEqual([row['epoch'] for row in self.database.query('lab-1', 'Freezer', 105.0, 130.0)], [110.0, 120.0])
+        self.assertEqual(len(self.database.query(limit=2)), 2)
+        nodes = self.database.nodes()
+        self.assertEqual([(node['node'], node['address'], node['readings'], node['first_seen'], node['last_seen']) for node in nodes],
+                         [('lab-1', '10.0.0.7', 3, 120.0, 130.0), ('lab-2', '10.0.0.6', 1, 120.0, 120.0)])
+
+# Requests handled by a collector running in a temporary directory, without opening a port
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.collector = Collector(CollectorSettings(collector_config(COLLECTOR_TOKEN='s3cret', INGEST_QUEUE_EVENTS='3')))
+
+    def tearDown(self):
+        self.collector.database_executor.shutdown()
+        self.collector.upload_executor.shutdown()
+        self.collector.dispatcher.executor.shutdown()
+        self.collector.database.close()
+        stop_logging(self.collector.log_handler)
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def request(self, method, path, body=None, token='s3cret', query=None):
+        headers = {'authorization': f'Bearer {token}'} if token else {}
+        return self.collector.route(method, path, query or {}, headers, json.dumps(body).encode() if body is not None else b'', '127.0.0.1')
+
+    def run_requests(self, steps):
+        async def main():
+            return await steps()
+        return asyncio.run(main())
+
+    def assert_refused(self, status, request):
+        async def steps():
+            with self.assertRaises(HTTPError) as refused:
+                await request()
+            self.assertEqual(refused.exception.status, status)
+        self.run_requests(steps)
+
+    def test_token(self):
+        self.assert_refused(401, lambda: self.request('GET', '/nodes', token=None))
+        self.assert_refused(401, lambda: self.request('GET', '/nodes', token='guess'))
+        self.assert_refused(404, lambda: self.request('GET', '/elsewhere'))
+        self.assert_refused(405, lambda: self.request('DELETE', '/readings'))
+
+    # Email only goes to RECIPIENTS, whatever the case of the address
+    def test_recipients(self):
+        notification = {'node': 'lab-1', 'subject': 'PANIC: Freezer', 'body': '<p>-15</p>'}
+        with self.assertLogs('fmonitor.collector', 'WARNING'):
+            self.assert_refused(403, lambda: self.request('POST', '/notifications', dict(notification, recipients=['lab@localhost', 'anyone@example.com'])))
+
+        async def steps():
+            return await self.request('POST', '/notifications', dict(notification, recipients=['LAB@localhost', 'admin@localhost']))
+
+        status, payload, _ = self.run_requests(steps)
+        self.assertEqual(status, 202)
+        self.assertEqual([(job.recipients, job.priority) for job in self.collector.dispatcher.jobs], [(['LAB@localhost', 'admin@localhost'], 3)])
+
+    # A request is only answered once its readings are stored, and readings beyond INGEST_QUEUE_EVENTS are refused
+    def test_readings(self):
+        events = [{'key': 'Freezer', 'value': -80.0 + i, 'epoch': 100.0 + i} for i in range(3)]
+
+        async def steps():
+            posted = asyncio.create_task(self.request('POST', '/readings', {'node': 'lab-1', 'events': events}))
+            await asyncio.sleep(0)
+            self.assertFalse(posted.done())
+            with self.assertRaises(HTTPError) as busy:
+                await self.request('POST', '/readings', {'node': 'lab-2', 'events': events[:1]})
+            self.assertEqual(busy.exception.status, 503)
+            await self.collector.write_pending()
+            status, payload, _ = await posted
+            self.assertEqual((status, json.loads(payload)), (200, {'stored': 3}))
+            return await self.request('GET', '/readings', query={'node': ['lab-1'], 'start': ['101']})
+
+        status, payload, _ = self.run_requests(steps)
+        self.assertEqual([row['value'] for row in json.loads(payload)], [-79.0, -78.0])
+        self.assert_refused(400, lambda: self.request('POST', '/readings', {'node': 'lab-1', 'events': [{'key': 'Freezer'}]}))
+
+if __name__ == '__main__':
+    unittest.main()
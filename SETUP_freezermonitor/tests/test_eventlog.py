@@ -0,0 +1,57 @@
+# Repeats of an event are limited however much their messages change, separately for each probe
+
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from fmonitor.eventlog import BufferedJSONLinesHandler
+
+def record(message, event=None, fields=None):
+    found = logging.LogRecord('fmonitor.sensor', logging.ERROR, __file__, 0, message, None, None)
+    if event is not None:
+        found.event = event
+    if fields is not None:
+        found.fields = fields
+    return found
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'events.jsonl')
+        self.handler = BufferedJSONLinesHandler(self.path, rate_limit=3, rate_window=600)
+
+    def tearDown(self):
+        self.handler.close()
+        self.directory.cleanup()
+
+    def lines(self):
+        self.handler.flush()
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_event(self):
+        for i in range(20):
+            self.handler.emit(record(f"Fault on Freezer: read {-80 + i}°C", 'sensor_fault', {'probe': 'Freezer'}))
+            self.handler.emit(record(f"Fault on Fridge: read {4 + i}°C", 'sensor_fault', {'probe': 'Fridge'}))
+        lines = self.lines()
+        self.assertEqual([line['probe'] for line in lines], ['Freezer', 'Fridge'] * 3)
+        self.assertEqual({line['event'] for line in lines}, {'sensor_fault'})
+
+        # One summary per probe once the window is over
+        for entry in self.handler.limiter.windows.values():
+            entry[0] -= 600
+        summaries = self.lines()[6:]
+        self.assertEqual(sorted((line['probe'], line['repeated']) for line in summaries), [('Freezer', 17), ('Fridge', 17)])
+        self.assertIn("read -61°C", summaries[0]['message'] + summaries[1]['message'])
+
+    # Without an event, records are told apart by their message
+    def test_message(self):
+        for i in range(5):
+            self.handler.emit(record("Sensor thread stopped"))
+            self.handler.emit(record(f"Unexpected error {i}"))
+        self.assertEqual(len(self.lines()), 3 + 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# The streaming filters against straightforward versions of the same calculation
+
+import math
+import random
+import statistics
+import unittest
+
+from fmonitor.filters import Debounce, ExponentialAverage, RollingMedian
+
+class RollingMedianTest(unittest.TestCase):
+    # Repeated values exercise the readings that are left in the heaps after leaving the window
+    def test_against_sorting(self):
+        rng = random.Random(1)
+        values = [rng.choice([-80.0, -79.99, -80.01, math.floor(rng.gauss(-80, 3))]) for _ in range(5000)]
+        for window in range(1, 10):
+            median = RollingMedian(window)
+            for i, value in enumerate(values):
+                self.assertEqual(median.add(value), statistics.median(values[max(i + 1 - window, 0):i + 1]))
+
+    # A single spike never gets through a window of 3
+    def test_spike(self):
+        median = RollingMedian(3)
+        found = [median.add(value) for value in (-80.0, -80.0, 25.0, -80.0, -80.0)]
+        self.assertEqual(max(found), -80.0)
+
+class ExponentialAverageTest(unittest.TestCase):
+    # After a step, one time constant brings the average 1 - 1/e of the way whatever the time between readings
+    def test_step(self):
+        for gap in (0.5, 2.0, 10.0, 60.0):
+            average = ExponentialAverage(60.0)
+            average.add(-80.0, 0.0)
+            for i in range(1, round(60.0 / gap) + 1):
+                value = average.add(-20.0, i * gap)
+            self.assertAlmostEqual(value, -80.0 + 60.0 * (1 - math.exp(-1)))
+
+class DebounceTest(unittest.TestCase):
+    def test_hold(self):
+        debounce = Debounce(30.0)
+        self.assertFalse(debounce.update(True, 0.0))
+        self.assertFalse(debounce.update(True, 29.0))
+        self.assertTrue(debounce.update(True, 30.0))
+        # Any reading below starts the hold again
+        self.assertFalse(debounce.update(False, 31.0))
+        self.assertFalse(debounce.update(True, 40.0))
+        self.assertTrue(debounce.update(True, 70.0))
+
+if __name__ == '__main__':
+    unittest.main()
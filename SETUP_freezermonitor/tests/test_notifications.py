@@ -0,0 +1,176 @@
+# The notification dispatcher's queue: retries, their backoff, what goes out meanwhile and what goes out
+# together, and the SMTP session kept open between emails
+
+import asyncio
+import smtplib
+import time
+import unittest
+
+from fmonitor.notifications import NotificationDispatcher, SMTPConnection
+
+def boot_message(snapshot):
+    return "Boot", "Monitor started"
+
+def panic_message(snapshot):
+    return "PANIC", "Freezer is at -15°C"
+
+def warning_message(snapshot):
+    return "WARNING", "Freezer is at -55°C"
+
+class DispatcherTest(unittest.TestCase):
+    # Emails to an address in refused fail, the others are kept with the time they were sent
+    def setUp(self):
+        self.refused = set()
+        self.sent = []
+
+    def send(self, recipients, subject, body):
+        if set(recipients) & self.refused:
+            raise OSError("recipient refused")
+        self.sent.append((recipients, subject, time.monotonic()))
+
+    # Start a dispatcher with a 30 second first retry, run steps against it and stop it again
+    def run_dispatcher(self, steps, coalesce_window=0.0):
+        dispatcher = NotificationDispatcher(self.send, lambda: None, 20, 10, 30.0, 600.0, 3600.0, coalesce_window, 5.0)
+
+        async def main():
+            dispatcher.start()
+            try:
+                await steps(dispatcher)
+            finally:
+                dispatcher.task.cancel()
+
+        try:
+            asyncio.run(main())
+        finally:
+            dispatcher.executor.shutdown()
+        return dispatcher
+
+    # Wait until count emails have gone out, for up to timeout seconds
+    async def wait_sent(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < count and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    # A boot message waiting out its backoff does not hold up a PANIC to other recipients
+    def test_retry_does_not_block(self):
+        self.refused.add('admin@localhost')
+
+        async def steps(dispatcher):
+            dispatcher.submit(boot_message, ['admin@localhost'])
+            while not any(job.attempts for job in dispatcher.jobs):
+                await asyncio.sleep(0.01)
+            submitted = time.monotonic()
+            dispatcher.submit(panic_message, ['lab@localhost'], priority=2)
+            await self.wait_sent(1)
+            self.assertEqual([(recipients, subject) for recipients, subject, _ in self.sent], [(['lab@localhost'], 'PANIC')])
+            self.assertLess(self.sent[0][2] - submitted, 1.0)
+            # The boot message is still waiting for its retry
+            self.assertEqual([job.name for job in dispatcher.jobs], ['boot_message'])
+            self.assertEqual(dispatcher.jobs[0].attempts, 1)
+
+        self.run_dispatcher(steps)
+
+    # Of jobs that are due together, the most urgent goes first
+    def test_priority(self):
+        async def steps(dispatcher):
+            dispatcher.submit(warning_message, ['lab@localhost'], priority=1)
+            dispatcher.submit(panic_message, ['admin@localhost'], priority=2)
+            for job in dispatcher.jobs:
+                job.due = 0.0
+            await self.wait_sent(2)
+            self.assertEqual([subject for _, subject, _ in self.sent], ['PANIC', 'WARNING'])
+
+        self.run_dispatcher(steps)
+
+    # Jobs for the same recipients within the window go out as one email headed by the most urgent, a newer
+    # job replaces a waiting one with the same key, and other recipients get their own email
+    def test_coalesce(self):
+        async def steps(dispatcher):
+            dispatcher.submit(warning_message, ['lab@localhost'], key='Freezer', priority=1)
+            dispatcher.submit(boot_message, ['lab@localhost'])
+            dispatcher.submit(panic_message, ['lab@localhost'], key='Freezer', priority=2)
+            dispatcher.submit(warning_message, ['admin@localhost'], priority=1)
+            await self.wait_sent(2)
+            self.assertEqual(sorted((recipients, subject) for recipients, subject, _ in self.sent),
+                             [(['admin@localhost'], 'WARNING'), (['lab@localhost'], 'PANIC (+1 more)')])
+            self.assertEqual((dispatcher.merged, dispatcher.coalesced, dispatcher.delivered), (1, 1, 3))
+
+        self.run_dispatcher(steps, coalesce_window=0.1)
+
+# Stands in for smtplib's session, recording what it was asked to do
+class FakeServer:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.sent = []
+        self.closed = False
+        self.fail_send = None
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return 250, b'OK'
+
+    def sendmail(self, sender, recipients, message):
+        if self.fail_send:
+            raise self.fail_send
+        self.sent.append((recipients, message))
+
+    def quit(self):
+        self.closed = True
+
+# An SMTPConnection that opens fake sessions instead of connecting, NOOP after 60 seconds idle, closed after 300
+class FakeConnection(SMTPConnection):
+    def __init__(self):
+        super().__init__('127.0.0.1', 1, 'monitor@localhost', 'secret', 5.0, 60.0, 300.0)
+        self.servers = []
+
+    def connect(self):
+        self.server = FakeServer()
+        self.servers.append(self.server)
+        self.connects += 1
+
+class SMTPConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.smtp = FakeConnection()
+
+    # Back-to-back emails share one session
+    def test_reuse(self):
+        for i in range(3):
+            self.smtp.sendmail(['lab@localhost'], f'message {i}')
+        self.assertEqual(self.smtp.connects, 1)
+        self.assertEqual(len(self.smtp.servers[0].sent), 3)
+
+    # A session idle past noop_after is kept if it answers NOOP and replaced if not
+    def test_noop(self):
+        self.smtp.sendmail(['lab@localhost'], 'first')
+        self.smtp.last_used -= 120
+        self.smtp.sendmail(['lab@localhost'], 'second')
+        self.assertEqual(self.smtp.connects, 1)
+        self.smtp.last_used -= 120
+        self.smtp.servers[0].alive = False
+        self.smtp.sendmail(['lab@localhost'], 'third')
+        self.assertEqual(self.smtp.connects, 2)
+        self.assertTrue(self.smtp.servers[0].closed)
+        self.assertEqual([message for _, message in self.smtp.servers[1].sent], ['third'])
+
+    # A session idle past idle_timeout is replaced without asking the server
+    def test_idle_timeout(self):
+        self.smtp.sendmail(['lab@localhost'], 'first')
+        self.smtp.last_used -= 600
+        self.smtp.sendmail(['lab@localhost'], 'second')
+        self.assertEqual(self.smtp.connects, 2)
+        self.assertTrue(self.smtp.servers[0].closed)
+
+    # A session that drops mid-send is closed and the error raised, so the dispatcher retries on a new one
+    def test_disconnect(self):
+        self.smtp.sendmail(['lab@localhost'], 'first')
+        self.smtp.servers[0].fail_send = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.smtp.sendmail(['lab@localhost'], 'second')
+        self.assertIsNone(self.smtp.server)
+        self.smtp.sendmail(['lab@localhost'], 'second')
+        self.assertEqual(self.smtp.connects, 2)
+        self.assertEqual([message for _, message in self.smtp.servers[1].sent], ['second'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# The query tool: options given as text, readings and rollups looked up in a data directory, and the rows
+# written out in each text format
+
+import io
+import json
+import math
+import os
+import tempfile
+import unittest
+
+from fmonitor.query import READING_COLUMNS, History, parse_time, write_csv, write_json, write_jsonl
+from fmonitor.rollups import Rollups
+from fmonitor.storage import FLAG_READ_ERROR, ReadingStore
+
+# On a whole hour, where the rollup buckets start
+START = 1699999200.0
+
+class ParseTimeTest(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(parse_time('now', START), START)
+        self.assertEqual(parse_time('90m', START), START - 5400)
+        self.assertEqual(parse_time(' 7d ', START), START - 7 * 86400)
+        self.assertEqual(parse_time('1700000000.5', START), 1700000000.5)
+        self.assertEqual(parse_time('2023-11-14T22:13:20+00:00', START), 1.7e9)
+        with self.assertRaises(ValueError):
+            parse_time('yesterday', START)
+
+class HistoryTest(unittest.TestCase):
+    # An hour of readings every minute from two probes, the first failing once
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        store = ReadingStore(os.path.join(self.directory.name, 'readings'))
+        rollups = Rollups(os.path.join(self.directory.name, 'rollups'), 60)
+        for i in range(60):
+            for sensor_id, value in ((0, -80.0 + i / 10), (3, -20.0)):
+                failed = sensor_id == 0 and i == 30
+                store.append(START + i * 60, sensor_id, math.nan if failed else value, FLAG_READ_ERROR if failed else 0)
+                rollups.add(START + i * 60, sensor_id, math.nan if failed else value, 0)
+        store.flush()
+        store.active.close()
+        rollups.flush()
+        for f in rollups.files.values():
+            f.close()
+        self.history = History(self.directory.name, {0: 'Freezer', 3: 'Fridge'})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def select(self, kind, **options):
+        columns, rows = self.history.select(kind, options, START + 3600)
+        return columns, list(rows)
+
+    def test_readings(self):
+        columns, rows = self.select('readings', start='1h', sensor='freezer', above='-76')
+        self.assertEqual(columns, READING_COLUMNS)
+        self.assertEqual([row[3] for row in rows], [round(-80.0 + i / 10, 1) for i in range(40, 60)])
+        self.assertEqual({row[2] for row in rows}, {'Freezer'})
+        # The failed reading is kept without a temperature
+        _, rows = self.select('readings', start=str(START + 1800), end=str(START + 1860), sensor='0')
+        self.assertEqual(rows, [(START + 1800, 0, 'Freezer', None, FLAG_READ_ERROR)])
+
+    def test_rollups(self):
+        _, rows = self.select('rollups', start='1h', resolution='1h', sensor='Fridge')
+        self.assertEqual([row[2:5] for row in rows], [('Fridge', 60, 0)])
+        _, rows = self.select('rollups', start='1h', resolution='1h', sensor='Freezer')
+        self.assertEqual([row[3:5] for row in rows], [(59, 1)])
+        _, rows = self.select('rollups', start='1h', resolution='1m', sensor='Freezer', below='-79.5')
+        self.assertEqual([row[5] for row in rows], [-80.0, -79.9, -79.8, -79.7, -79.6, -79.5])
+
+    def test_bad_options(self):
+        with self.assertRaises(ValueError):
+            self.select('readings', sensor='Chest freezer')
+        with self.assertRaises(ValueError):
+            self.select('readings', above='cold')
+        with self.assertRaises(ValueError):
+            self.select('rollups', resolution='1w')
+        with self.assertRaises(FileNotFoundError):
+            History(os.path.join(self.directory.name, 'missing'), {}).select('readings', {}, START)
+
+    # Every text format holds the same rows, with the time repeated in ISO 8601
+    def test_formats(self):
+        columns, rows = self.select('readings', start='5m', sensor='Fridge')
+        out = io.StringIO()
+        write_csv(columns, rows, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'timestamp,time,sensor_id,probe,temperature,flags')
+        self.assertEqual(len(lines), len(rows) + 1)
+        out = io.StringIO()
+        write_json(columns, iter(rows), out)
+        found = json.loads(out.getvalue())
+        out = io.StringIO()
+        write_jsonl(columns, iter(rows), out)
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], found)
+        self.assertEqual([(row['timestamp'], row['temperature']) for row in found], [(row[0], row[3]) for row in rows])
+        out = io.StringIO()
+        write_json(columns, iter([]), out)
+        self.assertEqual(json.loads(out.getvalue()), [])
+
+if __name__ == '__main__':
+    unittest.main()
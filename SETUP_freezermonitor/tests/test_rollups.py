@@ -0,0 +1,164 @@
+# Rollups must give the same counts, extremes, means and variances as the readings they summarise,
+# whether the buckets are read from their monthly files, merged or still being filled
+
+import calendar
+import math
+import os
+import random
+import statistics
+import tempfile
+import unittest
+
+from fmonitor.rollups import RESOLUTIONS, ROLLUP, Bucket, Rollups
+
+# Readings every 10 seconds for two probes over the end of a month, with the odd failed read
+def readings():
+    rng = random.Random(1)
+    start = calendar.timegm((2026, 9, 30, 20, 0, 0))
+    found = []
+    for i in range(3600):
+        for sensor_id, base in ((0, -80.0), (2, -20.0)):
+            value = math.nan if rng.random() < 0.01 else round(base + rng.gauss(0, 0.5), 2)
+            found.append((start + i * 10, sensor_id, value))
+    return found
+
+class BucketTest(unittest.TestCase):
+    def test_merge(self):
+        rng = random.Random(2)
+        values = [rng.gauss(-80, 2) for _ in range(1000)]
+        parts = [Bucket(0, 0), Bucket(0, 0), Bucket(0, 0)]
+        for i, value in enumerate(values):
+            parts[min(i // 300, 2)].add(value, 0, 10.0)
+        total = Bucket(0, 0)
+        for part in parts + [Bucket(0, 0)]:
+            total.merge(part)
+        self.assertEqual(total.count, len(values))
+        self.assertEqual(total.minimum, min(values))
+        self.assertEqual(total.maximum, max(values))
+        self.assertAlmostEqual(total.mean, statistics.fmean(values))
+        self.assertAlmostEqual(total.variance(), statistics.pvariance(values))
+
+class RollupsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.readings = readings()
+        self.rollups = Rollups(self.directory.name, 60)
+        for timestamp, sensor_id, value in self.readings:
+            self.rollups.add(timestamp, sensor_id, value, 0)
+        self.rollups.flush()
+
+    def tearDown(self):
+        for f in self.rollups.files.values():
+            f.close()
+        self.directory.cleanup()
+
+    # Check buckets against the readings they cover
+    def assert_buckets(self, buckets, resolution, sensor_id=None):
+        expected = {}
+        for timestamp, sensor, value in self.readings:
+            if sensor_id is None or sensor == sensor_id:
+                expected.setdefault((timestamp - timestamp % resolution, sensor), []).append(value)
+        self.assertEqual([bucket.key() for bucket in buckets], sorted(expected))
+        for bucket in buckets:
+            values = [value for value in expected[bucket.key()] if not math.isnan(value)]
+            self.assertEqual(bucket.count, len(values))
+            self.assertEqual(bucket.errors, len(expected[bucket.key()]) - len(values))
+            # Lowest and highest are kept as 32-bit floats
+            self.assertAlmostEqual(bucket.minimum, min(values), places=4)
+            self.assertAlmostEqual(bucket.maximum, max(values), places=4)
+            self.assertAlmostEqual(bucket.mean, statistics.fmean(values))
+            self.assertAlmostEqual(bucket.variance(), statistics.pvariance(values))
+
+    # Buckets from both months' files and the ones still being filled
+    def test_query(self):
+        self.assertTrue({'1h-2026-09.bin', '1h-2026-10.bin'} <= set(os.listdir(self.directory.name)))
+        self.assert_buckets(self.rollups.query('1h', 0, 2e9), 3600)
+        self.assert_buckets(self.rollups.query('1m', 0, 2e9, 2), 60, 2)
+        self.assert_buckets(Rollups(self.directory.name, 60, writable=False).query('1d', 0, 2e9), 86400)
+
+    # Records written out of order, or more than once for the same bucket (e.g. after the clock was set
+    # back), are sorted and merged
+    def test_out_of_order(self):
+        path = self.rollups.path('1h', self.readings[0][0])
+        self.rollups.files['1h'].close()
+        with open(path, 'rb') as f:
+            data = f.read()
+        records = [data[offset:offset + ROLLUP.size] for offset in range(0, len(data), ROLLUP.size)]
+        halves = []
+        for record in records:
+            first, second = Bucket.unpack(ROLLUP.unpack(record)), Bucket(*ROLLUP.unpack(record)[:2])
+            second.errors, first.errors = first.errors, 0
+            halves += [first.pack(), second.pack()]
+        random.Random(3).shuffle(halves)
+        with open(path, 'wb') as f:
+            f.write(b''.join(halves))
+        self.assert_buckets(Rollups(self.directory.name, 60, writable=False).query('1h', 0, 2e9), 3600)
+
+# iterate goes through the monthly files one at a time and merges in the buckets still being filled, which
+# after the clock was set back can be for the same start and probe as a finished one
+class IterateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.rollups = Rollups(self.directory.name, 60)
+        self.readings = []
+        # Two probes every 10 minutes from 22:00 to 00:20 over the end of a month, the second probe's
+        # reading first each time, so its finished buckets are written ahead of the first probe's
+        start = calendar.timegm((2026, 9, 30, 22, 0, 0))
+        for minute in range(0, 150, 10):
+            for sensor_id in (2, 0):
+                self.add(start + minute * 60, sensor_id, -80.0 + minute / 100 + sensor_id)
+        # The clock set back into the first hour, whose bucket has already been written out
+        self.add(start + 1805, 0, -70.0)
+
+    def tearDown(self):
+        for f in self.rollups.files.values():
+            f.close()
+        self.directory.cleanup()
+
+    def add(self, timestamp, sensor_id, value):
+        self.rollups.add(timestamp, sensor_id, value, 0)
+        self.readings.append((timestamp, sensor_id, value))
+
+    # (start, sensor id, count, lowest, highest, mean) of the buckets the readings make, in order
+    def expected(self, resolution, start, end, sensor_id=None):
+        values = {}
+        for timestamp, sensor, value in self.readings:
+            bucket_start = timestamp - timestamp % resolution
+            if start <= bucket_start < end and (sensor_id is None or sensor == sensor_id):
+                values.setdefault((bucket_start, sensor), []).append(value)
+        return [(key[0], key[1], len(found), min(found), max(found), statistics.fmean(found)) for key, found in sorted(values.items())]
+
+    def assert_iterate(self, name, start, end, sensor_id=None):
+        found = [(bucket.start, bucket.sensor_id, bucket.count, bucket.minimum, bucket.maximum, bucket.mean)
+                 for bucket in self.rollups.iterate(name, start, end, sensor_id)]
+        expected = self.expected(RESOLUTIONS[name], start, end, sensor_id)
+        self.assertEqual([bucket[:3] for bucket in found], [bucket[:3] for bucket in expected])
+        for bucket, reading in zip(found, expected):
+            for value, expected_value in zip(bucket[3:], reading[3:]):
+                self.assertAlmostEqual(value, expected_value, places=4)
+
+    def test_order_and_merge(self):
+        for name in RESOLUTIONS:
+            self.assert_iterate(name, 0, 2e9)
+        hours = list(self.rollups.iterate('1h', 0, 2e9, 0))
+        self.assertEqual(hours[0].count, 7)
+        self.assertEqual(hours[0].maximum, -70.0)
+
+    def test_range_and_probe(self):
+        start = calendar.timegm((2026, 9, 30, 23, 0, 0))
+        self.assert_iterate('1h', start, start + 3600)
+        self.assert_iterate('1m', start + 600, start + 4800, 2)
+        self.assert_iterate('1d', start, 2e9, 0)
+        self.assertEqual(list(self.rollups.iterate('1h', 0, start - 7200)), [])
+
+    # The same buckets once the ones still being filled have been saved and read back
+    def test_reopen(self):
+        self.rollups.flush()
+        for f in self.rollups.files.values():
+            f.close()
+        self.rollups = Rollups(self.directory.name, 60, writable=False)
+        for name in RESOLUTIONS:
+            self.assert_iterate(name, 0, 2e9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# The segmented reading store: readings spread over full segments and the active one must come back
+# in time order from a query, also after a restart and after old segments have been deleted
+
+import math
+import os
+import tempfile
+import unittest
+from array import array
+
+from fmonitor.storage import FLAG_READ_ERROR, SEGMENT_RECORDS, ReadingStore
+
+# What the segments hold for a value: a 32-bit float
+def stored(value):
+    return array('f', [value])[0]
+
+class ReadingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ReadingStore(self.directory.name)
+        # Two probes every 10 seconds over three segments
+        self.records = []
+        for part in range(3):
+            for i in range(100):
+                timestamp = 1.7e9 + (part * 100 + i) * 10
+                self.add(timestamp, 0, -80.0 - i / 100)
+                self.add(timestamp, 2, -20.0 + i / 100)
+            if part < 2:
+                self.store.rotate()
+
+    def tearDown(self):
+        self.store.active.close()
+        self.directory.cleanup()
+
+    # Open the store again, as after a restart
+    def reopen(self, writable=True):
+        self.store.flush()
+        self.store.active.close()
+        self.store = ReadingStore(self.directory.name, writable)
+
+    def add(self, timestamp, sensor_id, value, flags=0):
+        self.store.append(timestamp, sensor_id, value, flags)
+        self.records.append((timestamp, sensor_id, stored(value), flags))
+
+    def expected(self, start, end, sensor_id=None):
+        return [record for record in self.records if start <= record[0] < end and (sensor_id is None or record[1] == sensor_id)]
+
+    def test_rotate(self):
+        self.assertEqual([(number, count) for number, first, last, count in self.store.index], [(1, 200), (2, 200)])
+        self.assertEqual(self.store.index[1][1:3], (1.7e9 + 1000, 1.7e9 + 1990))
+        self.assertEqual(self.store.active.count, 200)
+
+    # Ranges that start and end inside segments, with and without a probe
+    def test_query(self):
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+        for start, end in ((1.7e9 + 505, 1.7e9 + 2505), (1.7e9 + 1000, 1.7e9 + 2000), (1.7e9 + 2990, math.inf)):
+            self.assertEqual(list(self.store.query(start, end)), self.expected(start, end))
+            self.assertEqual(list(self.store.query(start, end, 2)), self.expected(start, end, 2))
+        self.assertEqual(list(self.store.query(0, 1.7e9)), [])
+
+    def test_temperature_range(self):
+        found = list(self.store.query(0, math.inf, None, -80.5, -79.9))
+        self.assertEqual(found, [record for record in self.records if -80.5 <= record[2] <= -79.9])
+
+    # A failed reading is kept with its flags but never matches a temperature range
+    def test_failed_reading(self):
+        self.add(1.7e9 + 5000, 0, math.nan, FLAG_READ_ERROR)
+        found = list(self.store.query(1.7e9 + 5000, math.inf))
+        self.assertEqual(len(found), 1)
+        self.assertTrue(math.isnan(found[0][2]))
+        self.assertEqual(found[0][3], FLAG_READ_ERROR)
+        self.assertEqual(list(self.store.query(1.7e9 + 5000, math.inf, None, -1000.0, 1000.0)), [])
+
+    # A reading older than the last one starts a new segment, so every segment stays in time order
+    def test_clock_set_back(self):
+        self.add(1.7e9 + 500, 0, -79.0)
+        self.assertEqual(len(self.store.index), 3)
+        self.assertEqual(self.store.active.count, 1)
+        self.assertEqual(len(list(self.store.query(0, math.inf))), len(self.records))
+
+    # The readings in the active segment are found again after a restart, and a segment that was already
+    # in the index is not written to again
+    def test_reopen(self):
+        self.reopen()
+        self.assertEqual(self.store.active.count, 200)
+        self.add(1.7e9 + 3000, 0, -81.0)
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+
+        self.store.rotate()
+        self.reopen(writable=False)
+        self.assertEqual(self.store.active_number, 4)
+        self.assertEqual(self.store.active.count, 0)
+        self.assertEqual(list(self.store.query(0, math.inf)), self.records)
+
+    def test_full_segment(self):
+        self.store.rotate()
+        start = 1.7e9 + 10000
+        for i in range(SEGMENT_RECORDS + 1):
+            self.store.append(start + i, 1, -80.0)
+        self.assertEqual(self.store.index[-1][3], SEGMENT_RECORDS)
+        self.assertEqual(self.store.active.count, 1)
+        self.assertEqual(len(list(self.store.query(start, math.inf, 1))), SEGMENT_RECORDS + 1)
+
+    # Expired segments are gone from the index and the disk, the rest are still queried
+    def test_expire(self):
+        self.assertEqual(self.store.expire(1.7e9 + 1500), 1)
+        self.assertEqual([entry[0] for entry in self.store.index], [2])
+        self.assertFalse(os.path.exists(self.store.segment_path(1)))
+        self.assertEqual(list(self.store.query(0, math.inf)), self.expected(1.7e9 + 1000, math.inf))
+        self.reopen(writable=False)
+        self.assertEqual([entry[0] for entry in self.store.index], [2])
+
+if __name__ == '__main__':
+    unittest.main()
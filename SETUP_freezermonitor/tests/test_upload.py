@@ -0,0 +1,94 @@
+# The on-disk upload queue: readings must be sent once each, in order, and none lost when the monitor
+# restarts between sending a batch and recording it, or after a power cut mid-write
+
+import json
+import os
+import tempfile
+import unittest
+
+from fmonitor.upload import UploadQueue
+
+def events(count, start=0):
+    return [('Freezer Temperature', -80.0 - i / 100, 1.7e9 + i * 10) for i in range(start, start + count)]
+
+class UploadQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'upload_queue.jsonl')
+        self.queue = UploadQueue(self.path)
+
+    def tearDown(self):
+        self.queue.file.close()
+        self.directory.cleanup()
+
+    def reopen(self):
+        self.queue.file.close()
+        self.queue = UploadQueue(self.path)
+
+    # Take and commit batches until the queue is empty, returning the epochs sent
+    def drain(self, size=4):
+        sent = []
+        while True:
+            batch, end = self.queue.read_batch(size)
+            if end == self.queue.offset:
+                return sent
+            sent.extend(json.loads(event)['epoch'] for event in batch)
+            self.queue.commit(end)
+
+    def test_batches(self):
+        self.queue.extend(events(10))
+        batch, end = self.queue.read_batch(4)
+        self.assertEqual([json.loads(event)['value'] for event in batch], [-80.0, -80.01, -80.02, -80.03])
+        self.queue.commit(end)
+        self.assertEqual(self.queue.offset, end)
+        self.assertEqual(self.drain(), [1.7e9 + i * 10 for i in range(4, 10)])
+        # Emptied once everything has been sent
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.queue.offset, 0)
+        self.assertEqual(self.queue.backlog_bytes(), 0)
+
+    # Committed readings are not sent again after a restart, the others are
+    def test_restart(self):
+        self.queue.extend(events(10))
+        self.queue.commit(self.queue.read_batch(6)[1])
+        self.reopen()
+        self.assertEqual(self.drain(), [1.7e9 + i * 10 for i in range(6, 10)])
+
+    # A batch sent but not yet committed when the monitor stopped is sent again rather than lost
+    def test_restart_before_commit(self):
+        self.queue.extend(events(5))
+        self.queue.read_batch(5)
+        self.reopen()
+        self.assertEqual(len(self.drain()), 5)
+
+    # A power cut between resetting the offset and emptying the file sends the last batch twice at worst
+    def test_crash_while_emptying(self):
+        self.queue.extend(events(5))
+        self.queue.write_offset(0)
+        self.reopen()
+        self.assertEqual(len(self.drain()), 5)
+
+    # An offset past the end of the file (e.g. the queue file was deleted by hand)
+    # is brought back to the end, and an unreadable offset starts from the beginning
+    def test_bad_offset(self):
+        self.queue.extend(events(3))
+        with open(self.path + '.offset', 'w') as f:
+            f.write('1000000')
+        self.reopen()
+        self.assertEqual(self.queue.offset, os.path.getsize(self.path))
+        with open(self.path + '.offset', 'w') as f:
+            f.write('garbage')
+        self.reopen()
+        self.assertEqual(self.queue.offset, 0)
+
+    # A line cut short by a power cut is skipped, and the readings after it still start on their own line
+    def test_partial_line(self):
+        self.queue.extend(events(2))
+        self.queue.file.write(b'{"key": "Freezer Temperature", "val')
+        self.queue.file.flush()
+        self.reopen()
+        self.queue.extend(events(2, start=2))
+        self.assertEqual(self.drain(), [1.7e9 + i * 10 for i in range(4)])
+
+if __name__ == '__main__':
+    unittest.main()